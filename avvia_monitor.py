@@ -0,0 +1,10 @@
+# AVVIO VELOCE del Flight Monitor (per cron/launchd)
+# Stesse opzioni di `python flight_monitor.py`, ma il modulo viene importato:
+# Python usa il bytecode in __pycache__ invece di ricompilare lo script a ogni avvio.
+#
+#   python avvia_monitor.py [--daemon] [--importa-storico FILE]
+
+from flight_monitor import main
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,321 @@
+# BENCHMARK OFFLINE del Flight Monitor
+# Esegue controlla_prezzi e il bot Telegram contro mock_server.py e misura
+# tempo totale, chiamate per esecuzione, latenza p50/p99 e memoria di picco
+# (RSS massimo del processo, server finto incluso).
+#
+#   python benchmark.py                      # 1, 10 e 100 watch
+#   python benchmark.py --watch 10 --latenza-ms 200 --prob-429 0.05
+#   python benchmark.py --avvio 10           # costo di avvio (python -X importtime)
+#   python benchmark.py --riproduci traffico_http.jsonl.gz   # ciclo reale registrato con --registra
+#
+# Per profilare lo stesso ciclo:
+#   python -m cProfile -o ciclo.prof avvia_monitor.py --riproduci traffico_http.jsonl.gz
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+
+CARTELLA = os.path.dirname(os.path.abspath(__file__))
+AEROPORTI = ['FCO', 'MXP', 'VCE', 'NAP', 'BLQ', 'MEX', 'JFK', 'CUN', 'LAX', 'MIA', 'GRU', 'BKK']
+
+
+def percentile(valori, p):
+    if not valori:
+        return 0.0
+    ordinati = sorted(valori)
+    indice = min(len(ordinati) - 1, max(0, int(round(p / 100 * (len(ordinati) - 1)))))
+    return ordinati[indice]
+
+
+def genera_watchlist(n):
+    """n watch su rotte e date diverse (alcune rotte ripetute, come nella realtà)."""
+    watches = []
+    for i in range(n):
+        origine = AEROPORTI[i % 5]
+        destinazione = AEROPORTI[5 + (i // 5) % 7]
+        partenza = date(2026, 1, 12) + timedelta(days=7 * (i // 35))
+        watches.append({
+            'nome': f"W{i:03d} {origine}-{destinazione}",
+            'origine': origine,
+            'destinazione': destinazione,
+            'partenza': partenza.isoformat(),
+            'ritorno': (partenza + timedelta(days=27)).isoformat(),
+            'passeggeri': 1 + i % 4,
+        })
+    return watches
+
+
+def _ambiente_scenario(url, cartella, args):
+    return {
+        'AMADEUS_API_URL': url,
+        'TELEGRAM_API_URL': url,
+        'AMADEUS_API_KEY': 'benchmark',
+        'AMADEUS_API_SECRET': 'benchmark',
+        'TELEGRAM_BOT_TOKEN': 'benchmark',
+        'TELEGRAM_CHAT_ID': '1',
+        'USA_TELEGRAM': 'True',
+        'WATCHLIST_FILE': os.path.join(cartella, 'watchlist.json'),
+        'CACHE_TTL_SECONDI': '0',
+        'AMADEUS_QUOTA_MENSILE': '0',
+        'AMADEUS_RICHIESTE_AL_SECONDO': str(args.rps),
+        'AMADEUS_BURST': str(max(1, int(args.rps))),
+        'AMADEUS_MAX_OFFERTE': str(args.offerte),
+        'MAX_COMBINAZIONI': str(args.combinazioni),
+        'MAX_RICERCHE_PARALLELE': str(args.paralleli),
+        'TELEGRAM_INTERVALLO_MESSAGGI': '0',
+    }
+
+
+def esegui_scenario(args):
+    """Processo figlio: un solo scenario, risultati in JSON su stdout."""
+    import mock_server
+
+    server, stato, url = mock_server.avvia_server(
+        latenza_ms=args.latenza_ms, jitter_ms=args.jitter_ms,
+        prob_429=args.prob_429, retry_after=args.retry_after, seme=42,
+    )
+    # Cache, storico, quota e lock del ciclo restano nella cartella temporanea
+    with tempfile.TemporaryDirectory(prefix='bench-flight-') as cartella:
+        os.chdir(cartella)
+        try:
+            risultato = _misura_scenario(args, stato, url, cartella)
+        finally:
+            os.chdir(CARTELLA)
+            server.shutdown()
+    print(json.dumps(risultato))
+
+
+def _misura_scenario(args, stato, url, cartella):
+    with open('watchlist.json', 'w') as f:
+        json.dump(genera_watchlist(args.scenario), f)
+    os.environ.update(_ambiente_scenario(url, cartella, args))
+
+    sys.path.insert(0, CARTELLA)
+    import flight_monitor as fm
+
+    # Latenza vista dal client per ogni richiesta HTTP
+    latenze = []
+    http_get, http_post = fm.http_get, fm.http_post
+
+    def misura(funzione):
+        def avvolta(url, **kwargs):
+            inizio = time.perf_counter()
+            try:
+                return funzione(url, **kwargs)
+            finally:
+                latenze.append(time.perf_counter() - inizio)
+        return avvolta
+
+    fm.http_get, fm.http_post = misura(http_get), misura(http_post)
+
+    inizio = time.perf_counter()
+    if args.comandi:
+        for _ in range(args.comandi):
+            stato.accoda_comando('/prezzi')
+        stop = threading.Event()
+
+        def attendi_risposte():
+            while len(stato.messaggi) < args.comandi and time.perf_counter() - inizio < 300:
+                time.sleep(0.01)
+            stop.set()
+
+        threading.Thread(target=attendi_risposte, daemon=True).start()
+        fm.ascolta_comandi_telegram(stop)
+    else:
+        fm.controlla_prezzi()
+    durata = time.perf_counter() - inizio
+    picco = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        picco *= 1024  # Linux: kB, macOS: byte
+
+    fm.chiudi_sessioni_http()
+    chiamate = stato.riepilogo()
+    return {
+        'scenario': f"bot {args.comandi} comandi" if args.comandi else f"{args.scenario} watch",
+        'secondi': round(durata, 3),
+        'chiamate': chiamate,
+        'richieste_http': len(latenze),
+        'p50_ms': round(percentile(latenze, 50) * 1000, 1),
+        'p99_ms': round(percentile(latenze, 99) * 1000, 1),
+        'picco_mb': round(picco / 1024 / 1024, 2),
+    }
+
+
+def _importtime(comando, env=None):
+    """Esegue `comando` con -X importtime; ritorna (secondi, {modulo: (µs cumulativi, profondità)})."""
+    inizio = time.perf_counter()
+    uscita = subprocess.run([sys.executable, '-X', 'importtime'] + comando, capture_output=True,
+                            text=True, cwd=tempfile.gettempdir(), env=env)
+    durata = time.perf_counter() - inizio
+    moduli = {}
+    for riga in uscita.stderr.splitlines():
+        if not riga.startswith('import time:') or 'cumulative' in riga:
+            continue
+        _, cumulativo, nome = riga.split('|')
+        profondita = (len(nome) - len(nome.lstrip()) - 1) // 2
+        moduli[nome.strip()] = (int(cumulativo), profondita)
+    return durata, moduli
+
+def misura_avvio(ripetizioni):
+    """Costo di avvio: import del modulo e un'esecuzione che si ferma al controllo configurazione."""
+    import py_compile
+    
+    env = dict(os.environ, PYTHONPATH=CARTELLA, TELEGRAM_BOT_TOKEN='', TELEGRAM_CHAT_ID='',
+               AMADEUS_API_KEY='', AMADEUS_API_SECRET='', USA_TELEGRAM='True')
+    # Bytecode aggiornato come dopo il primo avvio (anche con PYTHONDONTWRITEBYTECODE)
+    py_compile.compile(os.path.join(CARTELLA, 'flight_monitor.py'))
+    vuoto, importi, esecuzioni, veloci = [], [], [], []
+    dettaglio = {}
+    pesanti = set()
+    base = set(_importtime(['-c', 'pass'], env)[1])  # moduli caricati comunque dall'interprete
+    for _ in range(ripetizioni):
+        vuoto.append(_importtime(['-c', 'pass'], env)[0])
+        _, moduli = _importtime(['-c', 'import flight_monitor'], env)
+        importi.append(moduli.get('flight_monitor', (0, 0))[0] / 1e6)
+        for nome, (us, profondita) in moduli.items():
+            if profondita == 1 and nome not in base:  # import fatti direttamente da flight_monitor
+                dettaglio.setdefault(nome, []).append(us)
+        durata, moduli = _importtime([os.path.join(CARTELLA, 'flight_monitor.py')], env)
+        esecuzioni.append(durata)
+        veloci.append(_importtime([os.path.join(CARTELLA, 'avvia_monitor.py')], env)[0])
+        pesanti.update(m for m in ('requests', 'urllib3', 'asyncio', 'smtplib', 'numpy') if m in moduli)
+    
+    print(f"\n{'avvio (mediana di ' + str(ripetizioni) + ')':<42}{'ms':>8}")
+    print("-" * 50)
+    print(f"{'interprete vuoto (python -c pass)':<42}{percentile(vuoto, 50) * 1000:>8.1f}")
+    print(f"{'import flight_monitor':<42}{percentile(importi, 50) * 1000:>8.1f}")
+    print(f"{'flight_monitor.py senza configurazione':<42}{percentile(esecuzioni, 50) * 1000:>8.1f}")
+    print(f"{'avvia_monitor.py senza configurazione':<42}{percentile(veloci, 50) * 1000:>8.1f}")
+    print(f"\nModuli caricati da un'esecuzione senza configurazione: "
+          f"{', '.join(sorted(pesanti)) or 'nessuno tra requests/urllib3/asyncio/smtplib/numpy'}")
+    print("\nImport diretti più costosi (µs cumulativi, mediana):")
+    for nome in sorted(dettaglio, key=lambda n: -percentile(dettaglio[n], 50))[:10]:
+        print(f"  {percentile(dettaglio[nome], 50):>8}  {nome}")
+    return {
+        'vuoto_ms': round(percentile(vuoto, 50) * 1000, 1),
+        'import_ms': round(percentile(importi, 50) * 1000, 1),
+        'esecuzione_ms': round(percentile(esecuzioni, 50) * 1000, 1),
+        'esecuzione_avvio_veloce_ms': round(percentile(veloci, 50) * 1000, 1),
+        'moduli_pesanti': sorted(pesanti),
+    }
+
+def misura_riproduzione(archivio, ripetizioni):
+    """Tempo e memoria di un ciclo registrato, riprodotto alla massima velocità in una cartella vuota.
+
+    Usa l'ambiente corrente (watchlist, soglie...): deve essere lo stesso della registrazione.
+    """
+    env = dict(os.environ)
+    env['WATCHLIST_FILE'] = os.path.abspath(env.get('WATCHLIST_FILE', 'watchlist.json'))
+    for nome in ('AMADEUS_API_KEY', 'AMADEUS_API_SECRET', 'TELEGRAM_BOT_TOKEN', 'TELEGRAM_CHAT_ID'):
+        env[nome] = env.get(nome) or 'riproduzione'
+    comando = [sys.executable, os.path.join(CARTELLA, 'avvia_monitor.py'), '--riproduci', os.path.abspath(archivio)]
+    tempi = []
+    for _ in range(ripetizioni):
+        with tempfile.TemporaryDirectory() as cartella:  # storico, notifiche e quota da zero
+            inizio = time.perf_counter()
+            uscita = subprocess.run(comando, capture_output=True, text=True, cwd=cartella, env=env)
+            tempi.append(time.perf_counter() - inizio)
+        if uscita.returncode != 0:
+            print(uscita.stdout[-2000:], uscita.stderr[-2000:])
+            sys.exit("❌ Riproduzione fallita")
+    riepilogo = [r for r in uscita.stdout.splitlines() if r.startswith('📼 Riprodotti')]
+    picco = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    if sys.platform != 'darwin':
+        picco *= 1024  # Linux: kB, macOS: byte
+    picco /= 1024 * 1024
+    print(f"\n{'riproduzione (' + str(ripetizioni) + ' esecuzioni)':<42}{'valore':>10}")
+    print("-" * 52)
+    print(f"{'tempo p50 s':<42}{percentile(tempi, 50):>10.3f}")
+    print(f"{'tempo minimo s':<42}{min(tempi):>10.3f}")
+    print(f"{'picco MB':<42}{picco:>10.2f}")
+    if riepilogo:
+        print(riepilogo[-1])
+    return {
+        'archivio': archivio,
+        'p50_s': round(percentile(tempi, 50), 3),
+        'min_s': round(min(tempi), 3),
+        'picco_mb': round(picco, 2),
+    }
+
+def stampa_tabella(risultati):
+    print()
+    print(f"{'scenario':<18}{'tempo s':>9}{'HTTP':>7}{'offerte':>9}{'429':>6}{'p50 ms':>9}{'p99 ms':>9}{'picco MB':>10}")
+    print("-" * 77)
+    for r in risultati:
+        c = r['chiamate']
+        print(f"{r['scenario']:<18}{r['secondi']:>9.2f}{r['richieste_http']:>7}"
+              f"{c.get('flight-offers', 0):>9}{c.get('429', 0):>6}"
+              f"{r['p50_ms']:>9.1f}{r['p99_ms']:>9.1f}{r['picco_mb']:>10.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark offline del Flight Monitor")
+    parser.add_argument('--watch', default='1,10,100', help="numero di watch per scenario, separati da virgola")
+    parser.add_argument('--comandi', type=int, default=0, help="misura invece il bot con N comandi /prezzi")
+    parser.add_argument('--latenza-ms', type=float, default=50)
+    parser.add_argument('--jitter-ms', type=float, default=15)
+    parser.add_argument('--prob-429', type=float, default=0.0)
+    parser.add_argument('--retry-after', type=int, default=1, help="Retry-After dei 429 (secondi interi)")
+    parser.add_argument('--rps', type=float, default=1000, help="limite richieste/s del client")
+    parser.add_argument('--paralleli', type=int, default=10)
+    parser.add_argument('--combinazioni', type=int, default=5, help="MAX_COMBINAZIONI per watch (0 = tutte)")
+    parser.add_argument('--offerte', type=int, default=50, help="offerte per risposta (max)")
+    parser.add_argument('--avvio', type=int, nargs='?', const=10, metavar='N',
+                        help="misura solo il costo di avvio (N ripetizioni, default 10)")
+    parser.add_argument('--riproduci', metavar='ARCHIVIO',
+                        help="misura un ciclo registrato con flight_monitor.py --registra")
+    parser.add_argument('--ripetizioni', type=int, default=5, help="esecuzioni per --riproduci")
+    parser.add_argument('--json', metavar='FILE', help="salva i risultati anche in JSON")
+    parser.add_argument('--scenario', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scenario is not None:
+        esegui_scenario(args)
+        return
+    
+    if args.avvio or args.riproduci:
+        if args.avvio:
+            risultato = misura_avvio(args.avvio)
+        else:
+            risultato = misura_riproduzione(args.riproduci, args.ripetizioni)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(risultato, f, indent=2)
+        return
+
+    # Ogni scenario in un processo nuovo: stato, cache e memoria partono da zero
+    scenari = [['--comandi', str(args.comandi), '--scenario', '1']] if args.comandi else \
+        [['--scenario', n.strip()] for n in args.watch.split(',') if n.strip()]
+    comuni = [
+        '--latenza-ms', str(args.latenza_ms), '--jitter-ms', str(args.jitter_ms),
+        '--prob-429', str(args.prob_429), '--retry-after', str(args.retry_after),
+        '--rps', str(args.rps), '--paralleli', str(args.paralleli),
+        '--combinazioni', str(args.combinazioni), '--offerte', str(args.offerte),
+    ]
+    risultati = []
+    for scenario in scenari:
+        print(f"⏱️ Scenario {' '.join(scenario)}...")
+        uscita = subprocess.run(
+            [sys.executable, os.path.abspath(__file__)] + scenario + comuni,
+            capture_output=True, text=True, cwd=CARTELLA,
+        )
+        if uscita.returncode != 0:
+            print(uscita.stdout[-2000:], uscita.stderr[-2000:])
+            sys.exit(f"❌ Scenario {' '.join(scenario)} fallito")
+        risultati.append(json.loads(uscita.stdout.strip().splitlines()[-1]))
+
+    stampa_tabella(risultati)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(risultati, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,29 @@
 # FLIGHT MONITOR SICURO per GitHub
 # Versione migliorata del tuo script originale
 
-import requests
+# requests/urllib3, asyncio e smtplib sono importati solo quando servono:
+# un'esecuzione che si ferma prima (es. configurazione mancante) non li carica
 import json
-import smtplib
+import sqlite3
 import os
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
-from urllib.parse import urlencode
+from urllib.parse import quote, urlsplit
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import abc
+import bisect
+import contextlib
+import functools
+import heapq
+import itertools
+import math
+import threading
+import re
 import time
+import argparse
+import random
+import signal
+import zlib
 
 # Carica variabili d'ambiente dal file .env
 load_dotenv()
@@ -23,14 +38,55 @@ PREZZO_ATTUALE = int(os.getenv('PREZZO_ATTUALE', '1420'))
 NUMERO_PASSEGGERI = int(os.getenv('NUMERO_PASSEGGERI', '4'))
 FLESSIBILITA_GIORNI = int(os.getenv('FLESSIBILITA_GIORNI', '7'))
 
+# Watchlist multi-rotta (JSON); se il file non esiste si usa la rotta definita sopra
+ORIGINE = os.getenv('ORIGINE', 'FCO')
+DESTINAZIONE = os.getenv('DESTINAZIONE', 'MEX')
+WATCHLIST_FILE = os.getenv('WATCHLIST_FILE', 'watchlist.json')
+
+# Storico prezzi (SQLite): ogni offerta vista, per rotta e date
+STORICO_DB = os.getenv('STORICO_DB', 'storico_prezzi.sqlite')
+SQLITE_ATTESA_SECONDI = float(os.getenv('SQLITE_ATTESA_SECONDI', '30'))  # database occupato da un altro processo
+
+# Modalità daemon (--daemon): controlli periodici nello stesso processo
+INTERVALLO_MINUTI = float(os.getenv('INTERVALLO_MINUTI', '60'))
+JITTER_SECONDI = float(os.getenv('JITTER_SECONDI', '60'))
+
+# Ricerche in parallelo (limite richieste contemporanee verso Amadeus)
+MAX_RICERCHE_PARALLELE = int(os.getenv('MAX_RICERCHE_PARALLELE', '5'))
+MAX_COMBINAZIONI = int(os.getenv('MAX_COMBINAZIONI', '0'))  # 0 = tutte
+
+# Polling adattivo: ogni combinazione di date ha il suo intervallo (vedi intervallo_adattivo)
+POLLING_ADATTIVO = os.getenv('POLLING_ADATTIVO', 'False').lower() == 'true'
+POLLING_MIN_MINUTI = float(os.getenv('POLLING_MIN_MINUTI', '15'))
+POLLING_MAX_MINUTI = float(os.getenv('POLLING_MAX_MINUTI', '1440'))
+
+# Esecuzione a shard (--processi N): watch divisi per rotta tra N processi, un solo scrittore.
+# I lock per bucket in LOCK_DIR evitano che due istanze sullo stesso host controllino la stessa rotta
+SHARD_PROCESSI = int(os.getenv('SHARD_PROCESSI', '1'))
+SHARD_BUCKET = 64  # shard = bucket % processi: cambiare N non sposta i lock
+LOCK_DIR = os.getenv('LOCK_DIR', '.locks')
+
 # Vincoli viaggio
 MIN_DURATA_VIAGGIO = int(os.getenv('MIN_DURATA_VIAGGIO', '25'))
 MAX_DURATA_VIAGGIO = int(os.getenv('MAX_DURATA_VIAGGIO', '35'))
+DURATA_IDEALE = int(os.getenv('DURATA_IDEALE', '28'))
+
+# Giorni in cui opera il volo (es. "lun,gio,sab"); vuoto = pattern fisso di offset Aeromexico
+GIORNI_OPERATIVI = os.getenv('GIORNI_OPERATIVI', '')
+GIORNI_OPERATIVI_RITORNO = os.getenv('GIORNI_OPERATIVI_RITORNO', '')
 
 # Notifiche
 MIN_CALO_PER_NOTIFICA = int(os.getenv('MIN_CALO_PER_NOTIFICA', '20'))
 SEMPRE_NOTIFICA_SOTTO = int(os.getenv('SEMPRE_NOTIFICA_SOTTO', '1200'))
 
+# Calo "statistico": prezzo sotto la media mobile di almeno ANALISI_SOGLIA_Z deviazioni standard
+ANALISI_MIN_OSSERVAZIONI = int(os.getenv('ANALISI_MIN_OSSERVAZIONI', '5'))  # prima: confronto con l'ultimo prezzo
+ANALISI_SOGLIA_Z = float(os.getenv('ANALISI_SOGLIA_Z', '2.0'))
+ANALISI_ALFA_EWMA = float(os.getenv('ANALISI_ALFA_EWMA', '0.3'))
+ANALISI_ERRORE_QUANTILI = float(os.getenv('ANALISI_ERRORE_QUANTILI', '0.01'))
+# Analizza solo i watch con offerte cambiate rispetto all'ultima istantanea (prezzi fermi = nessun avviso)
+ANALISI_SOLO_VARIAZIONI = os.getenv('ANALISI_SOLO_VARIAZIONI', 'True').lower() == 'true'
+
 # Credenziali (SICURE - da variabili d'ambiente)
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 TELEGRAM_CHAT_ID = os.getenv('TELEGRAM_CHAT_ID')
@@ -39,84 +95,1272 @@ USA_TELEGRAM = os.getenv('USA_TELEGRAM', 'True').lower() == 'true'
 # Email (se non usi Telegram)
 TUA_EMAIL = os.getenv('TUA_EMAIL')
 PASSWORD_EMAIL = os.getenv('PASSWORD_EMAIL')
+SMTP_HOST = os.getenv('SMTP_HOST', 'smtp.gmail.com')
+SMTP_PORT = int(os.getenv('SMTP_PORT', '587'))
+SMTP_STARTTLS = os.getenv('SMTP_STARTTLS', 'True').lower() == 'true'
+
+# Invio notifiche: digest a fine controllo, senza ripetere lo stesso avviso
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org').rstrip('/')
+TELEGRAM_INTERVALLO_MESSAGGI = float(os.getenv('TELEGRAM_INTERVALLO_MESSAGGI', '1.1'))
+TELEGRAM_MAX_CARATTERI = 4096
+FINESTRA_DEDUP_ORE = float(os.getenv('FINESTRA_DEDUP_ORE', '12'))
+NOTIFICHE_FILE = os.getenv('NOTIFICHE_FILE', 'notifiche_inviate.json')
+# Avvisi non consegnati (Telegram/SMTP giù): ritentati ai controlli successivi
+NOTIFICHE_SOSPESE_FILE = os.getenv('NOTIFICHE_SOSPESE_FILE', 'notifiche_in_sospeso.json')
+NOTIFICHE_SOSPESE_ORE = float(os.getenv('NOTIFICHE_SOSPESE_ORE', '24'))
 
 # Amadeus API (gratuita tier Self-Service con limiti)
 AMADEUS_API_KEY = os.getenv('AMADEUS_API_KEY')
 AMADEUS_API_SECRET = os.getenv('AMADEUS_API_SECRET')
+AMADEUS_API_URL = os.getenv('AMADEUS_API_URL', 'https://test.api.amadeus.com').rstrip('/')
 
 # Ascolto comandi Telegram (richieste manuali) e siti selezionati
 ASCOLTA_COMANDI_TELEGRAM = os.getenv('ASCOLTA_COMANDI_TELEGRAM', 'False').lower() == 'true'
 SITI_SELEZIONATI = os.getenv('SITI_SELEZIONATI', 'amadeus,google,skyscanner,kayak,aeromexico')
 INVIA_REPORT_SEMPRE = os.getenv('INVIA_REPORT_SEMPRE', 'False').lower() == 'true'
+TELEGRAM_BACKOFF_MAX = float(os.getenv('TELEGRAM_BACKOFF_MAX', '60'))
+PROVIDER_BUDGET_SECONDI = float(os.getenv('PROVIDER_BUDGET_SECONDI', '30'))  # attesa massima per /prezzi
+
+# Connessioni HTTP (una Session con pool per host, keep-alive e retry)
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '10'))
+HTTP_RETRY = int(os.getenv('HTTP_RETRY', '3'))
+HTTP_BACKOFF = float(os.getenv('HTTP_BACKOFF', '0.5'))
+
+_SESSIONI_HTTP = {}
+_SESSIONI_LOCK = threading.Lock()
+
+def _crea_sessione(solo_connessione=False):
+    """Crea una Session con pool di connessioni e retry su errori di rete e 5xx.
+
+    Il 429 resta fuori dai retry del trasporto (anche con Retry-After): lo
+    gestisce solo amadeus_get, che passa da limitatore e quota. Con
+    `solo_connessione` (host Amadeus) si ritenta solo se la connessione non
+    si apre: timeout di lettura e 5xx tornano ad amadeus_get e al circuit
+    breaker, perché ogni GET ripetuta è una chiamata fatturata.
+    """
+    ripeti = 0 if solo_connessione else HTTP_RETRY
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    
+    retry = Retry(
+        total=HTTP_RETRY,
+        connect=HTTP_RETRY,
+        read=ripeti,
+        status=ripeti,
+        other=ripeti,
+        backoff_factor=HTTP_BACKOFF,
+        status_forcelist=(500, 502, 503, 504),
+        respect_retry_after_header=False,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=HTTP_POOL_SIZE,
+        max_retries=retry,
+    )
+    sessione = requests.Session()
+    sessione.mount('https://', adapter)
+    sessione.mount('http://', adapter)
+    sessione.headers.update({
+        'Accept-Encoding': 'gzip, deflate',
+        'Connection': 'keep-alive',
+    })
+    return sessione
+
+def sessione_http(url):
+    """Ritorna la Session condivisa per l'host dell'URL (creata alla prima richiesta)."""
+    parti = urlsplit(url)
+    chiave = (parti.scheme, parti.netloc)
+    sessione = _SESSIONI_HTTP.get(chiave)
+    if sessione is None:
+        with _SESSIONI_LOCK:
+            sessione = _SESSIONI_HTTP.get(chiave)
+            if sessione is None:
+                sessione = _crea_sessione(parti.netloc == urlsplit(AMADEUS_API_URL).netloc)
+                _SESSIONI_HTTP[chiave] = sessione
+    return sessione
+
+def http_get(url, **kwargs):
+    """GET tramite la Session condivisa dell'host."""
+    if _ARCHIVIO_HTTP['modalita']:
+        return _scambio_archivio('GET', url, kwargs)
+    return sessione_http(url).get(url, **kwargs)
+
+def http_post(url, **kwargs):
+    """POST tramite la Session condivisa dell'host.
+
+    I retry su 5xx valgono solo per metodi idempotenti: una POST viene
+    ritentata solo se la connessione non è mai partita.
+    """
+    if _ARCHIVIO_HTTP['modalita']:
+        return _scambio_archivio('POST', url, kwargs)
+    return sessione_http(url).post(url, **kwargs)
+
+def chiudi_sessioni_http():
+    """Chiude tutte le Session aperte (fine processo)."""
+    with _SESSIONI_LOCK:
+        for sessione in _SESSIONI_HTTP.values():
+            sessione.close()
+        _SESSIONI_HTTP.clear()
+
+# Registrazione e riproduzione del traffico (--registra / --riproduci): ogni scambio di
+# http_get/http_post finisce in un archivio JSON-lines gzip, con token e segreti oscurati
+_ARCHIVIO_HTTP = {'modalita': None, 'file': None, 'inizio': 0.0, 'tempi_originali': False,
+                  'per_richiesta': {}, 'per_percorso': {}, 'scambi': 0, 'sintetiche': 0}
+_ARCHIVIO_LOCK = threading.Lock()
+_CAMPI_SEGRETI = frozenset(('client_id', 'client_secret', 'access_token'))
+_INTESTAZIONI_ARCHIVIO = ('Content-Type', 'Retry-After')
+
+class RichiestaNonRegistrata(ConnectionError):
+    """In riproduzione: la richiesta non ha (più) una risposta nell'archivio."""
+
+class RispostaRegistrata:
+    """Risposta letta dall'archivio, con la parte di requests.Response che usiamo."""
+    
+    def __init__(self, url, stato, corpo, intestazioni=None):
+        self.url = url
+        self.status_code = stato
+        self.text = corpo
+        self.headers = _IntestazioniRegistrate((k.lower(), v) for k, v in (intestazioni or {}).items())
+    
+    @property
+    def ok(self):
+        return self.status_code < 400
+    
+    def json(self):
+        return json.loads(self.text)
+    
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            import requests
+            raise requests.HTTPError(f"{self.status_code} (risposta registrata) per {self.url}", response=self)
+
+class _IntestazioniRegistrate(dict):
+    """Intestazioni con get() senza distinzione tra maiuscole e minuscole, come in requests."""
+    def get(self, chiave, predefinito=None):
+        return super().get(chiave.lower(), predefinito)
+
+def _percorso_archivio(url):
+    """Percorso dell'URL senza host e con il token del bot oscurato."""
+    return re.sub(r'/bot[^/]+/', '/bot***/', urlsplit(url).path)
+
+def _oscura(valori):
+    return {k: '***' if k in _CAMPI_SEGRETI else v for k, v in (valori or {}).items()}
+
+def _chiave_richiesta(metodo, percorso, params):
+    return (metodo, percorso, json.dumps(sorted(_oscura(params).items())))
+
+def configura_archivio_http(registra=None, riproduci=None, tempi_originali=False):
+    """Attiva la registrazione su `registra` o la riproduzione da `riproduci`.
+
+    In entrambi i casi cache e quota sono spente: ogni ricerca passa
+    dall'archivio e registrazione e riproduzione fanno le stesse richieste
+    (una chiamata rifiutata dalla quota mancherebbe nell'archivio). In
+    riproduzione il token non viene letto né salvato su file; senza
+    `tempi_originali` anche limite di frequenza e pause Telegram sono tolti,
+    così il ciclo gira alla massima velocità.
+    """
+    global CACHE_TTL_SECONDI, AMADEUS_QUOTA_MENSILE, AMADEUS_RICHIESTE_AL_SECONDO, AMADEUS_BURST
+    global TELEGRAM_INTERVALLO_MESSAGGI
+    import gzip
+    _ARCHIVIO_HTTP['inizio'] = time.monotonic()
+    _ARCHIVIO_HTTP['tempi_originali'] = tempi_originali
+    CACHE_TTL_SECONDI = 0
+    AMADEUS_QUOTA_MENSILE = 0
+    if registra:
+        _ARCHIVIO_HTTP['file'] = gzip.open(registra, 'wt', encoding='utf-8')
+        _ARCHIVIO_HTTP['modalita'] = 'registra'
+        return
+    with gzip.open(riproduci, 'rt', encoding='utf-8') as f:
+        for riga in f:
+            voce = json.loads(riga)
+            voce['usata'] = False
+            chiave = _chiave_richiesta(voce['metodo'], voce['percorso'], voce.get('params'))
+            _ARCHIVIO_HTTP['per_richiesta'].setdefault(chiave, []).append(voce)
+            _ARCHIVIO_HTTP['per_percorso'].setdefault(chiave[:2], []).append(voce)
+    _ARCHIVIO_HTTP['modalita'] = 'riproduci'
+    if not tempi_originali:
+        AMADEUS_RICHIESTE_AL_SECONDO = 1e9
+        AMADEUS_BURST = 10 ** 9
+        _LIMITATORE['gettoni'] = float(AMADEUS_BURST)
+        TELEGRAM_INTERVALLO_MESSAGGI = 0
+
+def chiudi_archivio_http():
+    """Chiude l'archivio e riassume quanti scambi sono stati registrati o riprodotti."""
+    modalita = _ARCHIVIO_HTTP['modalita']
+    if modalita == 'registra':
+        _ARCHIVIO_HTTP['file'].close()
+        print(f"📼 Registrati {_ARCHIVIO_HTTP['scambi']} scambi HTTP")
+    elif modalita == 'riproduci':
+        avanzate = sum(not v['usata'] for voci in _ARCHIVIO_HTTP['per_percorso'].values() for v in voci)
+        print(f"📼 Riprodotti {_ARCHIVIO_HTTP['scambi']} scambi HTTP "
+              f"({_ARCHIVIO_HTTP['sintetiche']} senza registrazione, {avanzate} non usati)")
+    _ARCHIVIO_HTTP['modalita'] = None
+
+def riproduzione_finita(frammento):
+    """True se si sta riproducendo e non restano risposte per URL che contengono `frammento`."""
+    if _ARCHIVIO_HTTP['modalita'] != 'riproduci':
+        return False
+    with _ARCHIVIO_LOCK:
+        return not any(not v['usata'] for (_, percorso), voci in _ARCHIVIO_HTTP['per_percorso'].items()
+                       if frammento in percorso for v in voci)
+
+def _scambio_archivio(metodo, url, kwargs):
+    percorso = _percorso_archivio(url)
+    if _ARCHIVIO_HTTP['modalita'] == 'riproduci':
+        return _riproduci_scambio(metodo, url, percorso, kwargs)
+    voce = {
+        'metodo': metodo,
+        'percorso': percorso,
+        'params': _oscura(kwargs.get('params')),
+        'dati': _oscura(kwargs.get('data')),
+    }
+    inizio = time.monotonic()
+    try:
+        risposta = sessione_http(url).request(metodo, url, **kwargs)
+    except Exception as e:
+        voce['errore'] = f"{type(e).__name__}: {e}"
+        risposta = None
+    voce['t'] = round(inizio - _ARCHIVIO_HTTP['inizio'], 4)
+    voce['durata'] = round(time.monotonic() - inizio, 4)
+    if risposta is not None:
+        corpo = risposta.text
+        if percorso.endswith('/oauth2/token') and risposta.ok:
+            corpo = json.dumps(_oscura(risposta.json()))
+        voce.update(stato=risposta.status_code, corpo=corpo,
+                    intestazioni={k: risposta.headers[k] for k in _INTESTAZIONI_ARCHIVIO
+                                  if k in risposta.headers})
+    with _ARCHIVIO_LOCK:
+        _ARCHIVIO_HTTP['file'].write(json.dumps(voce, ensure_ascii=False) + '\n')
+        _ARCHIVIO_HTTP['scambi'] += 1
+    if risposta is None:
+        import requests
+        raise requests.ConnectionError(voce['errore'])
+    return risposta
+
+def _riproduci_scambio(metodo, url, percorso, kwargs):
+    """Risposta registrata per la richiesta: stessi parametri, altrimenti stesso percorso, in ordine."""
+    chiave = _chiave_richiesta(metodo, percorso, kwargs.get('params'))
+    voce = None
+    with _ARCHIVIO_LOCK:
+        for elenco in (_ARCHIVIO_HTTP['per_richiesta'].get(chiave, ()),
+                       _ARCHIVIO_HTTP['per_percorso'].get(chiave[:2], ())):
+            voce = next((v for v in elenco if not v['usata']), None)
+            if voce is not None:
+                voce['usata'] = True
+                break
+        _ARCHIVIO_HTTP['scambi'] += 1
+        if voce is None:
+            _ARCHIVIO_HTTP['sintetiche'] += 1
+    if voce is None:
+        # Token e invii Telegram non cambiano il risultato del ciclo: si risponde "ok"
+        if percorso.endswith('/oauth2/token'):
+            return RispostaRegistrata(url, 200, json.dumps({'access_token': '***', 'expires_in': 1799}))
+        if percorso.endswith('/sendMessage'):
+            return RispostaRegistrata(url, 200, json.dumps({'ok': True, 'result': {}}))
+        raise RichiestaNonRegistrata(f"{metodo} {percorso} non presente nell'archivio")
+    intestazioni = voce.get('intestazioni') or {}
+    if _ARCHIVIO_HTTP['tempi_originali']:
+        time.sleep(voce.get('durata', 0))
+    elif 'Retry-After' in intestazioni:
+        intestazioni = dict(intestazioni, **{'Retry-After': '0'})  # alla massima velocità niente pause
+    if 'errore' in voce:
+        import requests
+        raise requests.ConnectionError(voce['errore'])
+    return RispostaRegistrata(url, voce['stato'], voce['corpo'], intestazioni)
+
+# Lock su file tra processi dello stesso host (fcntl); dove fcntl non c'è non bloccano nulla
+@contextlib.contextmanager
+def blocco_file(percorso, attendi=True):
+    """Lock esclusivo su `percorso`; con attendi=False ritorna False se è già preso."""
+    try:
+        import fcntl
+    except ImportError:
+        yield True
+        return
+    cartella = os.path.dirname(percorso)
+    if cartella:
+        os.makedirs(cartella, exist_ok=True)
+    with open(percorso, 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX if attendi else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            preso = True
+        except BlockingIOError:
+            preso = False
+        yield preso  # chiudere il file rilascia il lock
+
+def scrivi_file_atomico(percorso, testo, permessi=0o644):
+    """Scrive in un file temporaneo accanto a `percorso`, fsync e rename.
+
+    Chi legge trova il file vecchio o quello nuovo, mai uno a metà, anche se
+    il processo muore durante la scrittura.
+    """
+    temporaneo = f"{percorso}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        fd = os.open(temporaneo, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, permessi)
+        with os.fdopen(fd, 'w') as f:
+            f.write(testo)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporaneo, percorso)
+    except BaseException:
+        try:
+            os.unlink(temporaneo)
+        except OSError:
+            pass
+        raise
+    # fsync della cartella: il rename sopravvive anche a un crash del sistema
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(percorso)), os.O_RDONLY)
+    except OSError:
+        return  # es. Windows, dove le cartelle non si aprono
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def apri_sqlite(percorso, sincrono='FULL'):
+    """Connessione SQLite condivisibile tra processi: journal WAL e attesa sui lock."""
+    conn = sqlite3.connect(percorso, timeout=SQLITE_ATTESA_SECONDI, check_same_thread=False)
+    # Con il WAL i lettori non bloccano lo scrittore e un crash a metà commit non perde dati già scritti
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute(f'PRAGMA synchronous={sincrono}')
+    return conn
+
+# Metriche (tempi, chiamate, errori): spente di default, costo quasi nullo se disattivate
+METRICHE_PORTA = int(os.getenv('METRICHE_PORTA', '0'))  # endpoint Prometheus /metrics, 0 = spento
+METRICHE_FILE = os.getenv('METRICHE_FILE', '')  # JSON-lines con un riepilogo per ciclo
+METRICHE_ATTIVE = bool(METRICHE_PORTA or METRICHE_FILE)
+
+_METRICHE_BUCKET = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+_METRICHE_LOCK = threading.Lock()
+_CONTATORI = {}  # (nome, etichette) -> valore
+_ISTOGRAMMI = {}  # (nome, etichette) -> [conteggi per bucket (+Inf in coda), somma, totale]
+
+def conta(nome, valore=1, **etichette):
+    """Incrementa un contatore, es. conta('errori', operazione='token')."""
+    if not METRICHE_ATTIVE:
+        return
+    chiave = (nome, tuple(sorted(etichette.items())))
+    with _METRICHE_LOCK:
+        _CONTATORI[chiave] = _CONTATORI.get(chiave, 0) + valore
+
+def osserva_durata(nome, secondi, **etichette):
+    """Registra una durata nell'istogramma `nome`."""
+    if not METRICHE_ATTIVE:
+        return
+    chiave = (nome, tuple(sorted(etichette.items())))
+    with _METRICHE_LOCK:
+        istogramma = _ISTOGRAMMI.get(chiave)
+        if istogramma is None:
+            istogramma = _ISTOGRAMMI[chiave] = [[0] * (len(_METRICHE_BUCKET) + 1), 0.0, 0]
+        istogramma[0][bisect.bisect_left(_METRICHE_BUCKET, secondi)] += 1
+        istogramma[1] += secondi
+        istogramma[2] += 1
+
+def cronometra(operazione):
+    """Decoratore: durata, chiamate ed eccezioni della funzione.
+
+    Con le metriche spente ritorna la funzione così com'è (nessun costo).
+    """
+    def decoratore(funzione):
+        if not METRICHE_ATTIVE:
+            return funzione
+        
+        @functools.wraps(funzione)
+        def misurata(*args, **kwargs):
+            inizio = time.perf_counter()
+            try:
+                return funzione(*args, **kwargs)
+            except Exception:
+                conta('errori', operazione=operazione)
+                raise
+            finally:
+                conta('chiamate', operazione=operazione)
+                osserva_durata('durata_secondi', time.perf_counter() - inizio, operazione=operazione)
+        return misurata
+    return decoratore
+
+def _nome_metrica(nome, etichette, extra=()):
+    coppie = list(etichette) + list(extra)
+    if not coppie:
+        return nome
+    return nome + '{' + ','.join(f'{k}="{v}"' for k, v in coppie) + '}'
+
+def _quantile_istogramma(conteggi, totale, q):
+    """Stima del quantile q interpolando dentro il bucket che lo contiene."""
+    if not totale:
+        return 0.0
+    obiettivo = q * totale
+    cumulato = 0
+    for i, n in enumerate(conteggi):
+        if n and cumulato + n >= obiettivo:
+            basso = _METRICHE_BUCKET[i - 1] if i > 0 else 0.0
+            alto = _METRICHE_BUCKET[i] if i < len(_METRICHE_BUCKET) else basso * 2
+            return basso + (alto - basso) * (obiettivo - cumulato) / n
+        cumulato += n
+    return _METRICHE_BUCKET[-1]
+
+def istantanea_metriche():
+    """Copia di contatori e istogrammi (None se le metriche sono spente)."""
+    if not METRICHE_ATTIVE:
+        return None
+    with _METRICHE_LOCK:
+        contatori = dict(_CONTATORI)
+        istogrammi = {k: (list(v[0]), v[1], v[2]) for k, v in _ISTOGRAMMI.items()}
+    for esito in ('hit', 'miss'):
+        contatori[('cache', (('esito', esito),))] = _CACHE_STATS[esito]
+    return {'quando': time.time(), 'contatori': contatori, 'istogrammi': istogrammi}
+
+def esporta_prometheus():
+    """Metriche in formato testo Prometheus (0.0.4)."""
+    stato = istantanea_metriche() or {'contatori': {}, 'istogrammi': {}}
+    righe = []
+    tipi = set()
+    for (nome, etichette), valore in sorted(stato['contatori'].items()):
+        metrica = f'flight_monitor_{nome}_total'
+        if metrica not in tipi:
+            tipi.add(metrica)
+            righe.append(f'# TYPE {metrica} counter')
+        righe.append(f'{_nome_metrica(metrica, etichette)} {valore}')
+    for (nome, etichette), (conteggi, somma, totale) in sorted(stato['istogrammi'].items()):
+        metrica = f'flight_monitor_{nome}'
+        if metrica not in tipi:
+            tipi.add(metrica)
+            righe.append(f'# TYPE {metrica} histogram')
+        cumulato = 0
+        for limite, n in zip(_METRICHE_BUCKET + ('+Inf',), conteggi):
+            cumulato += n
+            righe.append(f'{_nome_metrica(metrica + "_bucket", etichette, [("le", limite)])} {cumulato}')
+        righe.append(f'{_nome_metrica(metrica + "_sum", etichette)} {somma:.6f}')
+        righe.append(f'{_nome_metrica(metrica + "_count", etichette)} {totale}')
+    quota = stato_quota_amadeus()
+    righe.append('# TYPE flight_monitor_quota_amadeus gauge')
+    for campo in ('usate', 'usate_oggi', 'budget_oggi'):
+        righe.append(f'flight_monitor_quota_amadeus{{campo="{campo}"}} {quota[campo]}')
+    return '\n'.join(righe) + '\n'
+
+def avvia_server_metriche(porta=None):
+    """Espone /metrics su 127.0.0.1:`porta` in un thread (per Prometheus)."""
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    
+    class Gestore(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            corpo = esporta_prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(corpo)))
+            self.end_headers()
+            self.wfile.write(corpo)
+        
+        def log_message(self, *args):
+            pass
+    
+    server = ThreadingHTTPServer(('127.0.0.1', porta or METRICHE_PORTA), Gestore)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metriche', daemon=True).start()
+    print(f"📊 Metriche Prometheus su http://127.0.0.1:{server.server_address[1]}/metrics")
+    return server
+
+def registra_ciclo_metriche(prima, watch=0):
+    """Riepilogo del ciclo (differenza rispetto a `prima`): stampa e riga in METRICHE_FILE."""
+    if prima is None:
+        return None
+    dopo = istantanea_metriche()
+    contatori = {}
+    for chiave, valore in dopo['contatori'].items():
+        delta = valore - prima['contatori'].get(chiave, 0)
+        if delta:
+            contatori[_nome_metrica(*chiave)] = delta
+    tempi = {}
+    for chiave, (conteggi, somma, totale) in dopo['istogrammi'].items():
+        vecchi, somma_prima, totale_prima = prima['istogrammi'].get(
+            chiave, ([0] * len(conteggi), 0.0, 0))
+        n = totale - totale_prima
+        if not n:
+            continue
+        delta = [a - b for a, b in zip(conteggi, vecchi)]
+        tempi[_nome_metrica(*chiave)] = {
+            'n': n,
+            'media_ms': round((somma - somma_prima) / n * 1000, 1),
+            'p50_ms': round(_quantile_istogramma(delta, n, 0.5) * 1000, 1),
+            'p99_ms': round(_quantile_istogramma(delta, n, 0.99) * 1000, 1),
+        }
+    riepilogo = {
+        'quando': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'durata_s': round(dopo['quando'] - prima['quando'], 3),
+        'watch': watch,
+        'contatori': contatori,
+        'tempi': tempi,
+        'quota': stato_quota_amadeus(),
+    }
+    ricerche = tempi.get(_nome_metrica('durata_secondi', (('operazione', 'amadeus_search_flights'),)))
+    print(f"📊 Ciclo: {riepilogo['durata_s']:.1f}s, "
+          f"{sum(v for k, v in contatori.items() if k.startswith('richieste_amadeus'))} chiamate Amadeus, "
+          f"{sum(v for k, v in contatori.items() if k.startswith('errori'))} errori"
+          + (f", ricerca p50 {ricerche['p50_ms']:.0f}ms" if ricerche else ""))
+    if METRICHE_FILE:
+        try:
+            with open(METRICHE_FILE, 'a') as f:
+                f.write(json.dumps(riepilogo, ensure_ascii=False) + '\n')
+        except OSError as e:
+            print(f"⚠️ Impossibile scrivere le metriche: {e}")
+    return riepilogo
+
+def differenza_metriche(prima):
+    """Contatori e istogrammi accumulati dopo `prima` (per riportarli da un processo worker)."""
+    if prima is None:
+        return None
+    dopo = istantanea_metriche()
+    contatori = {k: v - prima['contatori'].get(k, 0) for k, v in dopo['contatori'].items()
+                 if v != prima['contatori'].get(k, 0)}
+    istogrammi = {}
+    for chiave, (conteggi, somma, totale) in dopo['istogrammi'].items():
+        vecchi, somma_prima, totale_prima = prima['istogrammi'].get(
+            chiave, ([0] * len(conteggi), 0.0, 0))
+        if totale != totale_prima:
+            istogrammi[chiave] = ([a - b for a, b in zip(conteggi, vecchi)],
+                                  somma - somma_prima, totale - totale_prima)
+    return {'contatori': contatori, 'istogrammi': istogrammi}
+
+def unisci_metriche(differenza):
+    """Somma alle metriche di questo processo quelle arrivate da un worker."""
+    if not differenza or not METRICHE_ATTIVE:
+        return
+    with _METRICHE_LOCK:
+        for chiave, valore in differenza['contatori'].items():
+            if chiave[0] != 'cache':  # arrivano a parte, con unisci_statistiche_cache
+                _CONTATORI[chiave] = _CONTATORI.get(chiave, 0) + valore
+        for chiave, (conteggi, somma, totale) in differenza['istogrammi'].items():
+            istogramma = _ISTOGRAMMI.setdefault(chiave, [[0] * (len(_METRICHE_BUCKET) + 1), 0.0, 0])
+            istogramma[0] = [a + b for a, b in zip(istogramma[0], conteggi)]
+            istogramma[1] += somma
+            istogramma[2] += totale
+
+def unisci_statistiche_cache(differenza):
+    """Somma hit/miss della cache di un worker (anche a metriche spente)."""
+    if not differenza:
+        return
+    with _CACHE_LOCK:
+        for esito, valore in differenza.items():
+            _CACHE_STATS[esito] += valore
+
+# Cache su disco delle risposte Amadeus (TTL + LRU)
+CACHE_FILE = os.getenv('CACHE_FILE', 'cache_offerte.sqlite')
+CACHE_TTL_SECONDI = int(os.getenv('CACHE_TTL_SECONDI', '1800'))
+CACHE_MAX_VOCI = int(os.getenv('CACHE_MAX_VOCI', '1000'))
+
+_CACHE_CONN = None
+_CACHE_LOCK = threading.Lock()
+_CACHE_STATS = {'hit': 0, 'miss': 0, 'scritture': 0, 'rimosse': 0}
+_RICERCHE_IN_CORSO = {}  # chiave -> [Lock, ricerche in attesa], per non ripetere la stessa chiamata in parallelo
+
+def _cache_connessione():
+    """Apre (una volta) il database SQLite della cache e crea la tabella."""
+    global _CACHE_CONN
+    if _CACHE_CONN is None:
+        conn = apri_sqlite(CACHE_FILE, sincrono='NORMAL')  # una voce persa in cache non è un problema
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS cache ('
+            ' chiave TEXT PRIMARY KEY,'
+            ' valore TEXT NOT NULL,'
+            ' salvato REAL NOT NULL,'
+            ' scadenza REAL NOT NULL,'
+            ' ultimo_accesso REAL NOT NULL)'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_cache_accesso ON cache (ultimo_accesso)')
+        conn.commit()
+        _CACHE_CONN = conn
+    return _CACHE_CONN
+
+def chiave_cache(*parti):
+    """Chiave stabile per la cache, es. ('offerte', 'FCO', 'MEX', partenza, ritorno, pax)."""
+    return json.dumps([str(p) for p in parti], separators=(',', ':'))
+
+def leggi_cache(chiave):
+    """Ritorna (True, valore) se la chiave è in cache e non scaduta, altrimenti (False, None)."""
+    if CACHE_TTL_SECONDI <= 0:
+        return False, None
+    now = time.time()
+    with _CACHE_LOCK:
+        try:
+            conn = _cache_connessione()
+            riga = conn.execute(
+                'SELECT valore, scadenza FROM cache WHERE chiave = ?', (chiave,)
+            ).fetchone()
+            if riga is None or riga[1] < now:
+                _CACHE_STATS['miss'] += 1
+                return False, None
+            conn.execute('UPDATE cache SET ultimo_accesso = ? WHERE chiave = ?', (now, chiave))
+            conn.commit()
+        except sqlite3.Error as e:
+            print(f"⚠️ Cache non disponibile: {e}")
+            _CACHE_STATS['miss'] += 1
+            return False, None
+        _CACHE_STATS['hit'] += 1
+    return True, json.loads(riga[0])
+
+def leggi_cache_scaduta(chiave):
+    """Ultimo valore salvato anche se scaduto: (valore, salvato_il) oppure None.
+
+    Serve solo come ripiego quando il provider non risponde.
+    """
+    if CACHE_TTL_SECONDI <= 0:
+        return None
+    with _CACHE_LOCK:
+        try:
+            riga = _cache_connessione().execute(
+                'SELECT valore, salvato FROM cache WHERE chiave = ?', (chiave,)
+            ).fetchone()
+        except sqlite3.Error as e:
+            print(f"⚠️ Cache non disponibile: {e}")
+            return None
+    if riga is None:
+        return None
+    return json.loads(riga[0]), riga[1]
+
+def scrivi_cache(chiave, valore, ttl=None):
+    """Salva un valore JSON-serializzabile in cache ed elimina le voci meno usate oltre il limite."""
+    if CACHE_TTL_SECONDI <= 0:
+        return
+    if ttl is None:
+        ttl = CACHE_TTL_SECONDI
+    now = time.time()
+    with _CACHE_LOCK:
+        try:
+            conn = _cache_connessione()
+            conn.execute(
+                'INSERT OR REPLACE INTO cache (chiave, valore, salvato, scadenza, ultimo_accesso) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (chiave, json.dumps(valore), now, now + ttl, now),
+            )
+            cur = conn.execute(
+                'DELETE FROM cache WHERE chiave IN ('
+                ' SELECT chiave FROM cache ORDER BY ultimo_accesso DESC LIMIT -1 OFFSET ?)',
+                (CACHE_MAX_VOCI,),
+            )
+            conn.commit()
+            _CACHE_STATS['scritture'] += 1
+            _CACHE_STATS['rimosse'] += max(cur.rowcount, 0)
+        except sqlite3.Error as e:
+            print(f"⚠️ Impossibile scrivere in cache: {e}")
+
+def statistiche_cache():
+    """Contatori della cache (hit/miss/scritture/rimosse) e percentuale di hit."""
+    stats = dict(_CACHE_STATS)
+    totale = stats['hit'] + stats['miss']
+    stats['hit_rate'] = round(stats['hit'] / totale, 3) if totale else 0.0
+    return stats
+
+# Token OAuth2 Amadeus: condiviso tra thread, salvato su file tra un'esecuzione e l'altra
+AMADEUS_TOKEN_FILE = os.getenv('AMADEUS_TOKEN_FILE', '.amadeus_token.json')
+AMADEUS_TOKEN_MARGINE = int(os.getenv('AMADEUS_TOKEN_MARGINE', '300'))  # rinnovo anticipato (secondi)
 
-# Cache semplice per token Amadeus
 _AMADEUS_TOKEN_CACHE = {
     'token': None,
     'expiry': 0,
 }
+_AMADEUS_TOKEN_LOCK = threading.Lock()
+_RINNOVO_TOKEN_STOP = threading.Event()
+_RINNOVO_TOKEN_THREAD = None
+
+def _id_credenziali_amadeus():
+    """Impronta della API key, per non riusare un token salvato con altre credenziali."""
+    import hashlib
+    return hashlib.sha256((AMADEUS_API_KEY or '').encode()).hexdigest()[:16]
+
+def _token_amadeus_valido(margine=60):
+    return bool(_AMADEUS_TOKEN_CACHE['token']) and time.time() < _AMADEUS_TOKEN_CACHE['expiry'] - margine
+
+def _carica_token_amadeus():
+    """Carica in memoria il token salvato su file (se è delle stesse credenziali)."""
+    if _ARCHIVIO_HTTP['modalita'] == 'riproduci':
+        return  # in riproduzione il token è finto e non tocca quello vero
+    try:
+        with open(AMADEUS_TOKEN_FILE, 'r') as f:
+            salvato = json.load(f)
+    except (OSError, ValueError):
+        return
+    if salvato.get('credenziali') != _id_credenziali_amadeus():
+        return
+    if salvato.get('expiry', 0) > _AMADEUS_TOKEN_CACHE['expiry']:
+        _AMADEUS_TOKEN_CACHE['token'] = salvato.get('token')
+        _AMADEUS_TOKEN_CACHE['expiry'] = float(salvato.get('expiry', 0))
+
+def _salva_token_amadeus():
+    """Salva il token su file leggibile solo dall'utente."""
+    if _ARCHIVIO_HTTP['modalita'] == 'riproduci':
+        return
+    dati = {
+        'credenziali': _id_credenziali_amadeus(),
+        'token': _AMADEUS_TOKEN_CACHE['token'],
+        'expiry': _AMADEUS_TOKEN_CACHE['expiry'],
+    }
+    try:
+        scrivi_file_atomico(AMADEUS_TOKEN_FILE, json.dumps(dati), permessi=0o600)
+    except OSError as e:
+        print(f"⚠️ Impossibile salvare il token Amadeus: {e}")
 
-def amadeus_get_token():
-    """Ottiene e cache un token OAuth2 Amadeus (client_credentials)."""
+def _richiedi_token_amadeus():
+    """Chiede un nuovo token ad Amadeus (chiamare con _AMADEUS_TOKEN_LOCK acquisito)."""
     now = time.time()
-    if _AMADEUS_TOKEN_CACHE['token'] and now < _AMADEUS_TOKEN_CACHE['expiry'] - 60:
-        return _AMADEUS_TOKEN_CACHE['token']
-    url = 'https://test.api.amadeus.com/v1/security/oauth2/token'
+    url = f'{AMADEUS_API_URL}/v1/security/oauth2/token'
     data = {
         'grant_type': 'client_credentials',
         'client_id': AMADEUS_API_KEY,
         'client_secret': AMADEUS_API_SECRET,
     }
-    resp = requests.post(url, data=data, timeout=15)
+    resp = http_post(url, data=data, timeout=15)
     resp.raise_for_status()
     payload = resp.json()
     access_token = payload.get('access_token')
     expires_in = payload.get('expires_in', 1700)
     _AMADEUS_TOKEN_CACHE['token'] = access_token
     _AMADEUS_TOKEN_CACHE['expiry'] = now + int(expires_in)
+    _salva_token_amadeus()
     return access_token
 
-def amadeus_search_flights(partenza, ritorno, passeggeri):
+@cronometra('amadeus_get_token')
+def amadeus_get_token(token_rifiutato=None):
+    """Ottiene e cache un token OAuth2 Amadeus (client_credentials).
+
+    Un solo thread (e un solo processo, col lock sul file) alla volta rinnova
+    il token: gli altri attendono e poi usano quello appena ottenuto. Passare `token_rifiutato` (es. dopo un
+    401) forza il rinnovo solo se nel frattempo nessuno l'ha già sostituito.
+    """
+    if token_rifiutato is None and _token_amadeus_valido():
+        return _AMADEUS_TOKEN_CACHE['token']
+    with _AMADEUS_TOKEN_LOCK, blocco_file(AMADEUS_TOKEN_FILE + '.lock'):
+        if token_rifiutato is not None and _AMADEUS_TOKEN_CACHE['token'] == token_rifiutato:
+            _AMADEUS_TOKEN_CACHE['token'] = None
+            _AMADEUS_TOKEN_CACHE['expiry'] = 0
+        elif _token_amadeus_valido():
+            return _AMADEUS_TOKEN_CACHE['token']
+        else:
+            _carica_token_amadeus()
+            if _token_amadeus_valido():
+                return _AMADEUS_TOKEN_CACHE['token']
+        return _richiedi_token_amadeus()
+
+def _ciclo_rinnovo_token():
+    """Rinnova il token in anticipo (AMADEUS_TOKEN_MARGINE secondi prima della scadenza)."""
+    while not _RINNOVO_TOKEN_STOP.is_set():
+        attesa = _AMADEUS_TOKEN_CACHE['expiry'] - AMADEUS_TOKEN_MARGINE - time.time()
+        if attesa > 0:
+            _RINNOVO_TOKEN_STOP.wait(attesa)
+            continue
+        try:
+            with _AMADEUS_TOKEN_LOCK, blocco_file(AMADEUS_TOKEN_FILE + '.lock'):
+                _carica_token_amadeus()  # magari l'ha già rinnovato un altro processo
+                if not _token_amadeus_valido(AMADEUS_TOKEN_MARGINE):
+                    _richiedi_token_amadeus()
+        except Exception as e:
+            print(f"⚠️ Rinnovo token Amadeus fallito: {e}")
+            _RINNOVO_TOKEN_STOP.wait(30)
+
+def avvia_rinnovo_token():
+    """Avvia (una volta) il thread che rinnova il token Amadeus in background."""
+    global _RINNOVO_TOKEN_THREAD
+    if _RINNOVO_TOKEN_THREAD is not None and _RINNOVO_TOKEN_THREAD.is_alive():
+        return
+    with _AMADEUS_TOKEN_LOCK:
+        _carica_token_amadeus()
+    _RINNOVO_TOKEN_STOP.clear()
+    _RINNOVO_TOKEN_THREAD = threading.Thread(
+        target=_ciclo_rinnovo_token, name='rinnovo-token-amadeus', daemon=True
+    )
+    _RINNOVO_TOKEN_THREAD.start()
+
+def ferma_rinnovo_token():
+    """Ferma il thread di rinnovo del token."""
+    _RINNOVO_TOKEN_STOP.set()
+
+# Offerte per ricerca: quante chiederne ad Amadeus e quante tenerne (le più economiche)
+AMADEUS_MAX_OFFERTE = int(os.getenv('AMADEUS_MAX_OFFERTE', '20'))
+TOP_K_OFFERTE = int(os.getenv('TOP_K_OFFERTE', '5'))
+
+# Preselezione date con Flight Cheapest Date Search: una chiamata copre tutta la finestra
+# flessibile, poi le ricerche complete si fanno solo sulle coppie più economiche
+PRESELEZIONE_DATE = os.getenv('PRESELEZIONE_DATE', 'False').lower() == 'true'
+PRESELEZIONE_CANDIDATI = int(os.getenv('PRESELEZIONE_CANDIDATI', '5'))
+
+# Limite di frequenza e quota mensile Amadeus (free tier), condivisi da tutte le ricerche
+AMADEUS_RICHIESTE_AL_SECONDO = float(os.getenv('AMADEUS_RICHIESTE_AL_SECONDO', '5'))
+AMADEUS_BURST = int(os.getenv('AMADEUS_BURST', '5'))
+AMADEUS_QUOTA_MENSILE = int(os.getenv('AMADEUS_QUOTA_MENSILE', '2000'))  # 0 = nessun limite
+AMADEUS_QUOTA_ANTICIPO_ORE = float(os.getenv('AMADEUS_QUOTA_ANTICIPO_ORE', '6'))
+AMADEUS_QUOTA_FILE = os.getenv('AMADEUS_QUOTA_FILE', 'quota_amadeus.json')
+AMADEUS_MAX_TENTATIVI_429 = int(os.getenv('AMADEUS_MAX_TENTATIVI_429', '3'))
+
+# Provider lento o giù: sospende le chiamate e mostra gli ultimi prezzi in cache
+CIRCUITO_ERRORI = int(os.getenv('CIRCUITO_ERRORI', '5'))
+CIRCUITO_PAUSA_SECONDI = float(os.getenv('CIRCUITO_PAUSA_SECONDI', '120'))
+
+# Priorità in coda (numero più basso = servito prima)
+PRIORITA_IDEALE = 0
+PRIORITA_FLESSIBILE = 1
+PRIORITA_COMANDO = 2
+
+class QuotaAmadeusEsaurita(RuntimeError):
+    """Budget di chiamate Amadeus esaurito per oggi/questo mese."""
+
+_LIMITATORE = {
+    'gettoni': float(AMADEUS_BURST),
+    'aggiornato': time.monotonic(),
+    'pausa_fino': 0.0,  # impostato da un 429 con Retry-After
+}
+_LIMITATORE_COND = threading.Condition()
+_LIMITATORE_CODA = []  # heap di (priorita, progressivo)
+_LIMITATORE_PROGRESSIVO = itertools.count()
+
+_QUOTA = {'caricata': False, 'mese': None, 'usate': 0,
+          'giorno': None, 'usate_oggi': 0, 'budget_oggi': 0}
+_QUOTA_LOCK = threading.Lock()
+
+def _ricarica_gettoni(now):
+    trascorso = now - _LIMITATORE['aggiornato']
+    _LIMITATORE['aggiornato'] = now
+    _LIMITATORE['gettoni'] = min(float(AMADEUS_BURST),
+                                 _LIMITATORE['gettoni'] + trascorso * AMADEUS_RICHIESTE_AL_SECONDO)
+
+def attendi_slot_amadeus(priorita=PRIORITA_FLESSIBILE):
+    """Token bucket con coda a priorità: blocca finché la richiesta può partire."""
+    biglietto = (priorita, next(_LIMITATORE_PROGRESSIVO))
+    with _LIMITATORE_COND:
+        heapq.heappush(_LIMITATORE_CODA, biglietto)
+        try:
+            while True:
+                now = time.monotonic()
+                _ricarica_gettoni(now)
+                attesa = None
+                if now < _LIMITATORE['pausa_fino']:
+                    attesa = _LIMITATORE['pausa_fino'] - now
+                elif _LIMITATORE['gettoni'] < 1:
+                    attesa = (1 - _LIMITATORE['gettoni']) / AMADEUS_RICHIESTE_AL_SECONDO
+                elif _LIMITATORE_CODA[0] == biglietto:
+                    _LIMITATORE['gettoni'] -= 1
+                    return
+                _LIMITATORE_COND.wait(attesa)
+        finally:
+            _LIMITATORE_CODA.remove(biglietto)
+            heapq.heapify(_LIMITATORE_CODA)
+            _LIMITATORE_COND.notify_all()
+
+def sospendi_richieste_amadeus(secondi):
+    """Blocca tutte le richieste Amadeus per `secondi` (es. dopo un 429)."""
+    with _LIMITATORE_COND:
+        _LIMITATORE['pausa_fino'] = max(_LIMITATORE['pausa_fino'], time.monotonic() + secondi)
+        _LIMITATORE_COND.notify_all()
+
+def _secondi_retry_after(valore, predefinito=2.0):
+    """Interpreta l'header Retry-After (secondi o data HTTP)."""
+    if not valore:
+        return predefinito
+    try:
+        return max(0.0, float(valore))
+    except ValueError:
+        pass
+    from email.utils import parsedate_to_datetime
+    try:
+        return max(0.0, parsedate_to_datetime(valore).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return predefinito
+
+def _salva_quota():
+    dati = {k: _QUOTA[k] for k in ('mese', 'usate', 'giorno', 'usate_oggi', 'budget_oggi')}
+    try:
+        scrivi_file_atomico(AMADEUS_QUOTA_FILE, json.dumps(dati))
+    except OSError as e:
+        print(f"⚠️ Impossibile salvare la quota Amadeus: {e}")
+
+def _aggiorna_periodo_quota(adesso):
+    """Azzera i contatori a inizio mese/giorno e ricalcola il budget di oggi."""
+    if not _QUOTA['caricata']:
+        try:
+            with open(AMADEUS_QUOTA_FILE, 'r') as f:
+                _QUOTA.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+        _QUOTA['caricata'] = True
+    mese = adesso.strftime('%Y-%m')
+    giorno = adesso.strftime('%Y-%m-%d')
+    if _QUOTA['mese'] != mese:
+        _QUOTA.update(mese=mese, usate=0, giorno=None)
+    if _QUOTA['giorno'] != giorno:
+        inizio_prossimo_mese = (adesso.replace(day=28) + timedelta(days=4)).replace(day=1)
+        giorni_rimasti = (inizio_prossimo_mese.date() - adesso.date()).days
+        rimanenti = max(0, AMADEUS_QUOTA_MENSILE - _QUOTA['usate'])
+        _QUOTA.update(giorno=giorno, usate_oggi=0,
+                      budget_oggi=-(-rimanenti // max(1, giorni_rimasti)))
+
+def consuma_quota_amadeus():
+    """Scala una chiamata dal budget; solleva QuotaAmadeusEsaurita se non disponibile.
+
+    Il budget mensile rimanente è diviso sui giorni che mancano a fine mese e,
+    dentro la giornata, reso disponibile in proporzione alle ore trascorse
+    (più AMADEUS_QUOTA_ANTICIPO_ORE di anticipo).
+    """
+    if AMADEUS_QUOTA_MENSILE <= 0:
+        return
+    adesso = datetime.now()
+    with _QUOTA_LOCK, blocco_file(AMADEUS_QUOTA_FILE + '.lock'):
+        _QUOTA['caricata'] = False  # rilegge il file: altri processi possono aver consumato
+        _aggiorna_periodo_quota(adesso)
+        ore = adesso.hour + adesso.minute / 60 + AMADEUS_QUOTA_ANTICIPO_ORE
+        consentite = -(-_QUOTA['budget_oggi'] * min(24.0, ore) // 24)
+        if _QUOTA['usate'] >= AMADEUS_QUOTA_MENSILE:
+            raise QuotaAmadeusEsaurita('Quota mensile Amadeus esaurita')
+        if _QUOTA['usate_oggi'] >= consentite:
+            raise QuotaAmadeusEsaurita(
+                f"Budget Amadeus per ora esaurito ({_QUOTA['usate_oggi']}/{_QUOTA['budget_oggi']} oggi)"
+            )
+        _QUOTA['usate'] += 1
+        _QUOTA['usate_oggi'] += 1
+        _salva_quota()
+
+def restituisci_quota_amadeus():
+    """Restituisce una chiamata al budget (richiesta rifiutata con 429, non conteggiata)."""
+    if AMADEUS_QUOTA_MENSILE <= 0:
+        return
+    with _QUOTA_LOCK, blocco_file(AMADEUS_QUOTA_FILE + '.lock'):
+        _QUOTA['caricata'] = False
+        _aggiorna_periodo_quota(datetime.now())
+        _QUOTA['usate'] = max(0, _QUOTA['usate'] - 1)
+        _QUOTA['usate_oggi'] = max(0, _QUOTA['usate_oggi'] - 1)
+        _salva_quota()
+
+def stato_quota_amadeus():
+    """Chiamate usate nel mese/oggi e budget di oggi."""
+    with _QUOTA_LOCK:
+        _aggiorna_periodo_quota(datetime.now())
+        return {k: _QUOTA[k] for k in ('mese', 'usate', 'usate_oggi', 'budget_oggi')}
+
+# Circuit breaker per provider: dopo CIRCUITO_ERRORI errori di fila le chiamate
+# falliscono subito per CIRCUITO_PAUSA_SECONDI, poi passa una richiesta di prova
+class CircuitoAperto(RuntimeError):
+    """Provider considerato non disponibile: chiamata non eseguita."""
+
+_CIRCUITI = {}  # provider -> {'stato', 'errori', 'aperto_il', 'prova_in_corso'}
+_CIRCUITI_LOCK = threading.Lock()
+
+def _circuito(provider):
+    return _CIRCUITI.setdefault(provider, {
+        'stato': 'chiuso', 'errori': 0, 'aperto_il': 0.0, 'prova_in_corso': False,
+    })
+
+def circuito_permette(provider):
+    """True se si può chiamare il provider (circuito chiuso o richiesta di prova)."""
+    with _CIRCUITI_LOCK:
+        circuito = _circuito(provider)
+        if circuito['stato'] == 'chiuso':
+            return True
+        if circuito['stato'] == 'aperto' and time.monotonic() - circuito['aperto_il'] >= CIRCUITO_PAUSA_SECONDI:
+            circuito['stato'] = 'semiaperto'
+        if circuito['stato'] == 'semiaperto' and not circuito['prova_in_corso']:
+            circuito['prova_in_corso'] = True
+            print(f"🔌 {provider}: richiesta di prova dopo l'interruzione")
+            return True
+        return False
+
+def registra_successo_circuito(provider):
+    with _CIRCUITI_LOCK:
+        circuito = _circuito(provider)
+        if circuito['stato'] != 'chiuso':
+            print(f"✅ {provider} di nuovo raggiungibile")
+        circuito.update(stato='chiuso', errori=0, prova_in_corso=False)
+
+def annulla_prova_circuito(provider):
+    """Libera la richiesta di prova concessa ma mai inviata (es. quota esaurita)."""
+    with _CIRCUITI_LOCK:
+        _circuito(provider)['prova_in_corso'] = False
+
+def registra_errore_circuito(provider):
+    with _CIRCUITI_LOCK:
+        circuito = _circuito(provider)
+        circuito['errori'] += 1
+        if circuito['stato'] == 'semiaperto' or (
+                circuito['stato'] == 'chiuso' and circuito['errori'] >= CIRCUITO_ERRORI):
+            if circuito['stato'] == 'chiuso':
+                print(f"🚫 {provider}: {circuito['errori']} errori di fila, chiamate sospese "
+                      f"per {CIRCUITO_PAUSA_SECONDI:g}s")
+            conta('circuito_aperto', provider=provider)
+            circuito.update(stato='aperto', aperto_il=time.monotonic(), prova_in_corso=False)
+
+def stato_circuiti():
+    """{provider: stato} ('chiuso', 'aperto' o 'semiaperto')."""
+    with _CIRCUITI_LOCK:
+        return {provider: c['stato'] for provider, c in _CIRCUITI.items()}
+
+def amadeus_get(url, params, priorita=PRIORITA_FLESSIBILE, timeout=20):
+    """GET autenticata verso Amadeus rispettando limite di frequenza, quota e Retry-After.
+
+    Errori di rete e 5xx contano per il circuit breaker: a circuito aperto
+    solleva subito CircuitoAperto, senza attendere il timeout.
+    """
+    if not circuito_permette('amadeus'):
+        raise CircuitoAperto('Amadeus non disponibile, chiamate sospese. Riprova più tardi.')
+    try:
+        consuma_quota_amadeus()
+    except Exception:
+        annulla_prova_circuito('amadeus')
+        raise
+    endpoint = url.rsplit('/', 1)[-1]
+    for tentativo in range(AMADEUS_MAX_TENTATIVI_429 + 1):
+        attendi_slot_amadeus(priorita)
+        try:
+            token = amadeus_get_token()
+            headers = {
+                'Authorization': f'Bearer {token}',
+            }
+            conta('richieste_amadeus', endpoint=endpoint)
+            resp = http_get(url, params=params, headers=headers, timeout=timeout)
+            if resp.status_code == 401:
+                # Token revocato o scaduto lato server: rinnova una volta e riprova,
+                # passando di nuovo da limitatore e quota (è un'altra chiamata fatturata)
+                conta('token_rifiutati')
+                token = amadeus_get_token(token_rifiutato=token)
+                headers['Authorization'] = f'Bearer {token}'
+                attendi_slot_amadeus(priorita)
+                consuma_quota_amadeus()
+                conta('richieste_amadeus', endpoint=endpoint)
+                resp = http_get(url, params=params, headers=headers, timeout=timeout)
+        except QuotaAmadeusEsaurita:
+            annulla_prova_circuito('amadeus')
+            raise
+        except Exception:
+            registra_errore_circuito('amadeus')
+            raise
+        if resp.status_code >= 500:
+            registra_errore_circuito('amadeus')
+            return resp
+        registra_successo_circuito('amadeus')
+        if resp.status_code != 429:
+            return resp
+        conta('risposte_429', endpoint=endpoint)
+        attesa = _secondi_retry_after(resp.headers.get('Retry-After'), 2.0 * (2 ** tentativo))
+        print(f"   ⏳ Rate limit Amadeus: nuovo tentativo tra {attesa:.1f}s")
+        sospendi_richieste_amadeus(attesa)
+    restituisci_quota_amadeus()
+    raise RuntimeError('Rate limit Amadeus superato (free tier). Riprova più tardi.')
+
+@contextlib.contextmanager
+def _ricerca_esclusiva(chiave):
+    """Una sola ricerca alla volta per chiave; la voce sparisce quando nessuno la usa più."""
+    with _CACHE_LOCK:
+        voce = _RICERCHE_IN_CORSO.setdefault(chiave, [threading.Lock(), 0])
+        voce[1] += 1
+    try:
+        with voce[0]:
+            yield
+    finally:
+        with _CACHE_LOCK:
+            voce[1] -= 1
+            if not voce[1]:
+                del _RICERCHE_IN_CORSO[chiave]
+
+@cronometra('amadeus_search_flights')
+def amadeus_search_flights(partenza, ritorno, passeggeri, priorita=PRIORITA_FLESSIBILE,
+                           origine=None, destinazione=None):
+    """Miglior offerta Amadeus per rotta e date, letta prima dalla cache su disco.
+
+    Se Amadeus non risponde (o il circuito è aperto) ritorna l'ultima offerta
+    in cache anche se scaduta, con 'stale': True e 'aggiornato_il'.
+    """
+    origine = origine or ORIGINE
+    destinazione = destinazione or DESTINAZIONE
+    chiave = chiave_cache('offerte', origine, destinazione, partenza, ritorno, passeggeri)
+    with _ricerca_esclusiva(chiave):
+        trovato, offerta = leggi_cache(chiave)
+        if trovato:
+            if offerta:
+                offerta['offerte'] = [OffertaVolo.da_lista(o) for o in offerta.get('offerte', [])]
+                offerta['da_cache'] = True
+            return offerta
+        import requests
+        try:
+            offerta = _amadeus_search_flights_api(partenza, ritorno, passeggeri, priorita,
+                                                  origine, destinazione)
+        except (CircuitoAperto, requests.RequestException):
+            scaduta = leggi_cache_scaduta(chiave)
+            if not scaduta or not scaduta[0]:
+                raise
+            offerta, salvato = scaduta
+            conta('risposte_stale')
+            offerta['offerte'] = [OffertaVolo.da_lista(o) for o in offerta.get('offerte', [])]
+            offerta.update(da_cache=True, stale=True,
+                           aggiornato_il=datetime.fromtimestamp(salvato).strftime('%d/%m %H:%M'))
+            return offerta
+        # Anche "nessuna offerta" (None) viene messa in cache: evita chiamate ripetute
+        if offerta:
+            scrivi_cache(chiave, dict(offerta, offerte=[o.come_lista() for o in offerta['offerte']]))
+        else:
+            scrivi_cache(chiave, None)
+        return offerta
+
+def _amadeus_search_flights_api(partenza, ritorno, passeggeri, priorita, origine, destinazione):
     """Chiama Flight Offers Search v2 su ambiente test (gratuito). Ritorna miglior prezzo e link sito."""
-    token = amadeus_get_token()
-    url = 'https://test.api.amadeus.com/v2/shopping/flight-offers'
+    url = f'{AMADEUS_API_URL}/v2/shopping/flight-offers'
     params = {
-        'originLocationCode': 'FCO',
-        'destinationLocationCode': 'MEX',
+        'originLocationCode': origine,
+        'destinationLocationCode': destinazione,
         'departureDate': partenza,
         'returnDate': ritorno,
         'adults': passeggeri,
         'currencyCode': 'EUR',
         'nonStop': 'true',
-        'max': 20,
-    }
-    headers = {
-        'Authorization': f'Bearer {token}',
+        'max': AMADEUS_MAX_OFFERTE,
     }
-    resp = requests.get(url, params=params, headers=headers, timeout=20)
-    if resp.status_code == 429:
-        raise RuntimeError('Rate limit Amadeus superato (free tier). Riprova più tardi.')
+    resp = amadeus_get(url, params, priorita)
     resp.raise_for_status()
-    payload = resp.json()
-    data = payload.get('data', [])
-    if not data:
+    offerte = estrai_offerte_migliori(resp.json().get('data') or [], TOP_K_OFFERTE)
+    if not offerte:
         return None
-    # Ordina per prezzo totale
-    def price_of(offer):
-        try:
-            return float(offer['price']['grandTotal'])
-        except Exception:
-            return 1e9
-    data.sort(key=price_of)
-    offer = data[0]
-    prezzo = price_of(offer)
     # Amadeus non fornisce deep-link. Generiamo un link utile (Google Flights) per stesse date.
-    link = genera_link_offerta('Google Flights', partenza, ritorno, passeggeri)
+    link = genera_link_offerta('Google Flights', partenza, ritorno, passeggeri, origine, destinazione)
     return {
-        'prezzo': int(round(prezzo)),
+        'prezzo': int(round(offerte[0].prezzo)),
         'sito': 'Amadeus',
         'link': link,
+        'offerte': offerte,
+        'ottenuta_il': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),  # = osservato_il nello storico
     }
 
+def amadeus_cerca_date_economiche(origine, destinazione, partenza_da, partenza_a,
+                                  durata_min, durata_max, priorita=PRIORITA_FLESSIBILE):
+    """Prezzi indicativi per tutte le coppie di date di una finestra (Flight Cheapest Date Search).
+
+    Ritorna {(partenza, ritorno): prezzo}. I prezzi vengono dalla cache di
+    Amadeus e servono solo a scegliere quali date cercare per davvero.
+    """
+    chiave = chiave_cache('date', origine, destinazione, partenza_da, partenza_a, durata_min, durata_max)
+    trovato, valore = leggi_cache(chiave)
+    if trovato:
+        return {tuple(k.split('|')): v for k, v in valore.items()}
+    url = f'{AMADEUS_API_URL}/v1/shopping/flight-dates'
+    params = {
+        'origin': origine,
+        'destination': destinazione,
+        'departureDate': f"{partenza_da},{partenza_a}",
+        'duration': f"{durata_min},{durata_max}",
+        'oneWay': 'false',
+        'nonStop': 'true',
+        'viewBy': 'DATE',
+    }
+    resp = amadeus_get(url, params, priorita)
+    resp.raise_for_status()
+    prezzi = {}
+    for voce in resp.json().get('data') or []:
+        try:
+            coppia = (voce['departureDate'], voce['returnDate'])
+            prezzo = float(voce['price']['total'])
+        except (KeyError, TypeError, ValueError):
+            continue
+        if coppia not in prezzi or prezzo < prezzi[coppia]:
+            prezzi[coppia] = prezzo
+    scrivi_cache(chiave, {'|'.join(k): v for k, v in prezzi.items()})
+    return prezzi
+
+class OffertaVolo:
+    """Offerta Amadeus ridotta ai campi che usiamo (prezzo, compagnia, voli, posti, tariffa)."""
+    
+    __slots__ = ('prezzo', 'compagnia', 'voli_andata', 'voli_ritorno',
+                 'posti', 'orari', 'tariffa', 'bagagli')
+    
+    def __init__(self, prezzo, compagnia, voli_andata, voli_ritorno,
+                 posti=None, orari=(), tariffa=None, bagagli=None):
+        self.prezzo = prezzo
+        self.compagnia = compagnia
+        self.voli_andata = voli_andata
+        self.voli_ritorno = voli_ritorno
+        self.posti = posti  # numberOfBookableSeats
+        self.orari = orari  # partenza del primo volo di andata e di ritorno
+        self.tariffa = tariffa  # cabina e tariffa (brandedFare o fareBasis)
+        self.bagagli = bagagli  # bagagli in stiva inclusi
+    
+    @classmethod
+    def da_amadeus(cls, prezzo, offer):
+        """Costruisce il record dal dict di una flight-offer (solo per le offerte tenute)."""
+        voli = []
+        orari = []
+        for itinerario in offer.get('itineraries') or ():
+            segmenti = itinerario.get('segments') or ()
+            voli.append(tuple(f"{seg.get('carrierCode', '')}{seg.get('number', '')}" for seg in segmenti))
+            if segmenti:
+                orari.append((segmenti[0].get('departure') or {}).get('at'))
+        compagnie = offer.get('validatingAirlineCodes') or ()
+        tariffa = bagagli = None
+        prezzi_viaggiatori = offer.get('travelerPricings') or ()
+        dettagli = (prezzi_viaggiatori[0].get('fareDetailsBySegment') or ()) if prezzi_viaggiatori else ()
+        if dettagli:
+            dettaglio = dettagli[0]
+            tariffa = ' '.join(x for x in (dettaglio.get('cabin'),
+                                           dettaglio.get('brandedFare') or dettaglio.get('fareBasis')) if x) or None
+            bagagli = (dettaglio.get('includedCheckedBags') or {}).get('quantity')
+        return cls(
+            prezzo,
+            compagnie[0] if compagnie else None,
+            voli[0] if voli else (),
+            voli[1] if len(voli) > 1 else (),
+            offer.get('numberOfBookableSeats'),
+            tuple(orari),
+            tariffa,
+            bagagli,
+        )
+    
+    def come_lista(self):
+        """Forma JSON-serializzabile (per cache e istantanee)."""
+        return [self.prezzo, self.compagnia, list(self.voli_andata), list(self.voli_ritorno),
+                self.posti, list(self.orari), self.tariffa, self.bagagli]
+    
+    @classmethod
+    def da_lista(cls, valori):
+        # Le voci in cache salvate prima di posti/orari/tariffa hanno solo i primi 4 campi
+        prezzo, compagnia, andata, ritorno, posti, orari, tariffa, bagagli = (
+            list(valori) + [None, (), None, None])[:8]
+        return cls(prezzo, compagnia, tuple(andata), tuple(ritorno), posti, tuple(orari), tariffa, bagagli)
+    
+    def impronta(self):
+        """Hash del contenuto: cambia se cambia prezzo, volo, orario, tariffa o posti."""
+        import hashlib
+        testo = json.dumps(self.come_lista(), separators=(',', ':'))
+        return hashlib.blake2b(testo.encode('utf-8'), digest_size=8).hexdigest()
+    
+    def descrizione(self):
+        """Riga per gli avvisi, es. 'AM19 / AM20 · ECONOMY BASIC · 1 bagagli · 3 posti'."""
+        parti = [' / '.join(' '.join(v) for v in (self.voli_andata, self.voli_ritorno) if v)]
+        if self.tariffa:
+            parti.append(self.tariffa)
+        if self.bagagli is not None:
+            parti.append(f"{self.bagagli} bagagli")
+        if self.posti:
+            parti.append(f"{self.posti} posti")
+        return ' · '.join(p for p in parti if p)
+    
+    def __repr__(self):
+        return (f"OffertaVolo(€{self.prezzo}, {self.compagnia}, {self.voli_andata}, {self.voli_ritorno}, "
+                f"posti={self.posti}, tariffa={self.tariffa!r})")
+
+def estrai_offerte_migliori(data, k):
+    """Le k offerte più economiche di `data`, senza ordinare né convertire tutta la lista.
+
+    Si legge solo price.grandTotal di ogni offerta; gli itinerari vengono
+    estratti solo per le k vincitrici (heap di dimensione k).
+    """
+    def prezzi():
+        for i, offer in enumerate(data):
+            try:
+                yield float(offer['price']['grandTotal']), i
+            except (KeyError, TypeError, ValueError):
+                continue
+    migliori = heapq.nsmallest(max(1, k), prezzi())
+    return [OffertaVolo.da_amadeus(prezzo, data[i]) for prezzo, i in migliori]
+
 def controlla_configurazione():
     """Controlla che tutte le configurazioni necessarie siano presenti"""
     
@@ -148,120 +1392,587 @@ def controlla_configurazione():
     
     return True
 
-def genera_date_flessibili():
-    """Genera combinazioni realistiche per voli diretti Aeromexico"""
+def watch_predefinito():
+    """Watch costruito dalle variabili d'ambiente (la rotta storica FCO→MEX)."""
+    return {
+        'nome': f"{ORIGINE}-{DESTINAZIONE}",
+        'descrizione': 'Aeromexico DIRETTO',
+        'origine': ORIGINE,
+        'destinazione': DESTINAZIONE,
+        'partenza': PARTENZA,
+        'ritorno': RITORNO,
+        'passeggeri': NUMERO_PASSEGGERI,
+        'flessibilita_giorni': FLESSIBILITA_GIORNI,
+        'min_durata': MIN_DURATA_VIAGGIO,
+        'max_durata': MAX_DURATA_VIAGGIO,
+        'durata_ideale': DURATA_IDEALE,
+        'giorni_operativi': GIORNI_OPERATIVI,
+        'giorni_operativi_ritorno': GIORNI_OPERATIVI_RITORNO,
+        'prezzo_soglia': PREZZO_SOGLIA,
+        'prezzo_buono': PREZZO_BUONO,
+        'prezzo_attuale': PREZZO_ATTUALE,
+        'sempre_notifica_sotto': SEMPRE_NOTIFICA_SOTTO,
+        'min_calo': MIN_CALO_PER_NOTIFICA,
+    }
+
+def carica_watchlist(percorso=None):
+    """Legge la watchlist JSON (lista di watch o {"watches": [...]}).
+
+    Ogni watch eredita i campi mancanti da watch_predefinito(); servono
+    almeno origine, destinazione, partenza e ritorno. Senza file si
+    controlla solo la rotta configurata nel .env.
+    """
+    percorso = percorso or WATCHLIST_FILE
+    if not os.path.exists(percorso):
+        return [watch_predefinito()]
+    with open(percorso, 'r') as f:
+        dati = json.load(f)
+    if isinstance(dati, dict):
+        dati = dati.get('watches', [])
+    watches = []
+    nomi = set()
+    for i, voce in enumerate(dati):
+        mancanti = [k for k in ('origine', 'destinazione', 'partenza', 'ritorno') if not voce.get(k)]
+        if mancanti:
+            raise ValueError(f"Watch #{i+1} in {percorso}: mancano {', '.join(mancanti)}")
+        watch = watch_predefinito()
+        watch['descrizione'] = 'DIRETTO'
+        watch.update(voce)
+        watch['origine'] = watch['origine'].upper()
+        watch['destinazione'] = watch['destinazione'].upper()
+        if 'nome' not in voce:
+            watch['nome'] = f"{watch['origine']}-{watch['destinazione']} {watch['partenza']}"
+        if watch['nome'] in nomi:
+            raise ValueError(f"Watch duplicato in {percorso}: {watch['nome']}")
+        nomi.add(watch['nome'])
+        watches.append(watch)
+    return watches
+
+# Date realistiche partenze Aeromexico (circa 2-3 volte a settimana)
+GIORNI_VOLI_DIRETTI = (-7, -4, -3, 0, 3, 4, 7)  # Pattern realistico
+
+_NOMI_GIORNI = {
+    'lun': 0, 'mar': 1, 'mer': 2, 'gio': 3, 'ven': 4, 'sab': 5, 'dom': 6,
+    'mon': 0, 'tue': 1, 'wed': 2, 'thu': 3, 'fri': 4, 'sat': 5, 'sun': 6,
+}
+
+def _maschera_giorni(valore):
+    """"lun,gio,sab" / [0, 3, 5] -> maschera lun..dom per numpy, None se non impostata."""
+    if not valore:
+        return None
+    if isinstance(valore, str):
+        valore = [v.strip().lower() for v in valore.split(',') if v.strip()]
+    maschera = [0] * 7
+    for giorno in valore:
+        indice = giorno if isinstance(giorno, int) else _NOMI_GIORNI.get(str(giorno)[:3])
+        if indice is None or not 0 <= indice <= 6:
+            raise ValueError(f"Giorno della settimana non valido: {giorno!r}")
+        maschera[indice] = 1
+    return maschera
+
+class GrigliaDate:
+    """Combinazioni partenza/ritorno valide di un watch, come array NumPy.
+
+    `partenze`/`ritorni` sono datetime64[D], `durate` e gli scarti dalle date
+    base sono int; l'ordine è quello di generazione (partenza, poi ritorno).
+    """
     
-    data_partenza_base = datetime.strptime(PARTENZA, "%Y-%m-%d")
-    data_ritorno_base = datetime.strptime(RITORNO, "%Y-%m-%d")
+    __slots__ = ('partenze', 'ritorni', 'durate', 'diff_partenza', 'diff_ritorno', 'durata_ideale')
     
-    # Date realistiche partenze Aeromexico (circa 2-3 volte a settimana)
-    giorni_voli_diretti = [-7, -4, -3, 0, 3, 4, 7]  # Pattern realistico
+    def __init__(self, partenze, ritorni, durate, diff_partenza, diff_ritorno, durata_ideale):
+        self.partenze = partenze
+        self.ritorni = ritorni
+        self.durate = durate
+        self.diff_partenza = diff_partenza
+        self.diff_ritorno = diff_ritorno
+        self.durata_ideale = durata_ideale
     
-    combinazioni_date = []
+    def __len__(self):
+        return len(self.durate)
     
-    for giorni_partenza in giorni_voli_diretti:
-        if abs(giorni_partenza) <= FLESSIBILITA_GIORNI:
-            
-            nuova_partenza = data_partenza_base + timedelta(days=giorni_partenza)
-            
-            # Per ogni partenza, controlla ritorni compatibili
-            for giorni_ritorno in giorni_voli_diretti:
-                if abs(giorni_ritorno) <= FLESSIBILITA_GIORNI:
-                    
-                    nuovo_ritorno = data_ritorno_base + timedelta(days=giorni_ritorno)
-                    
-                    # Calcola durata viaggio
-                    durata = (nuovo_ritorno - nuova_partenza).days
-                    
-                    # Controlla vincoli di durata (25-35 giorni)
-                    if MIN_DURATA_VIAGGIO <= durata <= MAX_DURATA_VIAGGIO:
-                        combinazioni_date.append({
-                            'partenza': nuova_partenza.strftime("%Y-%m-%d"),
-                            'ritorno': nuovo_ritorno.strftime("%Y-%m-%d"),
-                            'durata': durata,
-                            'giorni_diff_partenza': giorni_partenza,
-                            'giorni_diff_ritorno': giorni_ritorno
-                        })
-    
-    # Ordina per durata ottimale (più vicina a 28 giorni)
-    combinazioni_date.sort(key=lambda x: abs(x['durata'] - 28))
-    
-    print(f"📊 Generate {len(combinazioni_date)} combinazioni realistiche per voli diretti")
+    def _combinazione(self, i):
+        return {
+            'partenza': str(self.partenze[i]),
+            'ritorno': str(self.ritorni[i]),
+            'durata': int(self.durate[i]),
+            'giorni_diff_partenza': int(self.diff_partenza[i]),
+            'giorni_diff_ritorno': int(self.diff_ritorno[i]),
+        }
+    
+    def migliori(self, n=None):
+        """Itera le combinazioni dalla durata più vicina a quella ideale (al massimo n).
+
+        Con n piccolo su griglie grandi si ordina solo la parte che serve
+        (argpartition) e i dict vengono creati uno alla volta.
+        """
+        np = _numpy()
+        distanza = np.abs(self.durate - self.durata_ideale)
+        if n is not None and n < len(distanza):
+            if n <= 0:
+                return
+            # Tutti gli elementi a distanza <= soglia, poi ordinamento stabile solo su quelli
+            soglia = np.partition(distanza, n - 1)[n - 1]
+            candidati = np.flatnonzero(distanza <= soglia)
+            ordine = candidati[np.argsort(distanza[candidati], kind='stable')][:n]
+        else:
+            ordine = np.argsort(distanza, kind='stable')
+        for i in ordine:
+            yield self._combinazione(i)
+
+def _numpy():
+    import numpy
+    return numpy
+
+def griglia_date(watch=None):
+    """Griglia vettoriale di tutte le coppie di date valide per il watch.
+
+    Senza giorni_operativi si usano gli offset fissi GIORNI_VOLI_DIRETTI (o
+    'offset_giorni' del watch) entro ±flessibilita_giorni; con i giorni
+    operativi si considera ogni giorno della finestra che cade in quei giorni.
+    Le coppie sono filtrate per min_durata..max_durata.
+    """
+    np = _numpy()
+    if watch is None:
+        watch = watch_predefinito()
+    flessibilita = int(watch['flessibilita_giorni'])
+    base_partenza = np.datetime64(watch['partenza'], 'D')
+    base_ritorno = np.datetime64(watch['ritorno'], 'D')
+    
+    offset_fissi = np.array(watch.get('offset_giorni') or GIORNI_VOLI_DIRETTI, dtype=np.int64)
+    offset_fissi = offset_fissi[np.abs(offset_fissi) <= flessibilita]
+    finestra = np.arange(-flessibilita, flessibilita + 1, dtype=np.int64)
+    
+    def offset_validi(base, maschera):
+        if maschera is None:
+            return offset_fissi
+        return finestra[np.is_busday(base + finestra, weekmask=maschera)]
+    
+    maschera_andata = _maschera_giorni(watch.get('giorni_operativi'))
+    maschera_ritorno = _maschera_giorni(watch.get('giorni_operativi_ritorno')) or maschera_andata
+    diff_p = offset_validi(base_partenza, maschera_andata)
+    diff_r = offset_validi(base_ritorno, maschera_ritorno)
+    
+    # Tutte le coppie (partenza, ritorno) come matrice, poi filtro sulla durata
+    durate = (base_ritorno - base_partenza).astype(np.int64) + diff_r[None, :] - diff_p[:, None]
+    righe, colonne = np.nonzero((durate >= watch['min_durata']) & (durate <= watch['max_durata']))
+    return GrigliaDate(
+        base_partenza + diff_p[righe],
+        base_ritorno + diff_r[colonne],
+        durate[righe, colonne],
+        diff_p[righe],
+        diff_r[colonne],
+        int(watch.get('durata_ideale', DURATA_IDEALE)),
+    )
+
+def genera_date_flessibili(watch=None, limite=None):
+    """Genera combinazioni realistiche per voli diretti Aeromexico"""
+    
+    if watch is None:
+        watch = watch_predefinito()
+    griglia = griglia_date(watch)
+    
+    # Ordina per durata ottimale (più vicina alla durata ideale)
+    combinazioni_date = list(griglia.migliori(limite))
+    
+    print(f"📊 {watch['nome']}: generate {len(griglia)} combinazioni realistiche per voli diretti")
     return combinazioni_date
 
-def controlla_prezzi():
+def preseleziona_combinazioni(watch, combinazioni):
+    """Sceglie le PRESELEZIONE_CANDIDATI coppie di date più economiche tra `combinazioni`.
+
+    Usa la griglia di prezzi indicativi di Amadeus sulla finestra
+    ±flessibilita_giorni, tenendo solo le coppie presenti in `combinazioni`
+    (la griglia di griglia_date: durate, giorni operativi e offset del watch).
+    Se la griglia non è disponibile o è vuota si tengono tutte le combinazioni.
+    """
+    if not PRESELEZIONE_DATE:
+        return combinazioni
+    flessibilita = timedelta(days=watch['flessibilita_giorni'])
+    base_partenza = datetime.strptime(watch['partenza'], "%Y-%m-%d")
+    try:
+        griglia = amadeus_cerca_date_economiche(
+            watch['origine'], watch['destinazione'],
+            (base_partenza - flessibilita).strftime("%Y-%m-%d"),
+            (base_partenza + flessibilita).strftime("%Y-%m-%d"),
+            watch['min_durata'], watch['max_durata'],
+        )
+    except Exception as e:
+        print(f"   ⚠️ {watch['nome']}: griglia date non disponibile ({e}), cerco tutte le combinazioni")
+        return combinazioni
+    
+    valide = {(c['partenza'], c['ritorno']): c for c in combinazioni}
+    candidati = [dict(valide[coppia], prezzo_indicativo=prezzo)
+                 for coppia, prezzo in griglia.items() if coppia in valide]
+    if not candidati:
+        print(f"   ⚠️ {watch['nome']}: griglia date vuota, cerco tutte le combinazioni")
+        return combinazioni
+    candidati.sort(key=lambda c: (c['prezzo_indicativo'],
+                                  abs(c['durata'] - watch.get('durata_ideale', DURATA_IDEALE))))
+    scelti = candidati[:PRESELEZIONE_CANDIDATI]
+    print(f"   🗓️ {watch['nome']}: {len(candidati)} coppie prezzate, "
+          f"cerco le {len(scelti)} più economiche")
+    return scelti
+
+def esegui_in_parallelo(funzione, lista_argomenti, max_paralleli=None):
+    """Esegue funzione(*args) per ogni elemento con un pool di thread limitato.
+
+    I risultati tornano nello stesso ordine di `lista_argomenti`; un errore su
+    un elemento non blocca gli altri (il suo risultato è None).
+    """
+    if max_paralleli is None:
+        max_paralleli = MAX_RICERCHE_PARALLELE
+    risultati = [None] * len(lista_argomenti)
+    if not lista_argomenti:
+        return risultati
+    workers = max(1, min(max_paralleli, len(lista_argomenti)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(funzione, *args): i
+            for i, args in enumerate(lista_argomenti)
+        }
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                risultati[i] = future.result()
+            except Exception as e:
+                print(f"   ❌ Errore ricerca parallela {lista_argomenti[i]}: {e}")
+    return risultati
+
+def controlla_prezzi(processi=None):
     """Controlla prezzi su tutti i siti configurati"""
     
     print(f"🔍 Controllo prezzi alle {datetime.now().strftime('%H:%M')}...")
     
     try:
-        # Controlla date ideali
-        risultato_ideale = controlla_volo_specifico(PARTENZA, RITORNO, "DATE IDEALI")
+        watches = carica_watchlist()
+        esegui_watchlist(watches, processi)
         
-        # Controlla date flessibili
-        combinazioni = genera_date_flessibili()
+    except Exception as e:
+        print(f"❌ Errore generale: {e}")
+
+def esegui_watchlist(watches, processi=None):
+    """Cerca tutte le date di tutti i watch e analizza i risultati watch per watch.
+
+    Le query identiche (stessa rotta, date e passeggeri) richieste da più watch
+    o più volte nello stesso watch partono una sola volta, tutte in parallelo.
+    Con più `processi` (default SHARD_PROCESSI) ricerche e analisi sono divise
+    tra processi worker; storico e notifiche li scrive solo questo processo.
+    I watch delle rotte già in controllo da un'altra istanza vengono saltati.
+    Con POLLING_ADATTIVO si cercano solo le combinazioni scadute e si ritorna
+    {nome watch: prossimo controllo}.
+    """
+    prima = istantanea_metriche()
+    processi = SHARD_PROCESSI if processi is None else processi
+    try:
+        with blocca_bucket(watches) as (liberi, occupati):
+            if occupati:
+                print(f"🔒 {len(occupati)} watch saltati: rotta già in controllo da un'altra istanza")
+            if not liberi:
+                return {}
+            if processi > 1:
+                risultato = cerca_in_shard(liberi, processi)
+            else:
+                risultato = cerca_e_analizza(liberi)
+            return registra_risultati(risultato)
+    finally:
+        registra_ciclo_metriche(prima, len(watches))
+
+def cerca_e_analizza(watches):
+    """Ricerche e analisi dei watch, senza scrivere nulla (gira anche nei worker).
+
+    Ritorna le notifiche accodate, le osservazioni da salvare nello storico,
+    le istantanee cambiate, le righe di pianificazione e i prossimi controlli
+    per watch. I watch senza offerte cambiate non vengono analizzati.
+    """
+    piani = []
+    query = {}  # (origine, destinazione, partenza, ritorno, passeggeri) -> priorità
+    # Con la preselezione serve tutta la griglia, altrimenti basta la parte migliore
+    limite = MAX_COMBINAZIONI if MAX_COMBINAZIONI > 0 and not PRESELEZIONE_DATE else None
+    tutte_combinazioni = [genera_date_flessibili(watch, limite) for watch in watches]
+    if PRESELEZIONE_DATE:
+        preselezionate = esegui_in_parallelo(
+            preseleziona_combinazioni, list(zip(watches, tutte_combinazioni)))
+        tutte_combinazioni = [p if p is not None else c
+                              for p, c in zip(preselezionate, tutte_combinazioni)]
+    for watch, combinazioni in zip(watches, tutte_combinazioni):
+        # Date ideali + date flessibili
+        if MAX_COMBINAZIONI > 0:
+            combinazioni = combinazioni[:MAX_COMBINAZIONI]
+        ricerche = [(watch['partenza'], watch['ritorno'], "DATE IDEALI", None)]
+        for i, combo in enumerate(combinazioni):
+            ricerche.append((combo['partenza'], combo['ritorno'], f"FLESSIBILE {i+1}", combo))
+        for partenza, ritorno, tipo_ricerca, _ in ricerche:
+            chiave = (watch['origine'], watch['destinazione'], partenza, ritorno, watch['passeggeri'])
+            priorita = PRIORITA_IDEALE if combo_ideale(tipo_ricerca) else PRIORITA_FLESSIBILE
+            query[chiave] = min(priorita, query.get(chiave, priorita))
+        piani.append((watch, ricerche))
+    
+    piano = {}
+    if POLLING_ADATTIVO:
+        # Solo le combinazioni scadute; quelle mai viste sono sempre da cercare
+        piano = leggi_pianificazione()
+        adesso = time.time()
+        tutte = len(query)
+        query = {k: p for k, p in query.items() if piano.get(k, 0) <= adesso}
+        if len(query) < tutte:
+            print(f"🗓️ Polling adattivo: {len(query)}/{tutte} combinazioni da controllare ora")
+    
+    elenco = list(query.items())
+    print(f"⚡ {len(elenco)} ricerche uniche per {len(watches)} watch "
+          f"(max {MAX_RICERCHE_PARALLELE} in parallelo)")
+    risposte = esegui_in_parallelo(_esegui_query, elenco)
+    esiti = {chiave: risposta for (chiave, _), risposta in zip(elenco, risposte)}
+    cambiate, istantanee, offerte_nuove = confronta_istantanee(esiti)
+    print(f"🧾 Istantanee: {len(cambiate)}/{len(esiti)} ricerche cambiate, "
+          f"{offerte_nuove} offerte nuove o modificate")
+    solo_variazioni = ANALISI_SOLO_VARIAZIONI and not INVIA_REPORT_SEMPRE
+    
+    for watch, ricerche in piani:
+        chiavi = [(watch['origine'], watch['destinazione'], p, r, watch['passeggeri'])
+                  for p, r, _, _ in ricerche]
+        if not any(chiave in esiti for chiave in chiavi):
+            continue  # polling adattivo: niente di scaduto per questo watch
+        if solo_variazioni and not any(chiave in cambiate for chiave in chiavi):
+            print(f"💤 {watch['nome']}: offerte invariate, niente da analizzare")
+            continue
+        risultato_ideale = None
         prezzi_trovati = []
-        
-        for i, combo in enumerate(combinazioni[:5]):  # Controlla solo le prime 5
-            risultato = controlla_volo_specifico(combo['partenza'], combo['ritorno'], 
-                                            f"FLESSIBILE {i+1}")
-            if risultato:
-                if risultato.get('prezzo') is None:
-                    continue
+        for partenza, ritorno, tipo_ricerca, combo in ricerche:
+            chiave = (watch['origine'], watch['destinazione'], partenza, ritorno, watch['passeggeri'])
+            risultato = _risultato_ricerca(esiti.get(chiave), partenza, ritorno, tipo_ricerca, watch)
+            if combo is None:
+                risultato_ideale = risultato
+            elif risultato and risultato.get('prezzo') is not None:
                 risultato['durata'] = combo['durata']
                 prezzi_trovati.append(risultato)
         
         # Analizza i risultati
-        analizza_risultati(risultato_ideale, prezzi_trovati)
-        
-    except Exception as e:
-        print(f"❌ Errore generale: {e}")
-
-def controlla_volo_specifico(partenza, ritorno, tipo_ricerca):
-    """Controlla prezzo per una specifica combinazione di date"""
+        try:
+            analizza_risultati(risultato_ideale, prezzi_trovati, watch)
+        except Exception as e:
+            print(f"❌ Errore analisi {watch['nome']}: {e}")
     
-    # Headers per sembrare un browser normale
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-    }
+    with _CODA_NOTIFICHE_LOCK:
+        notifiche = list(_CODA_NOTIFICHE)
+        _CODA_NOTIFICHE.clear()
     
-    try:
-        print(f"   🔍 {tipo_ricerca}: {partenza} → {ritorno}")
-        
-        # 1) Prova dati reali da Amadeus (free tier)
-        offerta = amadeus_search_flights(partenza, ritorno, NUMERO_PASSEGGERI)
-        if offerta:
-            print(f"   💰 €{offerta['prezzo']} (Amadeus)")
-            return {
-                'prezzo': offerta['prezzo'],
+    # Offerte da registrare nello storico (dopo l'analisi, che confronta col passato):
+    # tutte le top-k di ogni ricerca, con la posizione. Quelle lette dalla cache
+    # (es. arrivate con /prezzi) solo se la stessa risposta non è già nello storico
+    registrate = osservazioni_registrate(
+        (chiave, esito[1]['ottenuta_il']) for (chiave, _), esito in zip(elenco, risposte)
+        if esito and esito[0] == 'ok' and esito[1] and esito[1].get('da_cache')
+        and esito[1].get('ottenuta_il'))
+    osservazioni = []
+    for (chiave, priorita), esito in zip(elenco, risposte):
+        if not esito or esito[0] != 'ok' or not esito[1]:
+            continue
+        ottenuta_il = esito[1].get('ottenuta_il')
+        if esito[1].get('da_cache') and (not ottenuta_il or (chiave, ottenuta_il) in registrate):
+            continue
+        origine, destinazione, partenza, ritorno, passeggeri = chiave
+        for posizione, offerta in enumerate(esito[1]['offerte'], 1):
+            osservazioni.append({
+                'rotta': f"{origine}-{destinazione}",
                 'partenza': partenza,
                 'ritorno': ritorno,
-                'sito': offerta['sito'],
-                'link': offerta['link'],
-                'tipo': 'ideale' if "IDEALI" in tipo_ricerca else 'flessibile'
-            }
-        
-        # 2) Fallback: genera link/prenotazione utile (senza prezzo) usando Google Flights
-        link = genera_link_offerta('Google Flights', partenza, ritorno, NUMERO_PASSEGGERI)
-        print("   ⚠️ Nessuna offerta trovata su Amadeus")
+                'passeggeri': passeggeri,
+                'prezzo': int(round(offerta.prezzo)),
+                'sito': esito[1]['sito'],
+                'tipo': 'ideale' if priorita == PRIORITA_IDEALE else 'flessibile',
+                'osservato_il': ottenuta_il,
+                'posizione': posizione,
+            })
+    risultato = {'notifiche': notifiche, 'osservazioni': osservazioni, 'istantanee': istantanee,
+                 'pianificazione': [], 'prossimi': {}}
+    
+    if not POLLING_ADATTIVO:
+        return risultato
+    watches_per_chiave = {}
+    for watch, ricerche in piani:
+        for partenza, ritorno, _, _ in ricerche:
+            chiave = (watch['origine'], watch['destinazione'], partenza, ritorno, watch['passeggeri'])
+            watches_per_chiave.setdefault(chiave, []).append(watch)
+    righe = calcola_pianificazione(esiti, watches_per_chiave)
+    piano.update({chiave: riga[4] for chiave, riga in zip(esiti, righe)})
+    adesso = time.time()
+    risultato['pianificazione'] = righe
+    risultato['prossimi'] = {
+        watch['nome']: min(piano.get((watch['origine'], watch['destinazione'], p, r, watch['passeggeri']), adesso)
+                           for p, r, _, _ in ricerche)
+        for watch, ricerche in piani
+    }
+    return risultato
+
+def registra_risultati(risultato):
+    """Unico scrittore: invia le notifiche e salva storico, istantanee e pianificazione."""
+    for voce in risultato['notifiche']:
+        accoda_notifica(voce['chiave'], voce['testo'], voce['oggetto'])
+    # Gli avvisi non consegnati restano in sospeso su file e ripartono al prossimo
+    # controllo: storico e istantanee possono avanzare senza perderli
+    invia_notifiche_in_coda()
+    salva_prezzi(risultato['osservazioni'])
+    salva_istantanee(risultato['istantanee'])
+    salva_pianificazione(risultato['pianificazione'])
+    return risultato['prossimi']
+
+# ===== ESECUZIONE A SHARD =====
+# Ogni rotta ha un bucket stabile (crc32): lo stesso watch finisce sempre nello
+# stesso processo e lo stesso lock protegge la rotta tra istanze diverse.
+
+_POOL_SHARD = {'pool': None, 'processi': 0}
+
+def bucket_watch(watch):
+    """Bucket stabile (tra esecuzioni, processi e istanze) della rotta del watch."""
+    rotta = f"{watch['origine']}-{watch['destinazione']}-{watch['passeggeri']}"
+    return zlib.crc32(rotta.encode('utf-8')) % SHARD_BUCKET
+
+@contextlib.contextmanager
+def blocca_bucket(watches):
+    """Prende senza attendere i lock dei bucket dei watch; ritorna (watch liberi, watch occupati).
+
+    I lock restano presi fino all'uscita dal blocco, cioè fino a notifiche e
+    storico scritti: un'altra istanza non può controllare le stesse rotte.
+    """
+    bucket = sorted({bucket_watch(watch) for watch in watches})
+    with contextlib.ExitStack() as pila:
+        liberi = set()
+        for b in bucket:
+            if pila.enter_context(blocco_file(os.path.join(LOCK_DIR, f"bucket-{b:02d}.lock"), attendi=False)):
+                liberi.add(b)
+        yield ([w for w in watches if bucket_watch(w) in liberi],
+               [w for w in watches if bucket_watch(w) not in liberi])
+
+def _inizializza_worker_shard(processi):
+    """Nel processo worker: rate limit Amadeus diviso tra i worker, Ctrl+C gestito dal padre."""
+    global AMADEUS_RICHIESTE_AL_SECONDO, AMADEUS_BURST
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    AMADEUS_RICHIESTE_AL_SECONDO /= processi
+    AMADEUS_BURST = max(1, AMADEUS_BURST // processi)
+    _LIMITATORE['gettoni'] = float(AMADEUS_BURST)
+
+def _esegui_shard(watches):
+    """Eseguito nel worker: token e sessioni restano caldi tra un ciclo e l'altro."""
+    prima = istantanea_metriche()
+    cache_prima = dict(_CACHE_STATS)
+    risultato = cerca_e_analizza(watches)
+    risultato['metriche'] = differenza_metriche(prima)
+    risultato['cache'] = {k: v - cache_prima[k] for k, v in _CACHE_STATS.items()}
+    return risultato
+
+def _pool_shard(processi):
+    if _POOL_SHARD['pool'] is None or _POOL_SHARD['processi'] != processi:
+        chiudi_pool_shard()
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        # spawn anche dove c'è fork: il padre ha già thread attivi (rinnovo token, comandi)
+        _POOL_SHARD['pool'] = ProcessPoolExecutor(
+            processi, mp_context=multiprocessing.get_context('spawn'),
+            initializer=_inizializza_worker_shard, initargs=(processi,))
+        _POOL_SHARD['processi'] = processi
+    return _POOL_SHARD['pool']
+
+def chiudi_pool_shard():
+    """Ferma i processi worker (fine processo o cambio del numero di processi)."""
+    if _POOL_SHARD['pool'] is not None:
+        _POOL_SHARD['pool'].shutdown()
+        _POOL_SHARD.update(pool=None, processi=0)
+
+def cerca_in_shard(watches, processi):
+    """Divide i watch tra `processi` worker per bucket e unisce i risultati."""
+    shard = {}
+    for watch in watches:
+        shard.setdefault(bucket_watch(watch) % processi, []).append(watch)
+    if len(shard) == 1:
+        return cerca_e_analizza(watches)
+    pool = _pool_shard(processi)
+    try:
+        amadeus_get_token()  # salvato su file: i worker lo trovano già valido
+    except Exception as e:
+        print(f"⚠️ Token Amadeus non disponibile: {e}")
+    print(f"🧩 {len(watches)} watch su {len(shard)} processi")
+    futures = [(pool.submit(_esegui_shard, gruppo), gruppo) for _, gruppo in sorted(shard.items())]
+    risultato = {'notifiche': [], 'osservazioni': [], 'istantanee': [], 'pianificazione': [], 'prossimi': {}}
+    for future, gruppo in futures:
+        try:
+            parziale = future.result()
+        except Exception as e:
+            print(f"❌ Errore shard ({len(gruppo)} watch): {e}")
+            continue
+        unisci_metriche(parziale.pop('metriche', None))
+        unisci_statistiche_cache(parziale.pop('cache', None))
+        for campo in ('notifiche', 'osservazioni', 'istantanee', 'pianificazione'):
+            risultato[campo].extend(parziale[campo])
+        risultato['prossimi'].update(parziale['prossimi'])
+    if any(f.exception() is not None for f, _ in futures):
+        chiudi_pool_shard()  # un worker morto rompe il pool: si ricrea al prossimo ciclo
+    return risultato
+
+def combo_ideale(tipo_ricerca):
+    return "IDEALI" in tipo_ricerca
+
+@cronometra('ricerca')
+def _esegui_query(chiave, priorita):
+    """Una ricerca Amadeus per combinazione; ritorna ('ok', offerta) oppure ('errore', messaggio).
+
+    Durata in durata_secondi{operazione="ricerca"}, errori in errori{operazione="ricerca"}.
+    """
+    origine, destinazione, partenza, ritorno, passeggeri = chiave
+    print(f"   🔍 {origine}→{destinazione}: {partenza} → {ritorno} ({passeggeri} pax)")
+    try:
+        offerta = amadeus_search_flights(partenza, ritorno, passeggeri, priorita,
+                                         origine, destinazione)
+        if offerta and offerta.get('stale'):
+            print(f"   🕰️ €{offerta['prezzo']} {origine}→{destinazione} {partenza} → {ritorno} "
+                  f"(Amadeus non disponibile, dato del {offerta['aggiornato_il']})")
+        elif offerta:
+            print(f"   💰 €{offerta['prezzo']} {origine}→{destinazione} {partenza} → {ritorno} (Amadeus)")
+        else:
+            print(f"   ⚠️ Nessuna offerta su Amadeus per {origine}→{destinazione} {partenza} → {ritorno}")
+        return ('ok', offerta)
+    except Exception as e:
+        conta('errori', operazione='ricerca')
+        print(f"   ❌ Errore per {origine}→{destinazione} {partenza} → {ritorno}: {e}")
+        return ('errore', str(e))
+
+def _risultato_ricerca(esito, partenza, ritorno, tipo_ricerca, watch):
+    """Converte l'esito di una query nel risultato usato dall'analisi (None se in errore)."""
+    if esito is None or esito[0] == 'errore':
+        return None
+    offerta = esito[1]
+    tipo = 'ideale' if combo_ideale(tipo_ricerca) else 'flessibile'
+    if offerta:
         return {
-            'prezzo': None,
+            'prezzo': offerta['prezzo'],
             'partenza': partenza,
             'ritorno': ritorno,
-            'sito': 'Google Flights',
-            'link': link,
-            'tipo': 'ideale' if "IDEALI" in tipo_ricerca else 'flessibile'
+            'sito': offerta['sito'],
+            'link': offerta['link'],
+            'tipo': tipo,
+            'stale': offerta.get('stale', False),
+            'aggiornato_il': offerta.get('aggiornato_il'),
+            'dettaglio': offerta['offerte'][0].descrizione() if offerta.get('offerte') else None,
         }
-        
-    except Exception as e:
-        print(f"   ❌ Errore per {tipo_ricerca}: {e}")
-        return None
+    # Fallback: link utile (senza prezzo) a Google Flights
+    link = genera_link_offerta('Google Flights', partenza, ritorno, watch['passeggeri'],
+                               watch['origine'], watch['destinazione'])
+    return {
+        'prezzo': None,
+        'partenza': partenza,
+        'ritorno': ritorno,
+        'sito': 'Google Flights',
+        'link': link,
+        'tipo': tipo
+    }
 
-def analizza_risultati(risultato_ideale, prezzi_flessibili):
+@cronometra('analizza_risultati')
+def analizza_risultati(risultato_ideale, prezzi_flessibili, watch=None):
     """Analizza tutti i prezzi trovati e invia notifiche appropriate"""
     
-    # Leggi ultimo prezzo salvato
-    ultimo_prezzo_salvato = leggi_ultimo_prezzo()
+    if watch is None:
+        watch = watch_predefinito()
+    
+    rotta = f"{watch['origine']}-{watch['destinazione']}"
     
     # Trova il prezzo migliore
     tutti_prezzi = []
@@ -271,116 +1982,160 @@ def analizza_risultati(risultato_ideale, prezzi_flessibili):
     tutti_prezzi.extend(prezzi_flessibili)
     
     if not tutti_prezzi:
-        print("❌ Nessun prezzo trovato oggi")
+        print(f"❌ {watch['nome']}: nessun prezzo trovato oggi")
         if USA_TELEGRAM and INVIA_REPORT_SEMPRE:
-            ultimo = leggi_ultimo_prezzo()
+            ultimo = leggi_ultimo_prezzo(rotta, passeggeri=watch['passeggeri'])
             righe = [
-                "📭 Nessun prezzo live dalle API.",
+                f"📭 Nessun prezzo live dalle API ({watch['nome']}).",
                 "📬 Ultimo prezzo noto e link utili:",
                 f"- Ultimo noto: €{int(ultimo) if ultimo != 999999 else '—'}",
             ]
-            link_google = genera_link_offerta('Google Flights', PARTENZA, RITORNO, NUMERO_PASSEGGERI)
-            link_sky = genera_link_offerta('Skyscanner', PARTENZA, RITORNO, NUMERO_PASSEGGERI)
-            link_kayak = genera_link_offerta('Kayak', PARTENZA, RITORNO, NUMERO_PASSEGGERI)
-            link_am = genera_link_offerta('Aeromexico', PARTENZA, RITORNO, NUMERO_PASSEGGERI)
-            righe.append(f"- Google Flights: {link_google}")
-            righe.append(f"- Skyscanner: {link_sky}")
-            righe.append(f"- Kayak: {link_kayak}")
-            righe.append(f"- Aeromexico: {link_am}")
-            invia_messaggio_telegram("\n".join(righe))
+            righe.extend(
+                f"- {sito}: " + genera_link_offerta(sito, watch['partenza'], watch['ritorno'],
+                                                    watch['passeggeri'], watch['origine'],
+                                                    watch['destinazione'])
+                for sito in ('Google Flights', 'Skyscanner', 'Kayak', 'Aeromexico')
+            )
+            accoda_notifica(None, "\n".join(righe))
         return
     
     # Ordina per prezzo migliore
     tutti_prezzi.sort(key=lambda x: x['prezzo'])
-    prezzo_migliore = tutti_prezzi[0]
-    
-    print(f"\n🏆 MIGLIOR PREZZO OGGI: €{prezzo_migliore['prezzo']} ({prezzo_migliore['tipo']})")
+    # I prezzi non aggiornati (provider giù) finiscono nel report ma non generano avvisi
+    freschi = [p for p in tutti_prezzi if not p.get('stale')]
     
-    # Controlla se inviare notifiche
-    controlla_e_invia_notifiche(prezzo_migliore, ultimo_prezzo_salvato)
+    if freschi:
+        prezzo_migliore = freschi[0]
+        print(f"\n🏆 MIGLIOR PREZZO OGGI {watch['nome']}: €{prezzo_migliore['prezzo']} ({prezzo_migliore['tipo']})")
+        
+        # Ultimo prezzo e statistiche registrati per la stessa coppia di date
+        ultimo_prezzo_salvato = leggi_ultimo_prezzo(rotta, prezzo_migliore['partenza'],
+                                                    prezzo_migliore['ritorno'], watch['passeggeri'])
+        statistiche = leggi_statistiche_prezzo(rotta, prezzo_migliore['partenza'],
+                                               prezzo_migliore['ritorno'], watch['passeggeri'])
+        
+        # Controlla se inviare notifiche
+        controlla_e_invia_notifiche(prezzo_migliore, ultimo_prezzo_salvato, watch, statistiche)
+    else:
+        print(f"🕰️ {watch['nome']}: solo prezzi non aggiornati (provider non disponibile), nessun avviso")
     
     # Report riassuntivo se richiesto
     if USA_TELEGRAM and INVIA_REPORT_SEMPRE:
-        righe = ["📬 Report controllo prezzi:"]
-        for p in tutti_prezzi[:5]:
-            righe.append(f"- {p.get('tipo','?')}: €{p['prezzo']} {p['partenza']}→{p['ritorno']} ({p.get('sito','?')})")
-        invia_messaggio_telegram("\n".join(righe))
-    
-    # Salva il nuovo prezzo
-    salva_prezzo(prezzo_migliore['prezzo'], prezzo_migliore['tipo'])
+        righe = [f"📬 Report controllo prezzi {watch['nome']}:"] + rendi_offerte(tutti_prezzi[:5])
+        accoda_notifica(None, "\n".join(righe))
 
-def controlla_e_invia_notifiche(offerta, ultimo_prezzo):
+def controlla_e_invia_notifiche(offerta, ultimo_prezzo, watch=None, statistiche=None):
     """Controlla se inviare notifiche basate sui criteri impostati"""
     
+    if watch is None:
+        watch = watch_predefinito()
     prezzo = offerta['prezzo']
     
     # Controlli per diversi tipi di alert
-    if prezzo <= PREZZO_SOGLIA:
+    if prezzo <= watch['prezzo_soglia']:
         offerta['alert_type'] = "TARGET_OTTIMALE"
-        invia_notifica_offerta(offerta)
+        invia_notifica_offerta(offerta, watch)
         
-    elif prezzo <= PREZZO_BUONO:
+    elif prezzo <= watch['prezzo_buono']:
         offerta['alert_type'] = "PREZZO_BUONO" 
-        invia_notifica_offerta(offerta)
+        invia_notifica_offerta(offerta, watch)
         
-    elif prezzo <= SEMPRE_NOTIFICA_SOTTO:
+    elif prezzo <= watch['sempre_notifica_sotto']:
         offerta['alert_type'] = "SOTTO_SOGLIA"
-        invia_notifica_offerta(offerta)
+        invia_notifica_offerta(offerta, watch)
         
-    elif prezzo < ultimo_prezzo - MIN_CALO_PER_NOTIFICA:
-        # Calo significativo
-        invia_notifica_calo(prezzo, ultimo_prezzo, "Significativo")
-    
     else:
-        print(f"💡 Prezzo €{prezzo} - nessuna notifica necessaria")
+        calo = valuta_calo(prezzo, ultimo_prezzo, statistiche, watch)
+        if calo:
+            riferimento, motivo = calo
+            conta('cali_rilevati')
+            invia_notifica_calo(prezzo, riferimento, motivo, offerta, watch)
+        else:
+            print(f"💡 Prezzo €{prezzo} - nessuna notifica necessaria")
+
+def valuta_calo(prezzo, ultimo_prezzo, statistiche, watch):
+    """Decide se `prezzo` è un calo da notificare; ritorna (prezzo di riferimento, motivo) o None.
+
+    Con abbastanza osservazioni conta solo un calo statisticamente rilevante
+    rispetto alla media mobile della coppia di date; prima si confronta con
+    l'ultimo prezzo visto (mai al primo controllo).
+    """
+    if statistiche is not None and statistiche.n >= ANALISI_MIN_OSSERVAZIONI:
+        scarti = statistiche.scarti_sotto_media(prezzo)
+        if scarti < ANALISI_SOGLIA_Z:
+            return None
+        motivo = f"Significativo ({scarti:.1f}σ sotto la media recente"
+        percentile = statistiche.percentile_di(prezzo)
+        if percentile is not None:
+            motivo += f", più basso del {1 - percentile:.0%} dei prezzi visti"
+        return int(round(statistiche.ewma)), motivo + ")"
+    if ultimo_prezzo is None or ultimo_prezzo == 999999:
+        return None
+    if prezzo < ultimo_prezzo - watch['min_calo']:
+        return int(round(ultimo_prezzo)), "rispetto all'ultimo controllo"
+    return None
 
-def invia_notifica_offerta(offerta):
+def _chiave_avviso(tipo, offerta, watch, prezzo):
+    """Identifica un avviso: stessa rotta, date, passeggeri e prezzo = stesso avviso."""
+    return '|'.join(str(x) for x in (
+        tipo, watch['origine'], watch['destinazione'], offerta.get('partenza', watch['partenza']),
+        offerta.get('ritorno', watch['ritorno']), watch['passeggeri'], prezzo,
+    ))
+
+def invia_notifica_offerta(offerta, watch=None):
     """Invia notifica per offerte importanti"""
     
+    if watch is None:
+        watch = watch_predefinito()
     if USA_TELEGRAM:
-        invia_telegram_offerta(offerta)
+        invia_telegram_offerta(offerta, watch)
     else:
-        invia_email_offerta(offerta)
+        invia_email_offerta(offerta, watch)
 
-def invia_notifica_calo(prezzo_nuovo, prezzo_vecchio, motivo, offerta=None):
+def invia_notifica_calo(prezzo_nuovo, prezzo_vecchio, motivo, offerta=None, watch=None):
     """Invia notifica per cali di prezzo"""
     
+    if watch is None:
+        watch = watch_predefinito()
     if USA_TELEGRAM:
-        invia_telegram_calo(prezzo_nuovo, prezzo_vecchio, motivo, offerta)
+        invia_telegram_calo(prezzo_nuovo, prezzo_vecchio, motivo, offerta, watch)
     else:
-        invia_email_calo(prezzo_nuovo, prezzo_vecchio, motivo, offerta)
+        invia_email_calo(prezzo_nuovo, prezzo_vecchio, motivo, offerta, watch)
 
-def invia_telegram_offerta(offerta):
+def invia_telegram_offerta(offerta, watch):
     """Invia notifica Telegram per offerte"""
     
+    passeggeri = watch['passeggeri']
     prezzo_per_persona = offerta['prezzo']
-    prezzo_totale = prezzo_per_persona * NUMERO_PASSEGGERI
-    risparmio_per_persona = PREZZO_ATTUALE - prezzo_per_persona
-    risparmio_totale = risparmio_per_persona * NUMERO_PASSEGGERI
+    prezzo_totale = prezzo_per_persona * passeggeri
+    risparmio_per_persona = watch['prezzo_attuale'] - prezzo_per_persona
+    risparmio_totale = risparmio_per_persona * passeggeri
     
     # Emoji e messaggio basato sul tipo di alert
     if offerta['alert_type'] == "TARGET_OTTIMALE":
         emoji = "🎯🔥"
-        stato = f"TARGET OTTIMALE €{PREZZO_SOGLIA} RAGGIUNTO!"
+        stato = f"TARGET OTTIMALE €{watch['prezzo_soglia']} RAGGIUNTO!"
         urgenza = "PRENOTA SUBITO!"
     elif offerta['alert_type'] == "PREZZO_BUONO":
         emoji = "✨💰"
-        stato = f"PREZZO TOP €{PREZZO_BUONO} RAGGIUNTO!"
+        stato = f"PREZZO TOP €{watch['prezzo_buono']} RAGGIUNTO!"
         urgenza = "Ottimo prezzo!"
     else:
         emoji = "📢💡"
-        stato = f"Prezzo interessante sotto €{SEMPRE_NOTIFICA_SOTTO}"
+        stato = f"Prezzo interessante sotto €{watch['sempre_notifica_sotto']}"
         urgenza = "Da valutare!"
     
+    volo = f"\n🛫 Volo: {offerta['dettaglio']}" if offerta.get('dettaglio') else ""
+    
     messaggio = f"""{emoji} OFFERTA TROVATA! {emoji}
 
-✈️ Aeromexico DIRETTO FCO→MEX
+✈️ {watch['descrizione']} {watch['origine']}→{watch['destinazione']}
 📅 {offerta['partenza']} → {offerta['ritorno']}
 📊 Tipo: {offerta.get('tipo', 'N/A')}
-🌐 Sito: {offerta.get('sito', 'N/A')}
+🌐 Sito: {offerta.get('sito', 'N/A')}{volo}
 
 💰 €{prezzo_per_persona}/persona
-💰 €{prezzo_totale} TOTALE x{NUMERO_PASSEGGERI}
+💰 €{prezzo_totale} TOTALE x{passeggeri}
 
 🎯 RISPARMIO: €{risparmio_totale} totale!
 🟢 {stato}
@@ -389,64 +2144,92 @@ def invia_telegram_offerta(offerta):
 
 🔗 Link: {offerta.get('link', 'N/A')}"""
     
-    invia_messaggio_telegram(messaggio)
+    accoda_notifica(_chiave_avviso(offerta['alert_type'], offerta, watch, prezzo_per_persona), messaggio)
 
-def invia_telegram_calo(prezzo_nuovo, prezzo_vecchio, motivo, offerta=None):
+def invia_telegram_calo(prezzo_nuovo, prezzo_vecchio, motivo, offerta, watch):
     """Invia notifica Telegram per cali di prezzo"""
     
+    passeggeri = watch['passeggeri']
     risparmio_per_persona = prezzo_vecchio - prezzo_nuovo
-    risparmio_totale = risparmio_per_persona * NUMERO_PASSEGGERI
-    prezzo_totale = prezzo_nuovo * NUMERO_PASSEGGERI
+    risparmio_totale = risparmio_per_persona * passeggeri
+    prezzo_totale = prezzo_nuovo * passeggeri
     
     extra = ""
+    date = (watch['partenza'], watch['ritorno'])
     if offerta:
         extra = f"\n🌐 Sito: {offerta.get('sito')}\n🔗 Link: {offerta.get('link')}"
+        date = (offerta.get('partenza', date[0]), offerta.get('ritorno', date[1]))
 
     messaggio = f"""📉 PREZZO SCESO! 📉
 
-✈️ Aeromexico DIRETTO FCO→MEX
-📅 {PARTENZA} → {RITORNO}
+✈️ {watch['descrizione']} {watch['origine']}→{watch['destinazione']}
+📅 {date[0]} → {date[1]}
 
 💰 Prima: €{prezzo_vecchio}/persona
 💰 Ora: €{prezzo_nuovo}/persona
 📉 Sceso di: €{risparmio_per_persona}
 
-💰 TOTALE x{NUMERO_PASSEGGERI}: €{prezzo_totale}
+💰 TOTALE x{passeggeri}: €{prezzo_totale}
 🎯 RISPARMIO: €{risparmio_totale}
 
 🟢 Calo {motivo}!{extra}"""
     
-    invia_messaggio_telegram(messaggio)
+    accoda_notifica(_chiave_avviso('CALO', offerta or {}, watch, prezzo_nuovo), messaggio)
 
+_TELEGRAM_INVIO_LOCK = threading.Lock()
+_TELEGRAM_ULTIMO_INVIO = {'quando': 0.0}
+
+@cronometra('invia_messaggio_telegram')
 def invia_messaggio_telegram(messaggio):
-    """Funzione generica per inviare messaggi Telegram"""
+    """Funzione generica per inviare messaggi Telegram (True se inviato).
+
+    I messaggi alla chat sono distanziati di TELEGRAM_INTERVALLO_MESSAGGI
+    secondi; su 429 si attende il retry_after indicato da Telegram e si
+    riprova una volta.
+    """
     
     try:
-        url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
+        url = f"{TELEGRAM_API_URL}/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
         data = {
             'chat_id': TELEGRAM_CHAT_ID,
             'text': messaggio
         }
         
-        response = requests.post(url, data=data, timeout=10)
+        with _TELEGRAM_INVIO_LOCK:
+            for tentativo in range(2):
+                attesa = _TELEGRAM_ULTIMO_INVIO['quando'] + TELEGRAM_INTERVALLO_MESSAGGI - time.monotonic()
+                if attesa > 0:
+                    time.sleep(attesa)
+                response = http_post(url, data=data, timeout=10)
+                _TELEGRAM_ULTIMO_INVIO['quando'] = time.monotonic()
+                if response.status_code != 429 or tentativo:
+                    break
+                try:
+                    retry_after = response.json().get('parameters', {}).get('retry_after', 1)
+                except ValueError:
+                    retry_after = 1
+                time.sleep(float(retry_after))
         
         if response.status_code == 200:
+            conta('notifiche', canale='telegram', esito='inviata')
             print("📱 Notifica Telegram inviata!")
-        else:
-            print(f"❌ Errore Telegram: {response.text}")
+            return True
+        print(f"❌ Errore Telegram: {response.text}")
             
     except Exception as e:
         print(f"❌ Errore invio Telegram: {e}")
+    conta('notifiche', canale='telegram', esito='errore')
+    return False
 
 def leggi_messaggi_telegram(offset=None):
     """Legge aggiornamenti Telegram (long polling semplice)"""
     try:
-        url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/getUpdates"
+        url = f"{TELEGRAM_API_URL}/bot{TELEGRAM_BOT_TOKEN}/getUpdates"
         params = {}
         if offset is not None:
             params['offset'] = offset
         params['timeout'] = 25
-        resp = requests.get(url, params=params, timeout=30)
+        resp = http_get(url, params=params, timeout=30)
         resp.raise_for_status()
         return resp.json()
     except Exception as e:
@@ -462,74 +2245,213 @@ def gestisci_comando_telegram(testo):
     if txt.startswith('/prezzi'):
         # Parsing semplice: /prezzi [FCO] [MEX] [YYYY-MM-DD] [YYYY-MM-DD] [adults]
         parts = testo.split()
-        origin = 'FCO'
-        dest = 'MEX'
+        origin = ORIGINE
+        dest = DESTINAZIONE
         partenza = PARTENZA
         ritorno = RITORNO
         adults = NUMERO_PASSEGGERI
         if len(parts) >= 6:
             origin, dest, partenza, ritorno, adults = parts[1], parts[2], parts[3], parts[4], int(parts[5])
+            origin, dest = origin.upper(), dest.upper()
         # Esegui ricerca multipla
         return prezzi_tempo_reale(origin, dest, partenza, ritorno, adults)
     return "Comando non riconosciuto. Usa /prezzi"
 
+# ===== PROVIDER =====
+# Ogni sorgente di prezzi/link è un Provider registrato in PROVIDER; il
+# comando /prezzi li interroga tutti insieme con cerca_su_tutti.
+
+# Thread per le chiamate bloccanti dei provider. Non è l'executor di default
+# del loop: asyncio.run non aspetta le ricerche rimaste oltre il budget, che
+# finiscono in sottofondo (e riempiono la cache) senza ritardare la risposta.
+_POOL_PROVIDER = ThreadPoolExecutor(max_workers=MAX_RICERCHE_PARALLELE, thread_name_prefix='provider')
+
+async def in_thread_provider(funzione, *args):
+    """Esegue una funzione bloccante di un provider senza bloccare il loop."""
+    import asyncio
+    return await asyncio.get_running_loop().run_in_executor(_POOL_PROVIDER, funzione, *args)
+
+class Provider(abc.ABC):
+    """Sorgente di offerte. Le sottoclassi implementano `cerca` (async): senza,
+    il provider non si può istanziare.
+
+    `fornisce_prezzi` False = solo link di ricerca (nessuna chiamata di rete).
+    Il timeout si può cambiare con PROVIDER_TIMEOUT_<CHIAVE>, es. PROVIDER_TIMEOUT_AMADEUS=10.
+    """
+    
+    chiave = None  # nome usato in SITI_SELEZIONATI
+    nome = None
+    fornisce_prezzi = False
+    timeout = 5.0
+    
+    def __init__(self):
+        self.timeout = float(os.getenv(f'PROVIDER_TIMEOUT_{self.chiave.upper()}', self.timeout))
+    
+    @abc.abstractmethod
+    async def cerca(self, origine, destinazione, partenza, ritorno, adulti):
+        """Lista di offerte: dict con sito, prezzo (None se solo link), link e,
+        se noti, compagnia, voli_andata, voli_ritorno."""
+    
+    def __repr__(self):
+        return f"{type(self).__name__}({self.chiave})"
+
+class ProviderAmadeus(Provider):
+    chiave = 'amadeus'
+    nome = 'Amadeus'
+    fornisce_prezzi = True
+    timeout = 25.0
+    
+    async def cerca(self, origine, destinazione, partenza, ritorno, adulti):
+        offerta = await in_thread_provider(
+            amadeus_search_flights, partenza, ritorno, adulti, PRIORITA_COMANDO, origine, destinazione)
+        if not offerta:
+            return []
+        comuni = {
+            'sito': self.nome,
+            'link': offerta['link'],
+            'stale': offerta.get('stale', False),
+            'aggiornato_il': offerta.get('aggiornato_il'),
+        }
+        offerte = [
+            dict(comuni, prezzo=int(round(o.prezzo)), compagnia=o.compagnia,
+                 voli_andata=o.voli_andata, voli_ritorno=o.voli_ritorno)
+            for o in offerta.get('offerte', [])
+        ]
+        return offerte or [dict(comuni, prezzo=offerta['prezzo'])]
+
+class ProviderLink(Provider):
+    """Sito senza API di prezzi: solo il link alla ricerca con le stesse date."""
+    
+    timeout = 1.0
+    
+    def __init__(self, chiave, nome):
+        self.chiave = chiave
+        self.nome = nome
+        super().__init__()
+    
+    async def cerca(self, origine, destinazione, partenza, ritorno, adulti):
+        link = genera_link_offerta(self.nome, partenza, ritorno, adulti, origine, destinazione)
+        return [{'sito': self.nome, 'prezzo': None, 'link': link}]
+
+PROVIDER = {}
+
+def registra_provider(provider):
+    """Aggiunge (o sostituisce) un provider nel registro."""
+    PROVIDER[provider.chiave] = provider
+    return provider
+
+registra_provider(ProviderAmadeus())
+for _chiave, _nome in (('google', 'Google Flights'), ('skyscanner', 'Skyscanner'),
+                       ('kayak', 'Kayak'), ('aeromexico', 'Aeromexico')):
+    registra_provider(ProviderLink(_chiave, _nome))
+
+def provider_selezionati(siti=None):
+    """Provider indicati in SITI_SELEZIONATI (es. "amadeus,google"), nell'ordine del registro."""
+    chiavi = {s.strip().lower() for s in (siti or SITI_SELEZIONATI).split(',') if s.strip()}
+    for sconosciuto in sorted(chiavi - set(PROVIDER)):
+        print(f"⚠️ Sito sconosciuto in SITI_SELEZIONATI: {sconosciuto}")
+    return [p for chiave, p in PROVIDER.items() if chiave in chiavi]
+
+def _chiave_itinerario(offerta):
+    """Stessi voli = stessa offerta, anche se arriva da sorgenti diverse."""
+    if offerta.get('voli_andata') or offerta.get('voli_ritorno'):
+        return (tuple(offerta.get('voli_andata') or ()), tuple(offerta.get('voli_ritorno') or ()))
+    return (offerta['sito'], offerta['prezzo'])
+
+async def _cerca_provider(provider, *richiesta):
+    import asyncio
+    try:
+        return provider, await asyncio.wait_for(provider.cerca(*richiesta), provider.timeout), None
+    except asyncio.TimeoutError:
+        return provider, [], f"nessuna risposta entro {provider.timeout:g}s"
+    except Exception as e:
+        return provider, [], str(e)
+
+async def cerca_su_tutti(origine, destinazione, partenza, ritorno, adulti, providers=None, budget=None):
+    """Interroga in parallelo i provider e unisce le offerte.
+
+    Ritorna {'offerte': offerte con prezzo dalla più economica (deduplicate
+    per itinerario), 'link': [(sito, link)], 'migliori': {sito: offerta più
+    economica}, 'errori': {sito: messaggio}}. Quel che non arriva entro
+    `budget` secondi (PROVIDER_BUDGET_SECONDI) viene lasciato indietro.
+    """
+    import asyncio
+    providers = provider_selezionati() if providers is None else providers
+    budget = PROVIDER_BUDGET_SECONDI if budget is None else budget
+    richiesta = (origine, destinazione, partenza, ritorno, adulti)
+    attivi = {asyncio.ensure_future(_cerca_provider(p, *richiesta)): p for p in providers}
+    completati, in_ritardo = await asyncio.wait(attivi, timeout=budget) if attivi else (set(), set())
+    risultato = {'offerte': [], 'link': [], 'migliori': {}, 'errori': {}}
+    for task in in_ritardo:
+        task.cancel()
+        risultato['errori'][attivi[task].nome] = f"nessuna risposta entro {budget:g}s"
+    per_itinerario = {}
+    for task in sorted(completati, key=lambda t: providers.index(attivi[t])):
+        provider, offerte, errore = task.result()
+        if errore:
+            conta('errori', operazione=f'provider_{provider.chiave}')
+            risultato['errori'][provider.nome] = errore
+            continue
+        if offerte:
+            risultato['link'].append((provider.nome, offerte[0]['link']))
+        for offerta in offerte:
+            if offerta.get('prezzo') is None:
+                continue
+            migliore = risultato['migliori'].get(provider.nome)
+            if migliore is None or offerta['prezzo'] < migliore['prezzo']:
+                risultato['migliori'][provider.nome] = offerta
+            chiave = _chiave_itinerario(offerta)
+            gia_vista = per_itinerario.get(chiave)
+            if gia_vista is None or offerta['prezzo'] < gia_vista['prezzo']:
+                per_itinerario[chiave] = offerta
+    risultato['offerte'] = sorted(per_itinerario.values(), key=lambda o: o['prezzo'])
+    return risultato
+
 def prezzi_tempo_reale(origin, dest, partenza, ritorno, adults):
-    """Raccoglie prezzi reali e link dai siti selezionati (Amadeus + deep link)."""
-    selezionati = [s.strip().lower() for s in SITI_SELEZIONATI.split(',') if s.strip()]
-    risultati = []
-    # Amadeus fornisce prezzo
-    if 'amadeus' in selezionati:
-        try:
-            off = amadeus_search_flights(partenza, ritorno, adults)
-            if off:
-                risultati.append({
-                    'sito': 'Amadeus',
-                    'prezzo': off['prezzo'],
-                    'link': off['link'],
-                })
-        except Exception as e:
-            risultati.append({'sito': 'Amadeus', 'errore': str(e)})
-    # Deep links utili (senza prezzo diretto) per gli altri siti
-    mapping = {
-        'google': 'Google Flights',
-        'skyscanner': 'Skyscanner',
-        'kayak': 'Kayak',
-        'aeromexico': 'Aeromexico',
-    }
-    for key, nome in mapping.items():
-        if key in selezionati:
-            try:
-                link = genera_link_offerta(nome, partenza, ritorno, adults)
-                risultati.append({'sito': nome, 'prezzo': None, 'link': link})
-            except Exception as e:
-                risultati.append({'sito': nome, 'errore': str(e)})
+    """Prezzi reali e link da tutti i siti selezionati, interrogati in parallelo."""
+    import asyncio
+    providers = provider_selezionati()
+    risultato = asyncio.run(cerca_su_tutti(origin, dest, partenza, ritorno, adults, providers))
+    link = dict(risultato['link'])
     # Compose message
     lines = [f"📊 Prezzi in tempo reale {origin}→{dest} {partenza}→{ritorno} (adulti: {adults})"]
-    for r in risultati:
-        if r.get('errore'):
-            lines.append(f"- {r['sito']}: errore {r['errore']}")
-        else:
-            prezzo = f"€{r['prezzo']}" if r.get('prezzo') is not None else "—"
-            lines.append(f"- {r['sito']}: {prezzo}\n  {r['link']}")
+    for provider in providers:
+        nome = provider.nome
+        if nome in risultato['errori']:
+            lines.append(f"- {nome}: errore {risultato['errori'][nome]}")
+        elif nome in link:
+            migliore = risultato['migliori'].get(nome)
+            prezzo = f"€{migliore['prezzo']}" if migliore else "—"
+            if migliore and migliore.get('stale'):
+                prezzo += f" ⚠️ non aggiornato (sito non disponibile, dato del {migliore['aggiornato_il']})"
+            lines.append(f"- {nome}: {prezzo}\n  {link[nome]}")
+        elif provider.fornisce_prezzi:
+            lines.append(f"- {nome}: nessuna offerta")
+    if risultato['offerte']:
+        lines.append("🏆 Offerte più economiche:")
+        for o in risultato['offerte'][:3]:
+            voli = ' / '.join(' '.join(v) for v in (o.get('voli_andata'), o.get('voli_ritorno')) if v)
+            parti = (f"€{o['prezzo']}", o.get('compagnia'), voli, f"({o['sito']})")
+            lines.append("  · " + ' '.join(x for x in parti if x))
     return "\n".join(lines)
 
-def invia_email_offerta(offerta):
+def invia_email_offerta(offerta, watch):
     """Invia email per offerte (implementazione base)"""
     
     # Implementazione email semplificata
-    oggetto = f"🔥 OFFERTA VOLO! €{offerta['prezzo']}"
+    oggetto = f"🔥 OFFERTA VOLO {watch['origine']}→{watch['destinazione']}! €{offerta['prezzo']}"
     corpo = (
         f"Trovata offerta per €{offerta['prezzo']} dal {offerta['partenza']} al {offerta['ritorno']}\n"
         f"Sito: {offerta.get('sito', 'N/A')}\n"
         f"Link: {offerta.get('link', 'N/A')}\n"
     )
     
-    invia_email(oggetto, corpo)
+    accoda_notifica(_chiave_avviso(offerta['alert_type'], offerta, watch, offerta['prezzo']), corpo, oggetto)
 
-def invia_email_calo(prezzo_nuovo, prezzo_vecchio, motivo, offerta=None):
+def invia_email_calo(prezzo_nuovo, prezzo_vecchio, motivo, offerta, watch):
     """Invia email per cali di prezzo"""
     
-    oggetto = f"📉 PREZZO SCESO! €{prezzo_nuovo}"
+    oggetto = f"📉 PREZZO SCESO {watch['origine']}→{watch['destinazione']}! €{prezzo_nuovo}"
     if offerta:
         corpo = (
             f"Prezzo sceso da €{prezzo_vecchio} a €{prezzo_nuovo} ({motivo})\n"
@@ -539,128 +2461,970 @@ def invia_email_calo(prezzo_nuovo, prezzo_vecchio, motivo, offerta=None):
     else:
         corpo = f"Prezzo sceso da €{prezzo_vecchio} a €{prezzo_nuovo} ({motivo})"
     
-    invia_email(oggetto, corpo)
+    accoda_notifica(_chiave_avviso('CALO', offerta or {}, watch, prezzo_nuovo), corpo, oggetto)
 
 def invia_email(oggetto, corpo):
     """Funzione generica per inviare email"""
-    
+    return invia_email_batch([(oggetto, corpo)]) == 1
+
+@cronometra('invia_email_batch')
+def invia_email_batch(messaggi):
+    """Invia più email [(oggetto, corpo), ...] con una sola connessione SMTP autenticata.
+
+    Ritorna quante email sono state accettate dal server.
+    """
+    if not messaggi:
+        return 0
+    import smtplib
+    inviate = 0
     try:
-        server = smtplib.SMTP('smtp.gmail.com', 587)
-        server.starttls()
-        server.login(TUA_EMAIL, PASSWORD_EMAIL)
-        
-        messaggio = f"Subject: {oggetto}\n\n{corpo}"
-        server.sendmail(TUA_EMAIL, TUA_EMAIL, messaggio)
-        server.quit()
+        server = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=30)
+        try:
+            if SMTP_STARTTLS:
+                server.starttls()
+            if PASSWORD_EMAIL:
+                server.login(TUA_EMAIL, PASSWORD_EMAIL)
+            for oggetto, corpo in messaggi:
+                messaggio = f"Subject: {oggetto}\n\n{corpo}"
+                server.sendmail(TUA_EMAIL, TUA_EMAIL, messaggio.encode('utf-8'))
+                inviate += 1
+        finally:
+            server.quit()
         
-        print("📧 Email inviata!")
+        print(f"📧 Email inviate: {inviate}")
         
     except Exception as e:
         print(f"❌ Errore invio email: {e}")
+    conta('notifiche', inviate, canale='email', esito='inviata')
+    conta('notifiche', len(messaggi) - inviate, canale='email', esito='errore')
+    return inviate
+
+# ===== CODA NOTIFICHE =====
+# Gli avvisi del controllo vengono accodati e inviati insieme a fine ciclo:
+# niente doppioni entro FINESTRA_DEDUP_ORE e un solo digest invece di N messaggi.
+
+_CODA_NOTIFICHE = []
+_CODA_NOTIFICHE_LOCK = threading.Lock()
+
+def accoda_notifica(chiave, testo, oggetto=None):
+    """Mette in coda un avviso. `chiave` None = mai deduplicato (es. report)."""
+    with _CODA_NOTIFICHE_LOCK:
+        _CODA_NOTIFICHE.append({'chiave': chiave, 'testo': testo, 'oggetto': oggetto,
+                                'accodata_il': time.time()})
 
-def leggi_ultimo_prezzo():
-    """Legge l'ultimo prezzo salvato"""
+def _carica_notifiche_inviate():
     try:
-        with open('ultimo_prezzo.txt', 'r') as f:
-            return float(f.read().strip())
-    except:
-        return 999999  # Prima volta
+        with open(NOTIFICHE_FILE, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _salva_notifiche_inviate(inviate):
+    limite = time.time() - FINESTRA_DEDUP_ORE * 3600
+    inviate = {k: t for k, t in inviate.items() if t >= limite}
+    try:
+        scrivi_file_atomico(NOTIFICHE_FILE, json.dumps(inviate))
+    except OSError as e:
+        print(f"⚠️ Impossibile salvare le notifiche inviate: {e}")
+
+def _carica_notifiche_sospese():
+    limite = time.time() - NOTIFICHE_SOSPESE_ORE * 3600
+    try:
+        with open(NOTIFICHE_SOSPESE_FILE, 'r') as f:
+            sospese = json.load(f)
+    except (OSError, ValueError):
+        return []
+    return [v for v in sospese if v.get('accodata_il', 0) >= limite]
+
+def _salva_notifiche_sospese(sospese):
+    try:
+        if sospese:
+            scrivi_file_atomico(NOTIFICHE_SOSPESE_FILE, json.dumps(sospese, ensure_ascii=False))
+        elif os.path.exists(NOTIFICHE_SOSPESE_FILE):
+            os.remove(NOTIFICHE_SOSPESE_FILE)
+    except OSError as e:
+        print(f"⚠️ Impossibile salvare le notifiche in sospeso: {e}")
+
+def dividi_messaggio(testo, limite=TELEGRAM_MAX_CARATTERI):
+    """Spezza un testo troppo lungo a fine riga (a metà riga solo se è la riga a superare il limite).
+
+    Nessuna parte vuota o di soli spazi: Telegram rifiuta i messaggi senza testo.
+    """
+    if len(testo) <= limite:
+        return [testo] if testo.strip() else []
+    parti = []
+    corrente = []
+    lunghezza = 0
+    for riga in testo.split('\n'):
+        while len(riga) > limite:
+            if corrente:
+                parti.append('\n'.join(corrente))
+                corrente, lunghezza = [], 0
+            parti.append(riga[:limite])
+            riga = riga[limite:]
+        aggiunta = len(riga) + (1 if corrente else 0)
+        if corrente and lunghezza + aggiunta > limite:
+            parti.append('\n'.join(corrente))
+            corrente, aggiunta = [], len(riga)
+            lunghezza = 0
+        if not corrente and not riga.strip():
+            continue  # una parte non comincia con le righe vuote dove è stato spezzato il testo
+        corrente.append(riga)
+        lunghezza += aggiunta
+    if corrente:
+        parti.append('\n'.join(corrente))
+    return [parte for parte in parti if parte.strip()]
+
+def componi_digest(testi, limite=TELEGRAM_MAX_CARATTERI):
+    """Unisce più testi in messaggi da al massimo `limite` caratteri, in una sola passata.
+
+    I testi più lunghi del limite vengono spezzati a fine riga.
+    """
+    return [messaggio for messaggio, _ in _componi_digest(testi, limite)]
 
-def salva_prezzo(prezzo, tipo="unknown"):
-    """Salva il prezzo attuale"""
+def _componi_digest(testi, limite):
+    """Come componi_digest, ma con gli indici dei testi contenuti in ogni messaggio."""
+    separatore = "\n\n— — —\n\n"
+    messaggi = []
+    corrente = []
+    indici = set()
+    lunghezza = 0
+    for indice, testo in enumerate(testi):
+        for pezzo in dividi_messaggio(testo, limite):
+            aggiunta = len(pezzo) + (len(separatore) if corrente else 0)
+            if corrente and lunghezza + aggiunta > limite:
+                messaggi.append((separatore.join(corrente), indici))
+                corrente, indici, aggiunta = [], set(), len(pezzo)
+                lunghezza = 0
+            corrente.append(pezzo)
+            indici.add(indice)
+            lunghezza += aggiunta
+    if corrente:
+        messaggi.append((separatore.join(corrente), indici))
+    return messaggi
+
+# Una riga di report per offerta: il modello è pronto una volta, le righe escono in una passata
+RIGA_REPORT = "- {tipo}: €{prezzo} {partenza}→{ritorno} ({sito}){nota}"
+
+def rendi_offerte(offerte, modello=RIGA_REPORT):
+    """Righe di report per una lista di risultati (dict con prezzo, date, sito, tipo)."""
+    return [
+        modello.format(tipo=o.get('tipo', '?'), prezzo=o['prezzo'], partenza=o['partenza'],
+                       ritorno=o['ritorno'], sito=o.get('sito', '?'),
+                       nota=f" ⚠️ non aggiornato, del {o['aggiornato_il']}" if o.get('stale') else "")
+        for o in offerte
+    ]
+
+@cronometra('invia_notifiche_in_coda')
+def invia_notifiche_in_coda():
+    """Invia gli avvisi accodati: deduplica, raggruppa in digest e spedisce.
+
+    Gli avvisi già inviati negli ultimi FINESTRA_DEDUP_ORE (stessa chiave)
+    vengono scartati; quelli non consegnati restano in sospeso e vengono
+    ritentati alla chiamata successiva (per NOTIFICHE_SOSPESE_ORE). Ritorna
+    il numero di avvisi consegnati, None se l'invio è fallito.
+    """
+    with _CODA_NOTIFICHE_LOCK:
+        coda = list(_CODA_NOTIFICHE)
+        _CODA_NOTIFICHE.clear()
+    if not coda and not os.path.exists(NOTIFICHE_SOSPESE_FILE):
+        return 0
+    # Il lock copre lettura, invio e salvataggio: due istanze non mandano lo stesso avviso
+    with blocco_file(NOTIFICHE_FILE + '.lock'):
+        sospese = _carica_notifiche_sospese()
+        if sospese:
+            print(f"📨 {len(sospese)} notifiche in sospeso dal controllo precedente, nuovo tentativo")
+        return _invia_notifiche(sospese + coda)
+
+def _invia_notifiche(coda):
+    inviate = _carica_notifiche_inviate()
+    limite = time.time() - FINESTRA_DEDUP_ORE * 3600
+    da_inviare = []
+    chiavi = set()
+    for voce in coda:
+        chiave = voce['chiave']
+        if chiave is not None:
+            if chiave in chiavi or inviate.get(chiave, 0) >= limite:
+                continue
+            chiavi.add(chiave)
+        da_inviare.append(voce)
+    scartate = len(coda) - len(da_inviare)
+    if scartate:
+        conta('notifiche_duplicate', scartate)
+        print(f"🔕 {scartate} notifiche già inviate di recente, non ripetute")
+    if not da_inviare:
+        _salva_notifiche_sospese([])
+        return 0
+    
+    if USA_TELEGRAM:
+        # Un avviso è consegnato se sono partiti tutti i messaggi che lo contengono:
+        # se il digest si interrompe a metà, le parti già inviate non si ripetono
+        consegnati, falliti = set(), set()
+        for messaggio, indici in _componi_digest([v['testo'] for v in da_inviare], TELEGRAM_MAX_CARATTERI):
+            (consegnati if invia_messaggio_telegram(messaggio) else falliti).update(indici)
+        consegnati -= falliti
+        ok = not falliti
+    else:
+        if len(da_inviare) == 1:
+            email = [(da_inviare[0]['oggetto'] or "✈️ Flight Monitor", da_inviare[0]['testo'])]
+        else:
+            oggetti = [v['oggetto'] for v in da_inviare if v['oggetto']]
+            oggetto = f"✈️ Flight Monitor: {len(da_inviare)} avvisi"
+            if oggetti:
+                oggetto += f" ({oggetti[0]}...)"
+            email = [(oggetto, "\n\n-----\n\n".join(v['testo'] for v in da_inviare))]
+        ok = invia_email_batch(email) == len(email)
+        consegnati = set(range(len(da_inviare))) if ok else set()
+    
+    if consegnati:
+        adesso = time.time()
+        for i in consegnati:
+            if da_inviare[i]['chiave'] is not None:
+                inviate[da_inviare[i]['chiave']] = adesso
+        _salva_notifiche_inviate(inviate)
+    _salva_notifiche_sospese([v for i, v in enumerate(da_inviare) if i not in consegnati])
+    return len(da_inviare) if ok else None
+
+# ===== STATISTICHE PER COPPIA DI DATE =====
+# Aggiornate a ogni osservazione in O(1) (Welford, EWMA, sketch dei quantili)
+# e salvate nello storico: niente ricalcoli sull'intera cronologia.
+
+class StatistichePrezzo:
+    """Statistiche incrementali dei prezzi di una rotta/coppia di date.
+
+    Lo sketch dei quantili conta i prezzi in bucket logaritmici con errore
+    relativo ANALISI_ERRORE_QUANTILI (1% = ±€10 su €1000).
+    """
     
-    # Salva prezzo corrente
-    with open('ultimo_prezzo.txt', 'w') as f:
-        f.write(str(prezzo))
+    __slots__ = ('n', 'minimo', 'media', 'm2', 'ewma', 'ewvar', 'sketch')
     
-    # Salva nello storico
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    with open('storico_prezzi.txt', 'a') as f:
-        f.write(f"{timestamp} - €{prezzo} ({tipo})\n")
+    def __init__(self, n=0, minimo=None, media=0.0, m2=0.0, ewma=None, ewvar=0.0, sketch=None):
+        self.n = n
+        self.minimo = minimo
+        self.media = media
+        self.m2 = m2
+        self.ewma = ewma
+        self.ewvar = ewvar
+        self.sketch = sketch if sketch is not None else {}
+    
+    def aggiorna(self, prezzo, alfa=None):
+        """Aggiunge un'osservazione."""
+        alfa = ANALISI_ALFA_EWMA if alfa is None else alfa
+        self.n += 1
+        self.minimo = prezzo if self.minimo is None else min(self.minimo, prezzo)
+        delta = prezzo - self.media
+        self.media += delta / self.n
+        self.m2 += delta * (prezzo - self.media)
+        if self.ewma is None:
+            self.ewma = float(prezzo)
+        else:
+            scarto = prezzo - self.ewma
+            incremento = alfa * scarto
+            self.ewma += incremento
+            self.ewvar = (1 - alfa) * (self.ewvar + scarto * incremento)
+        if prezzo > 0:
+            bucket = math.ceil(math.log(prezzo) / _LOG_GAMMA_QUANTILI)
+            self.sketch[bucket] = self.sketch.get(bucket, 0) + 1
+        return self
+    
+    @property
+    def varianza(self):
+        return self.m2 / (self.n - 1) if self.n > 1 else 0.0
+    
+    def quantile(self, q):
+        """Prezzo al quantile q (0-1) secondo lo sketch."""
+        totale = sum(self.sketch.values())
+        if not totale:
+            return None
+        rango = q * (totale - 1)
+        cumulato = 0
+        for bucket in sorted(self.sketch):
+            cumulato += self.sketch[bucket]
+            if cumulato > rango:
+                return 2 * _GAMMA_QUANTILI ** bucket / (_GAMMA_QUANTILI + 1)
+        return 2 * _GAMMA_QUANTILI ** max(self.sketch) / (_GAMMA_QUANTILI + 1)
+    
+    def percentile_di(self, prezzo):
+        """Quota delle osservazioni passate più basse di `prezzo` (0-1)."""
+        totale = sum(self.sketch.values())
+        if not totale or prezzo <= 0:
+            return None
+        limite = math.ceil(math.log(prezzo) / _LOG_GAMMA_QUANTILI)
+        return sum(n for bucket, n in self.sketch.items() if bucket < limite) / totale
+    
+    def scarti_sotto_media(self, prezzo):
+        """Di quante deviazioni standard (EWMA) `prezzo` è sotto la media recente."""
+        # Con prezzi fermi la varianza è ~0: si considera comunque un rumore dell'1%
+        sigma = max(math.sqrt(max(self.ewvar, 0.0)), 0.01 * self.ewma)
+        return (self.ewma - prezzo) / sigma if sigma else 0.0
+    
+    def come_riga(self):
+        return (self.n, self.minimo, self.media, self.m2, self.ewma, self.ewvar,
+                json.dumps(self.sketch, separators=(',', ':')))
+    
+    @classmethod
+    def da_riga(cls, riga):
+        n, minimo, media, m2, ewma, ewvar, sketch = riga
+        return cls(n, minimo, media, m2, ewma, ewvar,
+                   {int(k): v for k, v in json.loads(sketch or '{}').items()})
+    
+    def __repr__(self):
+        return (f"StatistichePrezzo(n={self.n}, min=€{self.minimo}, media=€{self.media:.0f}, "
+                f"ewma=€{(self.ewma or 0):.0f})")
+
+_GAMMA_QUANTILI = (1 + ANALISI_ERRORE_QUANTILI) / (1 - ANALISI_ERRORE_QUANTILI)
+_LOG_GAMMA_QUANTILI = math.log(_GAMMA_QUANTILI)
+
+_STORICO_CONN = None
+_STORICO_LOCK = threading.Lock()
+
+def _storico_connessione():
+    """Apre (una volta) lo storico SQLite e crea tabella e indici."""
+    global _STORICO_CONN
+    if _STORICO_CONN is None:
+        conn = apri_sqlite(STORICO_DB)
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS osservazioni ('
+            ' id INTEGER PRIMARY KEY,'
+            ' rotta TEXT NOT NULL,'
+            ' partenza TEXT,'
+            ' ritorno TEXT,'
+            ' passeggeri INTEGER,'
+            ' prezzo REAL NOT NULL,'
+            ' sito TEXT,'
+            ' tipo TEXT,'
+            ' osservato_il TEXT NOT NULL,'
+            ' posizione INTEGER)'  # 1 = offerta migliore della ricerca, NULL = storico legacy
+        )
+        colonne = {riga[1] for riga in conn.execute('PRAGMA table_info(osservazioni)')}
+        if 'posizione' not in colonne:
+            conn.execute('ALTER TABLE osservazioni ADD COLUMN posizione INTEGER')
+        conn.execute(
+            'CREATE INDEX IF NOT EXISTS idx_osservazioni_rotta_date '
+            'ON osservazioni (rotta, partenza, ritorno, osservato_il)'
+        )
+        conn.execute('CREATE TABLE IF NOT EXISTS meta (chiave TEXT PRIMARY KEY, valore TEXT)')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS statistiche ('
+            ' rotta TEXT NOT NULL,'
+            ' partenza TEXT NOT NULL,'
+            ' ritorno TEXT NOT NULL,'
+            ' passeggeri INTEGER NOT NULL,'
+            ' n INTEGER NOT NULL,'
+            ' minimo REAL,'
+            ' media REAL,'
+            ' m2 REAL,'
+            ' ewma REAL,'
+            ' ewvar REAL,'
+            ' sketch TEXT,'
+            ' aggiornato_il TEXT,'
+            ' PRIMARY KEY (rotta, partenza, ritorno, passeggeri))'
+        )
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS pianificazione ('
+            ' rotta TEXT NOT NULL,'
+            ' partenza TEXT NOT NULL,'
+            ' ritorno TEXT NOT NULL,'
+            ' passeggeri INTEGER NOT NULL,'
+            ' prossimo_controllo REAL NOT NULL,'
+            ' intervallo_minuti REAL,'
+            ' PRIMARY KEY (rotta, partenza, ritorno, passeggeri))'
+        )
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS istantanee ('
+            ' rotta TEXT NOT NULL,'
+            ' partenza TEXT NOT NULL,'
+            ' ritorno TEXT NOT NULL,'
+            ' passeggeri INTEGER NOT NULL,'
+            ' impronte TEXT NOT NULL,'
+            ' offerte TEXT NOT NULL,'
+            ' aggiornato_il TEXT NOT NULL,'
+            ' PRIMARY KEY (rotta, partenza, ritorno, passeggeri))'
+        )
+        conn.commit()
+        _ricostruisci_statistiche(conn)
+        _STORICO_CONN = conn
+    return _STORICO_CONN
+
+def _ricostruisci_statistiche(conn):
+    """Calcola una volta sola le statistiche dalle osservazioni già presenti nello storico."""
+    if conn.execute("SELECT 1 FROM meta WHERE chiave = 'statistiche_v1'").fetchone():
+        return
+    statistiche = {}
+    righe = conn.execute(
+        'SELECT rotta, partenza, ritorno, passeggeri, prezzo, osservato_il FROM osservazioni '
+        'WHERE partenza IS NOT NULL AND ritorno IS NOT NULL AND passeggeri IS NOT NULL '
+        'AND (posizione IS NULL OR posizione = 1) ORDER BY osservato_il, id'
+    )
+    ultimo = {}
+    for rotta, partenza, ritorno, passeggeri, prezzo, osservato_il in righe:
+        chiave = (rotta, partenza, ritorno, passeggeri)
+        statistiche.setdefault(chiave, StatistichePrezzo()).aggiorna(prezzo)
+        ultimo[chiave] = osservato_il
+    with conn:
+        conn.executemany(
+            'INSERT OR REPLACE INTO statistiche VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [chiave + stat.come_riga() + (ultimo[chiave],) for chiave, stat in statistiche.items()],
+        )
+        conn.execute("INSERT OR REPLACE INTO meta (chiave, valore) VALUES ('statistiche_v1', ?)",
+                     (datetime.now().strftime("%Y-%m-%d %H:%M:%S"),))
+
+def leggi_statistiche_prezzo(rotta, partenza, ritorno, passeggeri):
+    """Statistiche della coppia di date (StatistichePrezzo) o None se mai osservata."""
+    try:
+        with _STORICO_LOCK:
+            riga = _storico_connessione().execute(
+                'SELECT n, minimo, media, m2, ewma, ewvar, sketch FROM statistiche '
+                'WHERE rotta = ? AND partenza = ? AND ritorno = ? AND passeggeri = ?',
+                (rotta, partenza, ritorno, passeggeri),
+            ).fetchone()
+    except sqlite3.Error as e:
+        print(f"⚠️ Statistiche non disponibili: {e}")
+        return None
+    return StatistichePrezzo.da_riga(riga) if riga else None
+
+def leggi_ultimo_prezzo(rotta=None, partenza=None, ritorno=None, passeggeri=None):
+    """Ultimo miglior prezzo registrato per rotta (e coppia di date, se indicata).
+
+    Ritorna 999999 se non c'è ancora nessuna osservazione.
+    """
+    rotta = rotta or f"{ORIGINE}-{DESTINAZIONE}"
+    sql = 'SELECT prezzo FROM osservazioni WHERE rotta = ? AND (posizione IS NULL OR posizione = 1)'
+    parametri = [rotta]
+    if partenza is not None and ritorno is not None:
+        sql += ' AND partenza = ? AND ritorno = ?'
+        parametri += [partenza, ritorno]
+    if passeggeri is not None:
+        sql += ' AND (passeggeri = ? OR passeggeri IS NULL)'
+        parametri.append(passeggeri)
+    sql += ' ORDER BY osservato_il DESC, id DESC LIMIT 1'
+    try:
+        with _STORICO_LOCK:
+            riga = _storico_connessione().execute(sql, parametri).fetchone()
+    except sqlite3.Error as e:
+        print(f"⚠️ Storico non disponibile: {e}")
+        return 999999
+    if riga is None:
+        return 999999  # Prima volta
+    return riga[0]
+
+def osservazioni_registrate(candidate):
+    """Le coppie (chiave query, osservato_il) già presenti nello storico."""
+    trovate = set()
+    try:
+        with _STORICO_LOCK:
+            conn = _storico_connessione()
+            for chiave, osservato_il in candidate:
+                origine, destinazione, partenza, ritorno, passeggeri = chiave
+                if conn.execute(
+                    'SELECT 1 FROM osservazioni WHERE rotta = ? AND partenza = ? AND ritorno = ? '
+                    'AND osservato_il = ? AND passeggeri = ? LIMIT 1',
+                    (f"{origine}-{destinazione}", partenza, ritorno, osservato_il, passeggeri),
+                ).fetchone():
+                    trovate.add((chiave, osservato_il))
+    except sqlite3.Error as e:
+        print(f"⚠️ Storico non disponibile: {e}")
+    return trovate
+
+def salva_prezzi(osservazioni, osservato_il=None, meta=None):
+    """Registra in un'unica transazione le offerte viste in questo controllo.
+
+    Ogni osservazione è un dict con rotta, partenza, ritorno, passeggeri,
+    prezzo, sito, tipo e posizione (1 = migliore della ricerca). Nella stessa
+    transazione aggiorna le statistiche delle coppie di date osservate, solo
+    con le migliori, e scrive le voci `meta` ({chiave: valore}).
+    """
+    if not osservazioni and not meta:
+        return 0
+    osservato_il = osservato_il or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    righe = [
+        (o['rotta'], o.get('partenza'), o.get('ritorno'), o.get('passeggeri'),
+         o['prezzo'], o.get('sito'), o.get('tipo'), o.get('osservato_il') or osservato_il,
+         o.get('posizione'))
+        for o in osservazioni
+    ]
+    with _STORICO_LOCK:
+        conn = _storico_connessione()
+        with conn:
+            conn.executemany(
+                'INSERT INTO osservazioni '
+                '(rotta, partenza, ritorno, passeggeri, prezzo, sito, tipo, osservato_il, posizione) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                righe,
+            )
+            _aggiorna_statistiche(conn, righe)
+            if meta:
+                conn.executemany('INSERT OR REPLACE INTO meta (chiave, valore) VALUES (?, ?)',
+                                 list(meta.items()))
+    print(f"💾 Storico: registrate {len(righe)} offerte")
+    return len(righe)
+
+def _aggiorna_statistiche(conn, righe):
+    """Aggiorna le statistiche delle coppie di date presenti in `righe` (come in salva_prezzi)."""
+    aggiornate = {}
+    for rotta, partenza, ritorno, passeggeri, prezzo, _, _, osservato_il, posizione in righe:
+        if partenza is None or ritorno is None or passeggeri is None or (posizione or 1) > 1:
+            continue
+        chiave = (rotta, partenza, ritorno, passeggeri)
+        if chiave not in aggiornate:
+            riga = conn.execute(
+                'SELECT n, minimo, media, m2, ewma, ewvar, sketch FROM statistiche '
+                'WHERE rotta = ? AND partenza = ? AND ritorno = ? AND passeggeri = ?', chiave,
+            ).fetchone()
+            aggiornate[chiave] = [StatistichePrezzo.da_riga(riga) if riga else StatistichePrezzo(), None]
+        aggiornate[chiave][0].aggiorna(prezzo)
+        aggiornate[chiave][1] = osservato_il
+    conn.executemany(
+        'INSERT OR REPLACE INTO statistiche VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        [chiave + stat.come_riga() + (quando,) for chiave, (stat, quando) in aggiornate.items()],
+    )
+
+def importa_storico_legacy(percorso='storico_prezzi.txt', rotta=None):
+    """Importa una volta sola le righe di storico_prezzi.txt nello storico SQLite.
+
+    Il vecchio formato è "2025-09-19 00:49:42 - €1130 (flessibile)": le date
+    del volo non erano salvate, quindi partenza/ritorno restano vuoti.
+    """
+    rotta = rotta or f"{ORIGINE}-{DESTINAZIONE}"
+    with _STORICO_LOCK:
+        gia_fatto = _storico_connessione().execute(
+            "SELECT valore FROM meta WHERE chiave = 'legacy_importato'"
+        ).fetchone()
+    if gia_fatto:
+        print(f"ℹ️ Storico legacy già importato il {gia_fatto[0]}")
+        return 0
+    formato = re.compile(r'^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}) - €(\d+(?:\.\d+)?) \(([^)]*)\)')
+    osservazioni = []
+    scartate = 0
+    with open(percorso, 'r') as f:
+        for riga in f:
+            m = formato.match(riga.strip())
+            if not m:
+                scartate += 1 if riga.strip() else 0
+                continue
+            osservazioni.append({
+                'rotta': rotta,
+                'prezzo': float(m.group(2)),
+                'tipo': m.group(3),
+                'osservato_il': m.group(1),
+            })
+    # Righe e segno di importazione nella stessa transazione: niente doppioni dopo un crash
+    salva_prezzi(osservazioni, meta={'legacy_importato': datetime.now().strftime("%Y-%m-%d %H:%M:%S")})
+    if scartate:
+        print(f"⚠️ {scartate} righe non riconosciute in {percorso}")
+    return len(osservazioni)
+
+# ===== ISTANTANEE DELLE OFFERTE =====
+# Per ogni query si tiene l'ultima lista delle offerte migliori con un hash del
+# contenuto: se non cambia nulla il watch non viene rianalizzato.
+
+def istantanea_offerte(chiave, offerta, aggiornato_il=None):
+    """Riga della tabella istantanee per l'esito (offerta o None) di una query."""
+    origine, destinazione, partenza, ritorno, passeggeri = chiave
+    offerte = (offerta or {}).get('offerte', [])
+    impronte = ','.join(o.impronta() for o in offerte) or '-'  # '-' = nessuna offerta
+    return (f"{origine}-{destinazione}", partenza, ritorno, passeggeri, impronte,
+            json.dumps([o.come_lista() for o in offerte], separators=(',', ':')),
+            aggiornato_il or datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+
+def leggi_impronte(chiavi):
+    """{chiave query: impronte dell'ultima istantanea} per le chiavi già viste."""
+    rotte = sorted({f"{c[0]}-{c[1]}" for c in chiavi})
+    if not rotte:
+        return {}
+    try:
+        with _STORICO_LOCK:
+            righe = _storico_connessione().execute(
+                'SELECT rotta, partenza, ritorno, passeggeri, impronte FROM istantanee '
+                f"WHERE rotta IN ({','.join('?' * len(rotte))})", rotte,
+            ).fetchall()
+    except sqlite3.Error as e:
+        print(f"⚠️ Istantanee non disponibili: {e}")
+        return {}
+    impronte = {}
+    for rotta, partenza, ritorno, passeggeri, valore in righe:
+        origine, _, destinazione = rotta.partition('-')
+        impronte[(origine, destinazione, partenza, ritorno, passeggeri)] = valore
+    return impronte
+
+def confronta_istantanee(esiti):
+    """Delta rispetto all'ultima istantanea delle query appena cercate.
+
+    Ritorna (chiavi cambiate, righe da salvare, offerte nuove o cambiate).
+    Le risposte in errore non contano come cambiate; quelle lette dalla cache
+    sì, se arrivate fuori dai controlli (es. con /prezzi) e quindi mai confrontate.
+    """
+    precedenti = leggi_impronte(esiti)
+    cambiate = set()
+    righe = []
+    offerte_nuove = 0
+    for chiave, esito in esiti.items():
+        if not esito or esito[0] != 'ok':
+            continue
+        riga = istantanea_offerte(chiave, esito[1])
+        vecchia = precedenti.get(chiave)
+        if vecchia == riga[4]:
+            continue
+        vecchie = set(vecchia.split(',')) if vecchia else set()
+        offerte_nuove += sum(1 for i in riga[4].split(',') if i != '-' and i not in vecchie)
+        cambiate.add(chiave)
+        righe.append(riga)
+    return cambiate, righe, offerte_nuove
+
+def salva_istantanee(righe):
+    """Sostituisce l'ultima istantanea delle query con quelle calcolate da confronta_istantanee."""
+    if not righe:
+        return
+    with _STORICO_LOCK:
+        conn = _storico_connessione()
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO istantanee VALUES (?, ?, ?, ?, ?, ?, ?)', righe)
+
+# ===== POLLING ADATTIVO =====
+# Ogni combinazione di date ha il suo prossimo controllo: più spesso se il
+# prezzo si muove, se la partenza è vicina o se è vicino alla soglia.
+
+def intervallo_adattivo(watch, partenza, prezzo, statistiche, oggi=None):
+    """Minuti da attendere prima di ricontrollare una combinazione di date."""
+    oggi = oggi or datetime.now().date()
+    try:
+        giorni = (datetime.strptime(partenza, '%Y-%m-%d').date() - oggi).days
+    except ValueError:
+        giorni = 60
+    # Partenza vicina (< 15 giorni) fino a 4 volte più spesso, lontana (> 8 mesi) fino a 4 volte meno
+    fattore_partenza = min(max(giorni / 60, 0.25), 4.0)
+    # Volatilità relativa (deviazione EWMA / media): 2% = cadenza base
+    if statistiche is None or statistiche.n < 2 or not statistiche.ewma:
+        fattore_volatilita = 0.5  # combinazione nuova: meglio conoscerla presto
+    else:
+        variazione = math.sqrt(max(statistiche.ewvar, 0.0)) / statistiche.ewma
+        fattore_volatilita = min(max(0.02 / max(variazione, 1e-3), 0.25), 4.0)
+    # Distanza dalla soglia: al 10% sopra = cadenza base, sotto soglia = 4 volte più spesso
+    if prezzo is None:
+        fattore_soglia = 1.0
+    else:
+        distanza = (prezzo - watch['prezzo_soglia']) / max(watch['prezzo_soglia'], 1)
+        fattore_soglia = min(max(0.5 + 5 * distanza, 0.25), 4.0)
+    minuti = INTERVALLO_MINUTI * fattore_partenza * fattore_volatilita * fattore_soglia
+    minuti = min(max(minuti, POLLING_MIN_MINUTI), POLLING_MAX_MINUTI)
+    # Un po' di jitter per non far scadere tutte insieme le combinazioni viste nello stesso ciclo
+    return minuti * random.uniform(0.9, 1.1)
+
+def leggi_pianificazione():
+    """{(origine, destinazione, partenza, ritorno, passeggeri): prossimo controllo (time.time())}."""
+    try:
+        with _STORICO_LOCK:
+            righe = _storico_connessione().execute(
+                'SELECT rotta, partenza, ritorno, passeggeri, prossimo_controllo FROM pianificazione'
+            ).fetchall()
+    except sqlite3.Error as e:
+        print(f"⚠️ Pianificazione non disponibile, controllo tutto: {e}")
+        return {}
+    piano = {}
+    for rotta, partenza, ritorno, passeggeri, prossimo in righe:
+        origine, _, destinazione = rotta.partition('-')
+        piano[(origine, destinazione, partenza, ritorno, passeggeri)] = prossimo
+    return piano
+
+def calcola_pianificazione(esiti, watches_per_chiave, adesso=None):
+    """Prossimo controllo delle combinazioni appena cercate, una riga per chiave di `esiti`.
+
+    `esiti` è {chiave query: ('ok', offerta) | ('errore', msg)}; una chiave
+    condivisa da più watch prende l'intervallo più breve.
+    """
+    adesso = adesso or time.time()
+    righe = []
+    for chiave, esito in esiti.items():
+        origine, destinazione, partenza, ritorno, passeggeri = chiave
+        rotta = f"{origine}-{destinazione}"
+        if esito is None or esito[0] == 'errore' or (esito[1] or {}).get('stale'):
+            minuti = POLLING_MIN_MINUTI
+        else:
+            prezzo = esito[1]['prezzo'] if esito[1] else None
+            statistiche = leggi_statistiche_prezzo(rotta, partenza, ritorno, passeggeri)
+            minuti = min(intervallo_adattivo(watch, partenza, prezzo, statistiche)
+                         for watch in watches_per_chiave[chiave])
+        righe.append((rotta, partenza, ritorno, passeggeri, adesso + minuti * 60, minuti))
+    return righe
+
+def salva_pianificazione(righe):
+    """Salva le righe calcolate da calcola_pianificazione."""
+    if not righe:
+        return
+    with _STORICO_LOCK:
+        conn = _storico_connessione()
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO pianificazione VALUES (?, ?, ?, ?, ?, ?)', righe)
 
 def scegli_sito_offerta():
     """Seleziona un sito simulato da cui proviene l'offerta"""
     import random
     return random.choice(["Google Flights", "Skyscanner", "Kayak", "Aeromexico"])
 
-def genera_link_offerta(sito, partenza, ritorno, num_passeggeri):
+# Link alle ricerche dei siti: un modello per sito, completato una volta per rotta.
+# Segnaposto: {origine}, {destinazione}, {origine_min}, {destinazione_min} (rotta),
+# {partenza}, {ritorno}, {partenza_compatta}, {ritorno_compatta} (AAAAMMGG), {adulti}
+MODELLI_LINK = {
+    'Google Flights': ("https://www.google.com/travel/flights?hl=it&gl=it"
+                       "#flt={origine}.{destinazione}.{partenza}*{destinazione}.{origine}.{ritorno}"
+                       ";c:EUR;e:1;sd:1;tt:o"),
+    'Skyscanner': ("https://www.skyscanner.it/trasporti/voli/{origine_min}/{destinazione_min}/"
+                   "{partenza_compatta}/{ritorno_compatta}/?adults={adulti}&currency=EUR"),
+    'Kayak': "https://www.kayak.it/flights/{origine}-{destinazione}/{partenza}/{ritorno}?adults={adulti}&c=EUR",
+    'Aeromexico': ("https://aeromexico.com/en-us/search?tripType=roundTrip&adults={adulti}"
+                   "&children=0&infants=0&origin={origine}&destination={destinazione}"
+                   "&departureDate={partenza}&returnDate={ritorno}&cabin=ECONOMY"),
+}
+
+class _Segnaposto(dict):
+    """Per format_map: i segnaposto non forniti restano nel testo."""
+    def __missing__(self, chiave):
+        return '{' + chiave + '}'
+
+def registra_modello_link(sito, modello):
+    """Aggiunge o sostituisce il modello di link di un sito (segnaposto come in MODELLI_LINK)."""
+    MODELLI_LINK[sito] = modello
+    modello_link.cache_clear()
+
+@functools.lru_cache(maxsize=512)
+def modello_link(sito, origine, destinazione):
+    """Modello del sito con la rotta già inserita (None se il sito non ha un modello)."""
+    modello = MODELLI_LINK.get(sito)
+    if modello is None:
+        return None
+    origine, destinazione = quote(origine, safe=''), quote(destinazione, safe='')
+    return modello.format_map(_Segnaposto(origine=origine, destinazione=destinazione,
+                                          origine_min=origine.lower(),
+                                          destinazione_min=destinazione.lower()))
+
+def genera_link_offerta(sito, partenza, ritorno, num_passeggeri, origin=None, destination=None):
     """Genera un link diretto (simulato ma utile) alla ricerca per le date date"""
-    origin = "FCO"
-    destination = "MEX"
-    if sito == "Google Flights":
-        params = {
-            'hl': 'it',
-            'gl': 'it',
-        }
-        base = "https://www.google.com/travel/flights"
-        fragment = f"#flt={origin}.{destination}.{partenza}*{destination}.{origin}.{ritorno};c:EUR;e:1;sd:1;tt:o"
-        return f"{base}?{urlencode(params)}{fragment}"
-    if sito == "Skyscanner":
-        return (
-            f"https://www.skyscanner.it/trasporti/voli/"
-            f"{origin.lower()}/{destination.lower()}/{partenza.replace('-', '')}/"
-            f"{ritorno.replace('-', '')}/?adults={num_passeggeri}&currency=EUR"
-        )
-    if sito == "Kayak":
-        return (
-            f"https://www.kayak.it/flights/{origin}-{destination}/"
-            f"{partenza}/{ritorno}?adults={num_passeggeri}&c=EUR"
-        )
-    if sito == "Aeromexico":
-        return (
-            "https://aeromexico.com/en-us/search?"
-            + urlencode({
-                'tripType': 'roundTrip',
-                'adults': num_passeggeri,
-                'children': 0,
-                'infants': 0,
-                'origin': origin,
-                'destination': destination,
-                'departureDate': partenza,
-                'returnDate': ritorno,
-                'cabin': 'ECONOMY',
-            })
-        )
-    return "https://www.google.com/travel/flights"
+    modello = modello_link(sito, origin or ORIGINE, destination or DESTINAZIONE)
+    if modello is None:
+        return "https://www.google.com/travel/flights"
+    return modello.format(partenza=partenza, ritorno=ritorno, adulti=num_passeggeri,
+                          partenza_compatta=partenza.replace('-', ''),
+                          ritorno_compatta=ritorno.replace('-', ''))
+
+def stampa_riepilogo():
+    """Stampa uso della quota Amadeus e statistiche della cache."""
+    quota = stato_quota_amadeus()
+    print(f"📈 Quota Amadeus: {quota['usate']}/{AMADEUS_QUOTA_MENSILE} nel mese, "
+          f"{quota['usate_oggi']}/{quota['budget_oggi']} oggi")
+    
+    stats = statistiche_cache()
+    print(f"🗄️ Cache Amadeus: {stats['hit']} hit / {stats['miss']} miss "
+          f"({stats['hit_rate']:.0%} chiamate risparmiate)")
+    
+    for provider, stato in stato_circuiti().items():
+        if stato != 'chiuso':
+            print(f"🚫 {provider}: circuito {stato}, chiamate sospese")
+
+def ascolta_comandi_telegram(stop=None):
+    """Long polling dei comandi Telegram finché `stop` (threading.Event) non è impostato."""
+    import asyncio
+    asyncio.run(ascolta_comandi_telegram_async(stop))
+
+async def _attendi(secondi, stop=None):
+    """asyncio.sleep interrotto in anticipo se `stop` viene impostato."""
+    import asyncio
+    fine = time.monotonic() + secondi
+    while stop is None or not stop.is_set():
+        resto = fine - time.monotonic()
+        if resto <= 0:
+            return
+        await asyncio.sleep(min(resto, 1.0))
+
+async def _rispondi_comando(testo):
+    """Esegue un comando (ricerche in un thread) e invia subito la risposta."""
+    import asyncio
+    try:
+        risposta = await asyncio.to_thread(gestisci_comando_telegram, testo)
+    except Exception as e:
+        risposta = f"❌ Errore comando: {e}"
+    for messaggio in componi_digest([risposta] if risposta else []):
+        await asyncio.to_thread(invia_messaggio_telegram, messaggio)
 
-def main():
+async def ascolta_comandi_telegram_async(stop=None):
+    """Bot Telegram asyncio: il polling non si blocca mai sulle ricerche.
+
+    Ogni comando diventa un task indipendente e risponde appena ha finito;
+    se getUpdates fallisce si riprova con attesa esponenziale.
+    """
+    import asyncio
+    print("\n🛰️ Ascolto comandi Telegram attivo (/prezzi)...")
+    last_update_id = None
+    attesa = 1.0
+    in_corso = set()
+    while stop is None or not stop.is_set():
+        offset = last_update_id + 1 if last_update_id else None
+        updates = await asyncio.to_thread(leggi_messaggi_telegram, offset)
+        if not updates or not updates.get('ok'):
+            if riproduzione_finita('/getUpdates'):
+                print("📼 Archivio dei comandi terminato")
+                break
+            print(f"⏳ getUpdates non riuscito, nuovo tentativo tra {attesa:.0f}s")
+            await _attendi(attesa, stop)
+            attesa = min(attesa * 2, TELEGRAM_BACKOFF_MAX)
+            continue
+        attesa = 1.0
+        for upd in updates.get('result', []):
+            last_update_id = upd.get('update_id', last_update_id)
+            msg = upd.get('message') or upd.get('edited_message')
+            if not msg:
+                continue
+            chat_id = str(msg.get('chat', {}).get('id'))
+            text = msg.get('text', '')
+            if TELEGRAM_CHAT_ID and str(TELEGRAM_CHAT_ID) != chat_id:
+                # ignora altre chat
+                continue
+            task = asyncio.create_task(_rispondi_comando(text))
+            in_corso.add(task)
+            task.add_done_callback(in_corso.discard)
+    if in_corso:
+        await asyncio.gather(*in_corso, return_exceptions=True)
+
+def _prossima_esecuzione(watch, adesso):
+    """Istante del prossimo controllo: intervallo del watch più un jitter casuale."""
+    intervallo = float(watch.get('intervallo_minuti', INTERVALLO_MINUTI)) * 60
+    return adesso + intervallo + random.uniform(0, max(0.0, JITTER_SECONDI))
+
+def esegui_daemon(stop=None, processi=None):
+    """Scheduler interno: esegue i watch quando scadono finché non arriva SIGTERM/SIGINT.
+
+    Token, sessioni HTTP e cache restano caldi tra un ciclo e l'altro; la
+    watchlist viene riletta a ogni ciclo, quindi watch nuovi o modificati
+    entrano in gioco senza riavviare.
+    """
+    stop = stop or threading.Event()
+    
+    def _termina(signum, _frame):
+        print(f"\n🛑 Ricevuto segnale {signum}: chiusura al termine del ciclo in corso...")
+        stop.set()
+    
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, _termina)
+        signal.signal(signal.SIGINT, _termina)
+    
+    if USA_TELEGRAM and ASCOLTA_COMANDI_TELEGRAM:
+        threading.Thread(target=ascolta_comandi_telegram, args=(stop,),
+                         name='comandi-telegram', daemon=True).start()
+    
+    print(f"🔁 Daemon attivo (intervallo {INTERVALLO_MINUTI:g} min, jitter {JITTER_SECONDI:g}s)")
+    pianificati = {}  # nome watch -> prossima esecuzione (time.time())
+    while not stop.is_set():
+        try:
+            watches = {w['nome']: w for w in carica_watchlist()}
+        except Exception as e:
+            print(f"❌ Watchlist non valida: {e}")
+            stop.wait(60)
+            continue
+        adesso = time.time()
+        for nome in list(pianificati):
+            if nome not in watches:
+                del pianificati[nome]
+        for nome in watches:
+            pianificati.setdefault(nome, adesso)
+        
+        coda = [(quando, nome) for nome, quando in pianificati.items()]
+        heapq.heapify(coda)
+        dovuti = []
+        while coda and coda[0][0] <= adesso:
+            dovuti.append(watches[heapq.heappop(coda)[1]])
+        
+        if dovuti:
+            print(f"\n🔍 Ciclo delle {datetime.now().strftime('%H:%M')}: {len(dovuti)} watch da controllare")
+            prossimi = {}
+            try:
+                prossimi = esegui_watchlist(dovuti, processi) or {}
+            except Exception as e:
+                print(f"❌ Errore generale: {e}")
+            fine = time.time()
+            for watch in dovuti:
+                if watch['nome'] in prossimi:
+                    # Polling adattivo: si riparte quando scade la prima combinazione del watch
+                    pianificati[watch['nome']] = max(prossimi[watch['nome']], fine + POLLING_MIN_MINUTI * 60)
+                else:
+                    pianificati[watch['nome']] = _prossima_esecuzione(watch, fine)
+            stampa_riepilogo()
+            continue
+        
+        attesa = coda[0][0] - adesso if coda else 60
+        stop.wait(max(1.0, attesa))
+
+def main(argv=None):
     """Funzione principale"""
     
+    parser = argparse.ArgumentParser(description="Flight Monitor: controllo prezzi voli")
+    parser.add_argument('--daemon', action='store_true',
+                        help="resta attivo e ricontrolla ogni watch al suo intervallo (stop con SIGTERM)")
+    parser.add_argument('--importa-storico', nargs='?', const='storico_prezzi.txt', metavar='FILE',
+                        help="importa nello storico SQLite il vecchio storico testuale ed esce")
+    parser.add_argument('--processi', type=int, metavar='N',
+                        help=f"divide i watch tra N processi (default SHARD_PROCESSI={SHARD_PROCESSI})")
+    archivio = parser.add_mutually_exclusive_group()
+    archivio.add_argument('--registra', nargs='?', const='traffico_http.jsonl.gz', metavar='FILE',
+                          help="registra richieste e risposte HTTP in un archivio JSON-lines gzip")
+    archivio.add_argument('--riproduci', metavar='FILE',
+                          help="risponde alle richieste HTTP dall'archivio invece che dalla rete "
+                               "(usare file di stato di prova: storico e notifiche vengono scritti)")
+    parser.add_argument('--tempi-originali', action='store_true',
+                        help="in riproduzione rispetta la durata registrata di ogni richiesta")
+    args = parser.parse_args(argv)
+    
+    if args.importa_storico:
+        n = importa_storico_legacy(args.importa_storico)
+        print(f"✅ Importate {n} righe da {args.importa_storico} in {STORICO_DB}")
+        return
+    
     print("🚀 Avvio Flight Monitor FCO-MEX (Aeromexico Diretto)")
     print(f"📅 Date: {PARTENZA} → {RITORNO}")
     print(f"👥 Passeggeri: {NUMERO_PASSEGGERI}")
     print(f"🎯 Target: €{PREZZO_SOGLIA} | Buono: €{PREZZO_BUONO}")
     print(f"🔔 Notifiche: {'Telegram' if USA_TELEGRAM else 'Email'}")
+    if os.path.exists(WATCHLIST_FILE):
+        print(f"👀 Watchlist: {WATCHLIST_FILE}")
     print("-" * 50)
     
-    # Controlla configurazione
-    if not controlla_configurazione():
+    # Controlla configurazione (in riproduzione le credenziali non servono: risponde l'archivio)
+    if not args.riproduci and not controlla_configurazione():
+        return
+    
+    if METRICHE_PORTA:
+        avvia_server_metriche()
+    
+    if args.registra or args.riproduci:
+        configura_archivio_http(args.registra, args.riproduci, args.tempi_originali)
+        print(f"📼 {'Registrazione su' if args.registra else 'Riproduzione da'} "
+              f"{args.registra or args.riproduci}")
+        args.processi = 1  # l'archivio è di questo processo: niente worker
+    
+    # Token Amadeus: riusa quello salvato e rinnovalo prima che scada
+    avvia_rinnovo_token()
+    
+    if args.daemon:
+        esegui_daemon(processi=args.processi)
+        chiudi_pool_shard()
+        ferma_rinnovo_token()
+        chiudi_sessioni_http()
+        stampa_riepilogo()
+        chiudi_archivio_http()
+        print("\n👋 Daemon terminato")
         return
     
     # Esegui controllo prezzi
-    controlla_prezzi()
+    controlla_prezzi(args.processi)
+    chiudi_pool_shard()
     
     # Ascolta comandi Telegram per richieste manuali (opzionale)
     if USA_TELEGRAM and ASCOLTA_COMANDI_TELEGRAM:
-        print("\n🛰️ Ascolto comandi Telegram attivo (/prezzi)...")
-        last_update_id = None
-        while True:
-            updates = leggi_messaggi_telegram(offset=last_update_id + 1 if last_update_id else None)
-            if not updates or not updates.get('ok'):
-                continue
-            for upd in updates.get('result', []):
-                last_update_id = upd.get('update_id', last_update_id)
-                msg = upd.get('message') or upd.get('edited_message')
-                if not msg:
-                    continue
-                chat_id = str(msg.get('chat', {}).get('id'))
-                text = msg.get('text', '')
-                if TELEGRAM_CHAT_ID and str(TELEGRAM_CHAT_ID) != chat_id:
-                    # ignora altre chat
-                    continue
-                risposta = gestisci_comando_telegram(text)
-                if risposta:
-                    invia_messaggio_telegram(risposta)
+        ascolta_comandi_telegram()
+    
+    ferma_rinnovo_token()
+    chiudi_sessioni_http()
+    
+    stampa_riepilogo()
+    chiudi_archivio_http()
     
     print("\n✅ Controllo completato!")
     print(f"📊 Prossimo controllo: manuale o automatico via scheduler")
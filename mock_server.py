@@ -0,0 +1,334 @@
+# SERVER FINTO Amadeus + Telegram per prove e benchmark offline
+# Emula token OAuth2, Flight Offers Search, Flight Cheapest Date Search,
+# sendMessage e getUpdates, con latenza e 429 configurabili, più un SMTP
+# minimo (senza STARTTLS) per le notifiche email.
+
+import argparse
+import json
+import math
+import random
+import re
+import socketserver
+import threading
+import time
+from datetime import date, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+
+VARIANTI_RISPOSTA = 3
+
+
+class StatoServer:
+    """Configurazione e contatori condivisi tra i thread del server."""
+
+    def __init__(self, latenza_ms=100, jitter_ms=30, prob_429=0.0, retry_after=1, seme=None):
+        self.latenza_ms = latenza_ms
+        self.jitter_ms = jitter_ms
+        self.prob_429 = prob_429
+        self.retry_after = retry_after
+        self.random = random.Random(seme)
+        self.lock = threading.Lock()
+        self.chiamate = {}
+        self.messaggi = []
+        self.email = []  # (sessione SMTP, messaggio) ricevuti dal server SMTP finto
+        self.aggiornamenti = []  # update Telegram da restituire con getUpdates
+        self.prossimo_update_id = 1
+        self.risposte_pronte = {}  # (rotta, date, adulti, max) -> varianti già serializzate
+
+    def conta(self, endpoint):
+        with self.lock:
+            self.chiamate[endpoint] = self.chiamate.get(endpoint, 0) + 1
+
+    def latenza(self):
+        with self.lock:
+            ritardo = self.latenza_ms + self.random.uniform(-self.jitter_ms, self.jitter_ms)
+        time.sleep(max(0.0, ritardo) / 1000)
+
+    def rifiuta(self):
+        with self.lock:
+            return self.random.random() < self.prob_429
+
+    def accoda_comando(self, testo, chat_id=1):
+        """Aggiunge un messaggio che il bot riceverà con getUpdates."""
+        with self.lock:
+            self.aggiornamenti.append({
+                'update_id': self.prossimo_update_id,
+                'message': {'chat': {'id': chat_id}, 'text': testo},
+            })
+            self.prossimo_update_id += 1
+
+    def riepilogo(self):
+        with self.lock:
+            return dict(self.chiamate)
+
+
+def _segmento(rnd, da, a, giorno, numero):
+    partenza = f"{giorno}T{rnd.randint(6, 22):02d}:{rnd.choice((0, 15, 30, 45)):02d}:00"
+    return {
+        'departure': {'iataCode': da, 'terminal': '1', 'at': partenza},
+        'arrival': {'iataCode': a, 'terminal': '2', 'at': partenza},
+        'carrierCode': 'AM',
+        'number': str(numero),
+        'aircraft': {'code': '789'},
+        'operating': {'carrierCode': 'AM'},
+        'duration': 'PT13H5M',
+        'id': str(numero),
+        'numberOfStops': 0,
+        'blacklistedInEU': False,
+    }
+
+
+def offerta_finta(rnd, indice, origine, destinazione, partenza, ritorno, adulti):
+    """Una flight-offer con la stessa struttura (e dimensione) di quelle vere."""
+    per_adulto = round(rnd.uniform(700, 1900), 2)
+    totale = f"{per_adulto * adulti:.2f}"
+    andata = _segmento(rnd, origine, destinazione, partenza, rnd.randint(1, 999))
+    rientro = _segmento(rnd, destinazione, origine, ritorno, rnd.randint(1, 999))
+    return {
+        'type': 'flight-offer',
+        'id': str(indice + 1),
+        'source': 'GDS',
+        'instantTicketingRequired': False,
+        'nonHomogeneous': False,
+        'oneWay': False,
+        'lastTicketingDate': partenza,
+        'numberOfBookableSeats': rnd.randint(1, 9),
+        'itineraries': [
+            {'duration': 'PT13H5M', 'segments': [andata]},
+            {'duration': 'PT12H10M', 'segments': [rientro]},
+        ],
+        'price': {
+            'currency': 'EUR',
+            'total': totale,
+            'base': f"{per_adulto * adulti * 0.7:.2f}",
+            'fees': [{'amount': '0.00', 'type': 'SUPPLIER'}, {'amount': '0.00', 'type': 'TICKETING'}],
+            'grandTotal': totale,
+        },
+        'pricingOptions': {'fareType': ['PUBLISHED'], 'includedCheckedBagsOnly': True},
+        'validatingAirlineCodes': ['AM'],
+        'travelerPricings': [
+            {
+                'travelerId': str(t + 1),
+                'fareOption': 'STANDARD',
+                'travelerType': 'ADULT',
+                'price': {'currency': 'EUR', 'total': f"{per_adulto:.2f}", 'base': f"{per_adulto * 0.7:.2f}"},
+                'fareDetailsBySegment': [
+                    {
+                        'segmentId': seg['id'],
+                        'cabin': 'ECONOMY',
+                        'fareBasis': 'NLNNNXM1',
+                        'brandedFare': 'BASIC',
+                        'class': 'N',
+                        'includedCheckedBags': {'quantity': 1},
+                    }
+                    for seg in (andata, rientro)
+                ],
+            }
+            for t in range(adulti)
+        ],
+    }
+
+
+class GestoreRichieste(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    stato = None  # impostato da avvia_server
+
+    def log_message(self, *args):
+        pass
+
+    def _rispondi(self, codice, corpo, intestazioni=None):
+        dati = corpo if isinstance(corpo, bytes) else json.dumps(corpo).encode('utf-8')
+        self.send_response(codice)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(dati)))
+        for chiave, valore in (intestazioni or {}).items():
+            self.send_header(chiave, valore)
+        self.end_headers()
+        self.wfile.write(dati)
+
+    def _leggi_corpo(self):
+        lunghezza = int(self.headers.get('Content-Length') or 0)
+        return parse_qs(self.rfile.read(lunghezza).decode('utf-8')) if lunghezza else {}
+
+    @staticmethod
+    def _genera_offerte(rnd, chiave):
+        origine, destinazione, partenza, ritorno, adulti, quante = chiave
+        data = [
+            offerta_finta(rnd, i, origine, destinazione, partenza, ritorno, adulti)
+            for i in range(quante)
+        ]
+        return json.dumps({
+            'meta': {'count': len(data)},
+            'data': data,
+            'dictionaries': {'carriers': {'AM': 'AEROMEXICO'}, 'aircraft': {'789': 'BOEING 787-9'}},
+        }).encode('utf-8')
+
+    def do_POST(self):
+        percorso = urlsplit(self.path).path
+        corpo = self._leggi_corpo()
+        if percorso == '/v1/security/oauth2/token':
+            self.stato.conta('token')
+            self.stato.latenza()
+            return self._rispondi(200, {
+                'type': 'amadeusOAuth2Token',
+                'access_token': f"finto-{random.getrandbits(64):x}",
+                'expires_in': 1799,
+                'state': 'approved',
+            })
+        if re.match(r'^/bot[^/]+/sendMessage$', percorso):
+            self.stato.conta('sendMessage')
+            with self.stato.lock:
+                self.stato.messaggi.append((corpo.get('chat_id', [''])[0], corpo.get('text', [''])[0]))
+            return self._rispondi(200, {'ok': True, 'result': {'message_id': len(self.stato.messaggi)}})
+        self._rispondi(404, {'errors': [{'detail': f'endpoint sconosciuto {percorso}'}]})
+
+    def do_GET(self):
+        parti = urlsplit(self.path)
+        params = {k: v[0] for k, v in parse_qs(parti.query).items()}
+        stato = self.stato
+        if parti.path == '/v2/shopping/flight-offers':
+            stato.conta('flight-offers')
+            stato.latenza()
+            if stato.rifiuta():
+                stato.conta('429')
+                return self._rispondi(429, {'errors': [{'status': 429, 'title': 'Too many requests'}]},
+                                      {'Retry-After': str(math.ceil(stato.retry_after))})
+            # Le risposte sono generate una volta per query (poche varianti a rotazione):
+            # così il costo del server non sporca le misure del client
+            chiave = (params.get('originLocationCode'), params.get('destinationLocationCode'),
+                      params.get('departureDate'), params.get('returnDate'),
+                      int(params.get('adults', 1)), int(params.get('max', 20)))
+            with stato.lock:
+                varianti = stato.risposte_pronte.get(chiave)
+                rnd = random.Random(stato.random.random())
+                scelta = stato.random.randrange(VARIANTI_RISPOSTA)
+            if varianti is None:
+                varianti = [self._genera_offerte(rnd, chiave) for _ in range(VARIANTI_RISPOSTA)]
+                with stato.lock:
+                    stato.risposte_pronte[chiave] = varianti
+            return self._rispondi(200, varianti[scelta])
+        if parti.path == '/v1/shopping/flight-dates':
+            stato.conta('flight-dates')
+            stato.latenza()
+            da, _, a = params.get('departureDate', '').partition(',')
+            a = a or da
+            durata_min, durata_max = (int(x) for x in params.get('duration', '7,7').split(','))
+            with stato.lock:
+                rnd = random.Random(stato.random.random())
+            giorno = date.fromisoformat(da)
+            data = []
+            while giorno <= date.fromisoformat(a):
+                for durata in range(durata_min, durata_max + 1):
+                    data.append({
+                        'type': 'flight-date',
+                        'origin': params.get('origin'),
+                        'destination': params.get('destination'),
+                        'departureDate': giorno.isoformat(),
+                        'returnDate': (giorno + timedelta(days=durata)).isoformat(),
+                        'price': {'total': f"{rnd.uniform(700, 1900):.2f}"},
+                    })
+                giorno += timedelta(days=1)
+            return self._rispondi(200, {'data': data})
+        if re.match(r'^/bot[^/]+/getUpdates$', parti.path):
+            stato.conta('getUpdates')
+            offset = int(params.get('offset', 0) or 0)
+            with stato.lock:
+                risultato = [u for u in stato.aggiornamenti if u['update_id'] >= offset]
+            if not risultato:
+                # long polling breve: il benchmark non deve aspettare 25s
+                time.sleep(min(float(params.get('timeout', 0) or 0), 0.05))
+            return self._rispondi(200, {'ok': True, 'result': risultato})
+        self._rispondi(404, {'errors': [{'detail': f'endpoint sconosciuto {parti.path}'}]})
+
+
+def avvia_server(porta=0, **opzioni):
+    """Avvia il server in un thread; ritorna (server, stato, url_base)."""
+    stato = StatoServer(**opzioni)
+    gestore = type('Gestore', (GestoreRichieste,), {'stato': stato})
+    server = ThreadingHTTPServer(('127.0.0.1', porta), gestore)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='server-finto', daemon=True).start()
+    return server, stato, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+class GestoreSmtp(socketserver.StreamRequestHandler):
+    """SMTP minimo: EHLO/HELO, MAIL, RCPT, DATA, RSET, NOOP, QUIT (niente TLS né AUTH).
+
+    Ogni connessione conta come una sessione ('smtp'); ogni DATA come un'email ('email').
+    """
+
+    stato = None
+
+    def _rispondi(self, riga):
+        self.wfile.write(f"{riga}\r\n".encode('ascii'))
+
+    def handle(self):
+        stato = self.stato
+        stato.conta('smtp')
+        with stato.lock:
+            sessione = stato.chiamate['smtp']
+        self._rispondi('220 server-finto ESMTP')
+        while True:
+            riga = self.rfile.readline()
+            if not riga:
+                return
+            comando = riga.decode('utf-8', 'replace').strip().split(' ', 1)[0].upper()
+            if comando == 'EHLO':
+                self._rispondi('250-server-finto')
+                self._rispondi('250 8BITMIME')
+            elif comando in ('HELO', 'MAIL', 'RCPT', 'RSET', 'NOOP'):
+                self._rispondi('250 OK')
+            elif comando == 'DATA':
+                self._rispondi('354 fine con <CRLF>.<CRLF>')
+                righe = []
+                for riga in iter(self.rfile.readline, b''):
+                    if riga in (b'.\r\n', b'.\n'):
+                        break
+                    righe.append(riga[1:] if riga.startswith(b'..') else riga)
+                stato.conta('email')
+                with stato.lock:
+                    stato.email.append((sessione, b''.join(righe).decode('utf-8', 'replace')))
+                self._rispondi('250 OK accodata')
+            elif comando == 'QUIT':
+                self._rispondi('221 ciao')
+                return
+            else:
+                self._rispondi('502 comando non supportato')
+
+
+def avvia_smtp(stato, porta=0):
+    """Avvia il server SMTP finto in un thread, con i contatori di `stato`; ritorna (server, porta)."""
+    gestore = type('GestoreSmtpStato', (GestoreSmtp,), {'stato': stato})
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', porta), gestore)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='smtp-finto', daemon=True).start()
+    return server, server.server_address[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Server finto Amadeus/Telegram per prove offline")
+    parser.add_argument('--porta', type=int, default=8099)
+    parser.add_argument('--latenza-ms', type=float, default=100)
+    parser.add_argument('--jitter-ms', type=float, default=30)
+    parser.add_argument('--prob-429', type=float, default=0.0)
+    parser.add_argument('--retry-after', type=int, default=1, help="secondi interi, come Amadeus")
+    parser.add_argument('--smtp-porta', type=int, help="avvia anche il server SMTP finto su questa porta")
+    args = parser.parse_args()
+    server, stato, url = avvia_server(args.porta, latenza_ms=args.latenza_ms, jitter_ms=args.jitter_ms,
+                                      prob_429=args.prob_429, retry_after=args.retry_after)
+    print(f"🧪 Server finto su {url}")
+    print(f"   AMADEUS_API_URL={url} TELEGRAM_API_URL={url}")
+    if args.smtp_porta is not None:
+        _, porta_smtp = avvia_smtp(stato, args.smtp_porta)
+        print(f"   USA_TELEGRAM=False SMTP_HOST=127.0.0.1 SMTP_PORT={porta_smtp} SMTP_STARTTLS=False")
+    try:
+        while True:
+            time.sleep(10)
+            print(f"📊 Chiamate: {stato.riepilogo()}")
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()